@@ -1,25 +1,43 @@
-from typing import List, Dict
+import asyncio
+from typing import List, Dict, Optional, Union
 from datetime import datetime, timedelta
 import uuid
 from contextlib import asynccontextmanager
-
-from fastapi import FastAPI, Request, Response, HTTPException, Body, Depends, Security, status
-from fastapi.responses import FileResponse, RedirectResponse
+import os
+import time
+
+from fastapi import (
+    FastAPI,
+    Request,
+    Response,
+    HTTPException,
+    Body,
+    Depends,
+    Header,
+    Query,
+    Security,
+    UploadFile,
+    status,
+)
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, RedirectResponse
 from fastapi.security import APIKeyHeader
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from jose import jwt
 from jose.exceptions import JWTError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, desc
-from sqlalchemy.orm import joinedload
-import secrets
-
-from config import jwt_settings
-from database import get_db_session, get_session_manager
-from embedding_api_client import OpenAIClient
+from sqlalchemy import select, desc, func
+from sqlalchemy.orm import joinedload, selectinload
+
+from config import analytics_settings, embedding_settings, jwt_settings, maintenance_settings, scoring_settings
+from blob_store import blob_response, store_blob
+from database import get_db_session, get_read_db_session, get_session_manager
+from duplicates import get_duplicate_clusters, scan_contest
+from embedding_api_client import FULL_EMBEDDING_DIMENSIONS, EmbeddingUnavailableError, get_embedding_client
+from idempotency import IDEMPOTENCY_HEADER_NAME, IdempotentRequest, request_fingerprint
 from model import (
-    Base,
+    DEFAULT_EMBEDDING_MODEL,
+    DEFAULT_PROMPT_VERSION,
     ContestStatus,
     User,
     TemporaryUser,
@@ -28,20 +46,30 @@ from model import (
     DataSource,
     Question,
     AnswerEmbedding,
+    QuestionEmbedding,
     AnswerOption,
     UserAnswer,
     ContestFirstDownloaded,
     QuestionFirstDownloaded,
 )
 from logger_config import logger
+from maintenance import maintenance_scheduler
+from partitions import create_contest_partitions
+from provisioning import credentials_csv, parse_users, provision_users, shutdown_hash_pool
+from rate_limit import submission_bucket, auth_bucket, enforce_rate_limit
 from payload import (
     ContestIn,
     ContestOut,
     DataSourcePayload,
+    ProvisionUsersOut,
     QuestionOut,
+    ScoringTicketOut,
     UserAnswerSubmission,
     UserAnswerOut,
+    UserStatsOut,
+    question_list_adapter,
 )
+from responses import ModelResponse
 from utils import (
     verify_password,
     get_password_hash,
@@ -50,27 +78,32 @@ from utils import (
     format_millisec,
     authenticate_user,
     send_email_to,
+    generate_api_key,
 )
-from validate import UserAnswerScorer
+from scoring import scoring_pool, update_contest_progress
+from tracing import TracingMiddleware, span
+from stats import get_contest_analytics, get_user_stats
+from validate import UserAnswerScorer, request_dimensions, stored_embedding_columns
+from vector_store import build_contest_vector_store
 
 
 API_HEADER_NAME = "x-api-key"
 api_key_header = APIKeyHeader(name=API_HEADER_NAME, auto_error=False)
 
 
-def generate_api_key():
-    return secrets.token_urlsafe(16)
-
-
 async def get_user_by_api_key(api_key: str, session: AsyncSession = Depends(get_db_session)) -> User:
-    result = await session.execute(select(User).where(User.api_key == api_key))
-    return result.scalar_one_or_none()
+    with span("auth"):
+        result = await session.execute(select(User).where(User.api_key == api_key))
+        return result.scalar_one_or_none()
 
 
 async def get_validated_user(
     api_key_header: str = Security(api_key_header),
     session: AsyncSession = Depends(get_db_session),
 ):
+    if not api_key_header:
+        # ヘッダーが無ければ DB に問い合わせるまでもない
+        raise HTTPException(status_code=403, detail="Invalid API Key")
     user = await get_user_by_api_key(api_key_header, session)
     if user:
         return user
@@ -78,27 +111,68 @@ async def get_validated_user(
         raise HTTPException(status_code=403, detail="Invalid API Key")
 
 
+async def get_admin_user(user: User = Security(get_validated_user)) -> User:
+    if not user.is_admin:
+        raise HTTPException(status_code=403, detail="Admin privileges required")
+    return user
+
+
+async def limit_submission_rate(user: User = Security(get_validated_user)):
+    # 照合済みのユーザーごとに数える (任意の API キーでバケットの表を埋めて、他のユーザーのバケットを追い出させない)。
+    # 照合はエンドポイントの user と共有されるので問い合わせは増えない
+    enforce_rate_limit(submission_bucket, f"user:{user.id}")
+
+
+async def limit_auth_rate(request: Request):
+    client_host = request.client.host if request.client else "unknown"
+    enforce_rate_limit(auth_bucket, f"ip:{client_host}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # write startup event here
-    await get_session_manager().create_tables(Base)
+    # スキーマ作成は fork 前に migrate.py で 1 回だけ行う
+    started = time.perf_counter()
+    get_session_manager()
+    if scoring_settings.SCORING_POOL_IN_APP:
+        scoring_pool.start()
+    if maintenance_settings.MAINTENANCE_IN_APP:
+        maintenance_scheduler.start()
+    logger.info(f"Worker {os.getpid()} startup finished in {(time.perf_counter() - started) * 1000:.1f} ms")
     yield
     # write shutdown event here
+    if scoring_settings.SCORING_POOL_IN_APP:
+        await scoring_pool.stop()
+    if maintenance_settings.MAINTENANCE_IN_APP:
+        await maintenance_scheduler.stop()
+    shutdown_hash_pool()
+    await get_session_manager().close()
 
 
 logger.info("API Server starting...")
-app = FastAPI(title="Rag Contest", lifespan=lifespan)
+app = FastAPI(title="Rag Contest", lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(TracingMiddleware)
 logger.info("API Server started")
 app.mount("/html", StaticFiles(directory="html"), name="html")
+
 templates = Jinja2Templates(directory="template")
 
 
+@app.exception_handler(EmbeddingUnavailableError)
+async def embedding_unavailable_handler(request: Request, exc: EmbeddingUnavailableError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Embedding service is temporarily unavailable"},
+        headers={"Retry-After": str(int(embedding_settings.BREAKER_OPEN_SECONDS))},
+    )
+
+
 @app.get("/api/contests", response_model=Dict[int, str])
 async def get_contests_list(
     user: User = Security(get_validated_user),
-    session: AsyncSession = Depends(get_db_session),
+    read_session: AsyncSession = Depends(get_read_db_session),
 ):
-    result = await session.execute(select(Contest).where(Contest.status != "Done"))
+    result = await read_session.execute(select(Contest).where(Contest.status != "Done"))
     contests = result.scalars().all()
     return {contest.id: contest.name for contest in contests}
 
@@ -108,8 +182,9 @@ async def get_contest(
     contest_id: int,
     user: User = Security(get_validated_user),
     session: AsyncSession = Depends(get_db_session),
+    read_session: AsyncSession = Depends(get_read_db_session),
 ):
-    result = await session.execute(
+    result = await read_session.execute(
         select(Contest)
         .options(joinedload(Contest.data_sources), joinedload(Contest.questions))
         .where(Contest.id == contest_id)
@@ -130,6 +205,10 @@ async def get_contest(
                 path=data_source.path,
                 type=data_source.type,
                 description=data_source.description,
+                id=data_source.id,
+                url=f"/api/data_sources/{data_source.id}/file" if data_source.sha256 else None,
+                sha256=data_source.sha256,
+                size=data_source.size,
             )
             for data_source in contest.data_sources
         ],
@@ -140,7 +219,7 @@ async def get_contest(
     try:
         await session.commit()
     finally:
-        return result
+        return ModelResponse(result)
 
 
 @app.get("/api/questions/{question_id}", response_model=QuestionOut)
@@ -148,8 +227,9 @@ async def get_question(
     question_id: int,
     user: User = Security(get_validated_user),
     session: AsyncSession = Depends(get_db_session),
+    read_session: AsyncSession = Depends(get_read_db_session),
 ):
-    result = await session.execute(
+    result = await read_session.execute(
         select(Question).options(joinedload(Question.answer_options)).where(Question.id == question_id)
     )
     question = result.scalars().first()
@@ -162,48 +242,111 @@ async def get_question(
         options=[option.option_text for option in question.answer_options],
         description=question.description,
     )
-    new_record = QuestionFirstDownloaded(user_id=user.id, question_id=question.id)
+    new_record = QuestionFirstDownloaded(user_id=user.id, question_id=question.id, contest_id=question.contest_id)
     session.add(new_record)
     try:
         await session.commit()
     finally:
-        return questionOut
+        return ModelResponse(questionOut)
 
 
 @app.get("/api/contests/{contest_id}/questions", response_model=List[QuestionOut])
 async def get_questions(
     contest_id: int,
     user: User = Security(get_validated_user),
-    session: AsyncSession = Depends(get_db_session),
+    read_session: AsyncSession = Depends(get_read_db_session),
 ):
-    results = await session.execute(select(Question).where(Contest.id == contest_id))
+    results = await read_session.execute(
+        select(Question)
+        .options(selectinload(Question.answer_options))
+        .where(Question.contest_id == contest_id)
+        .order_by(Question.id)
+    )
     questions = results.scalars().all()
     if questions is None:
         raise HTTPException(status_code=404, detail="Question not found")
 
-    return questions
+    return ModelResponse(
+        [
+            QuestionOut(
+                id=question.id,
+                query=question.query,
+                options=[option.option_text for option in question.answer_options],
+                description=question.description,
+            )
+            for question in questions
+        ],
+        adapter=question_list_adapter,
+    )
 
 
-@app.post("/api/questions/{question_id}", response_model=UserAnswerOut)
+@app.post(
+    "/api/questions/{question_id}",
+    response_model=Union[UserAnswerOut, ScoringTicketOut],
+    dependencies=[Depends(limit_submission_rate)],
+)
 async def submit_answer(
     question_id: int,
     answer_submission: UserAnswerSubmission = Body(...),
     user: User = Security(get_validated_user),
     session: AsyncSession = Depends(get_db_session),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER_NAME),
+    prefer: Optional[str] = Header(None),
 ):
     """答え合わせの処理
-    ユーザーの提出回答と正解を照合して正しいかどうか、かかった時間をデータベースに保存してメインページに表示"""
-    # Fetch the question from the database
+    ユーザーの提出回答と正解を照合して正しいかどうか、かかった時間をデータベースに保存してメインページに表示
+    非同期採点の場合は回答を保存して 202 と採点結果の取得先を返す"""
+    deferred = scoring_settings.SCORING_MODE == "deferred" or "respond-async" in (prefer or "")
+    # rollback すると user も expire されるので (フォールバックや重複の待機で)、先に id を控える
+    user_id = user.id
+    fingerprint = request_fingerprint(question_id, answer_submission)
+    async with IdempotentRequest(f"submit_answer:{user_id}", idempotency_key, fingerprint, session) as request:
+        if request.replay is not None:
+            return request.replay
+        if not deferred:
+            try:
+                return ModelResponse(
+                    request.save(await score_and_save_answer(question_id, answer_submission, user_id, session))
+                )
+            except EmbeddingUnavailableError as e:
+                if not embedding_settings.EMBEDDING_FALLBACK_TO_DEFERRED:
+                    raise
+                # 埋め込み API が落ちている間は受け付けだけして後で採点する
+                logger.warning(f"Falling back to deferred scoring: {e}")
+                await session.rollback()
+
+        ticket = await accept_answer(question_id, answer_submission, user_id, session)
+        return ModelResponse(
+            request.save(ticket, status_code=status.HTTP_202_ACCEPTED),
+            status_code=status.HTTP_202_ACCEPTED,
+            headers={"Location": ticket.result_url},
+        )
+
+
+async def get_question_or_404(question_id: int, session: AsyncSession) -> Question:
     result = await session.execute(select(Question).where(Question.id == question_id))
     question = result.scalars().first()
     if not question:
         raise HTTPException(status_code=404, detail="Question not found")
-    user_id = user.id
+    return question
+
+
+async def score_and_save_answer(
+    question_id: int,
+    answer_submission: UserAnswerSubmission,
+    user_id: int,
+    session: AsyncSession,
+) -> UserAnswerOut:
+    # Fetch the question from the database
+    question = await get_question_or_404(question_id, session)
     contest_id = question.contest_id
 
     # Score the answer
-    uas = await UserAnswerScorer.create(user_id, question_id, session)
-    score = uas.get_score(answer_submission.answer)
+    with span("scorer"):
+        uas = await UserAnswerScorer.create(user_id, question_id, session)
+    # 埋め込み API は同期クライアントなので、イベントループを止めないようスレッドで呼ぶ
+    with span("embedding"):
+        score = await asyncio.to_thread(uas.get_score, answer_submission.answer)
     is_correct = uas.is_correct(score)
     time_taken_ms = uas.get_time()
 
@@ -212,41 +355,19 @@ async def submit_answer(
         answer=answer_submission.answer,
         user_id=user_id,
         question_id=question_id,
+        contest_id=contest_id,
         is_correct=is_correct,
         similarity=score,
         time_taken_ms=time_taken_ms,
+        **uas.stored_embedding(),
     )
     session.add(new_answer)
-    await session.commit()
+    with span("commit"):
+        await session.commit()
 
     # check if all questions are answered
-    result = await session.execute(
-        select(UserAnswer).options(joinedload(UserAnswer.question)).where(UserAnswer.user_id == user_id)
-    )
-    answers = result.scalars().all()
-    result = await session.execute(select(Question).where(Question.contest_id == contest_id))
-    questions = result.scalars().all()
-    all_questions = {question.id for question in questions}
-    answered_questions = {answer.question_id for answer in answers}
-    sum_time = sum([answer.time_taken_ms for answer in answers])
-    number_of_correct_answers = sum([answer.is_correct for answer in answers])
-    print("contest_id: ", contest_id)
-    print("all_questions: ", all_questions)
-    print("answered_questions: ", answered_questions)
-    answers_remain = list(all_questions - answered_questions)
-    # await session.commit()
-    if not answers_remain:
-        try:
-            new_result = ContestResult(
-                user_id=user_id,
-                contest_id=contest_id,
-                number_of_correct_answers=number_of_correct_answers,
-                time_ms=sum_time,
-            )
-            session.add(new_result)
-            await session.commit()
-        except Exception:
-            pass
+    with span("progress"):
+        answers_remain = await update_contest_progress(session, user_id, contest_id)
 
     return UserAnswerOut(
         question_id=question_id,
@@ -258,12 +379,182 @@ async def submit_answer(
     )
 
 
+async def accept_answer(
+    question_id: int,
+    answer_submission: UserAnswerSubmission,
+    user_id: int,
+    session: AsyncSession,
+) -> ScoringTicketOut:
+    """採点せずに回答を保存する (かかった時間は受け付けた時点で確定する)"""
+    question = await get_question_or_404(question_id, session)
+    time_taken_ms = await UserAnswerScorer.measure_time_taken_ms(user_id, question, session)
+    new_answer = UserAnswer(
+        answer=answer_submission.answer,
+        user_id=user_id,
+        question_id=question_id,
+        contest_id=question.contest_id,
+        time_taken_ms=time_taken_ms,
+    )
+    session.add(new_answer)
+    # commit すると属性が expire されて読み直しに行く (AsyncSession では暗黙の IO は使えない) ので、先に id を控える
+    await session.flush()
+    answer_id = new_answer.id
+    contest_id = new_answer.contest_id
+    await session.commit()
+    if scoring_settings.SCORING_POOL_IN_APP:
+        scoring_pool.submit(answer_id, contest_id)
+
+    return ScoringTicketOut(
+        ticket_id=answer_id,
+        question_id=question_id,
+        answer=answer_submission.answer,
+        time_taken_ms=time_taken_ms,
+        status="pending",
+        result_url=f"/api/answers/{answer_id}",
+    )
+
+
+@app.get("/api/answers/{ticket_id}", response_model=Union[UserAnswerOut, ScoringTicketOut])
+async def get_answer_result(
+    ticket_id: int,
+    user: User = Security(get_validated_user),
+    session: AsyncSession = Depends(get_db_session),
+):
+    """非同期採点の結果を取得する。採点待ちの間は 202"""
+    # ポーリングされるので、回答の埋め込みは読まない
+    result = await session.execute(
+        select(
+            UserAnswer.id,
+            UserAnswer.contest_id,
+            UserAnswer.question_id,
+            UserAnswer.answer,
+            UserAnswer.is_correct,
+            UserAnswer.similarity,
+            UserAnswer.time_taken_ms,
+        ).where((UserAnswer.id == ticket_id) & (UserAnswer.user_id == user.id))
+    )
+    answer = result.first()
+    if answer is None:
+        raise HTTPException(status_code=404, detail="Answer not found")
+
+    if answer.similarity is None:
+        ticket = ScoringTicketOut(
+            ticket_id=answer.id,
+            question_id=answer.question_id,
+            answer=answer.answer,
+            time_taken_ms=answer.time_taken_ms,
+            status="pending",
+            result_url=f"/api/answers/{answer.id}",
+        )
+        return ModelResponse(ticket, status_code=status.HTTP_202_ACCEPTED)
+
+    answers_remain = await update_contest_progress(session, user.id, answer.contest_id)
+    return ModelResponse(
+        UserAnswerOut(
+            question_id=answer.question_id,
+            answer=answer.answer,
+            is_correct=answer.is_correct,
+            similarity=answer.similarity,
+            time_taken_ms=answer.time_taken_ms,
+            not_answered_question_ids=answers_remain,
+        )
+    )
+
+
+@app.api_route("/api/data_sources/{data_source_id}/file", methods=["GET", "HEAD"])
+async def download_data_source(
+    request: Request,
+    data_source_id: int,
+    user: User = Security(get_validated_user),
+    session: AsyncSession = Depends(get_read_db_session),
+):
+    """アップロードされたデータソースのファイル (Range・If-None-Match に対応)"""
+    data_source = await session.get(DataSource, data_source_id)
+    if data_source is None or data_source.sha256 is None:
+        raise HTTPException(status_code=404, detail="Data source file not found")
+    return blob_response(request, data_source)
+
+
+@app.put("/api/admin/data_sources/{data_source_id}/file")
+async def upload_data_source(
+    data_source_id: int,
+    file: UploadFile,
+    user: User = Security(get_admin_user),
+    session: AsyncSession = Depends(get_db_session),
+):
+    """データソースのファイルをアップロードする (同じ内容のファイルは共有する)"""
+    data_source = await session.get(DataSource, data_source_id)
+    if data_source is None:
+        raise HTTPException(status_code=404, detail="Data source not found")
+    sha256, size = await asyncio.to_thread(store_blob, file.file)
+    data_source.sha256 = sha256
+    data_source.size = size
+    data_source.content_type = file.content_type
+    await session.commit()
+    return {"data_source_id": data_source_id, "sha256": sha256, "size": size}
+
+
+@app.get("/api/admin/embedding/stats")
+async def get_embedding_stats(user: User = Security(get_admin_user)):
+    """この worker の埋め込み API 呼び出しのブレーカー状態とカウンター"""
+    return {"pid": os.getpid(), **get_embedding_client().breaker.snapshot()}
+
+
+@app.get("/api/admin/contests/{contest_id}/duplicates")
+async def get_duplicate_answers(
+    contest_id: int,
+    min_similarity: Optional[float] = None,
+    refresh: bool = False,
+    user: User = Security(get_admin_user),
+    session: AsyncSession = Depends(get_db_session),
+):
+    """別のユーザーのほぼ同じ回答のクラスタ。refresh=true で前回以降の回答を検査してから返す"""
+    if refresh:
+        await scan_contest(session, contest_id)
+    return {"contest_id": contest_id, "clusters": await get_duplicate_clusters(session, contest_id, min_similarity)}
+
+
+@app.get("/api/admin/contests/{contest_id}/analytics")
+async def get_contest_analytics_endpoint(
+    contest_id: int,
+    bins: int = Query(analytics_settings.ANALYTICS_BINS, ge=1, le=100),
+    top_wrong_answers: int = Query(5, ge=0, le=50),
+    full: bool = False,
+    user: User = Security(get_admin_user),
+    session: AsyncSession = Depends(get_read_db_session),
+):
+    """問題ごとの類似度の分布・正答率・回答時間・多い誤答。full=true で最初から集計し直す"""
+    return await get_contest_analytics(session, contest_id, bins, top_wrong_answers, full)
+
+
+@app.post("/api/admin/users/bulk", response_model=ProvisionUsersOut)
+async def provision_users_endpoint(
+    request: Request,
+    skip_existing: bool = False,
+    user: User = Security(get_admin_user),
+    session: AsyncSession = Depends(get_db_session),
+):
+    """参加者をまとめて登録する (CSV: name,email[,password] / JSON: {"users": [...]})
+
+    登録済みの名前・メールアドレスがあれば 409。skip_existing=true なら飛ばして skipped で返す。
+    Accept: text/csv なら API キーと生成したパスワードを CSV で返す"""
+    users = parse_users(request.headers.get("content-type", ""), await request.body())
+    provisioned = await provision_users(session, users, skip_existing)
+    if "text/csv" in request.headers.get("accept", ""):
+        return Response(
+            content=credentials_csv(provisioned),
+            media_type="text/csv",
+            headers={"Content-Disposition": "attachment; filename=credentials.csv"},
+        )
+    return provisioned
+
+
 @app.get("/signup")
 async def signup_page():
     return FileResponse("./html/signup.html", media_type="text/html")
 
 
-@app.post("/signup")
+@app.post("/signup", dependencies=[Depends(limit_auth_rate)])
 async def signup(
     json_data: dict,
     session: AsyncSession = Depends(get_db_session),
@@ -307,9 +598,9 @@ async def signup(
 
 @app.get("/verify/{user_id}")
 async def authenticate_user_by_email(user_id: str, session: AsyncSession = Depends(get_db_session)):
-    hour_ago = datetime.now() - timedelta(hours=1)
+    expired_before = datetime.now() - timedelta(hours=maintenance_settings.TEMPORARY_USER_TTL_HOURS)
     result = await session.execute(
-        select(TemporaryUser).where((TemporaryUser.registered_at > hour_ago) & (TemporaryUser.id == user_id))
+        select(TemporaryUser).where((TemporaryUser.registered_at > expired_before) & (TemporaryUser.id == user_id))
     )
     tmp_user = result.scalars().first()
     if not tmp_user:
@@ -337,7 +628,7 @@ async def login_page(request: Request, session: AsyncSession = Depends(get_db_se
         return FileResponse("./html/login.html", media_type="text/html")
 
 
-@app.post("/login")
+@app.post("/login", dependencies=[Depends(limit_auth_rate)])
 async def login(
     response: Response,
     json_data: dict,
@@ -408,8 +699,30 @@ async def dashboard_page(request: Request, session: AsyncSession = Depends(get_d
         return RedirectResponse(url="/login", status_code=303)
 
 
+async def get_dashboard_user(
+    request: Request,
+    api_key_header: str = Security(api_key_header),
+    session: AsyncSession = Depends(get_db_session),
+) -> User:
+    # API キーか、ダッシュボードのログイン cookie のどちらでもよい
+    if api_key_header:
+        return await get_validated_user(api_key_header, session)
+    token = fetch_access_token_from_cookie_header(request)
+    return await get_current_user(token, session)
+
+
+@app.get("/api/users/me/stats", response_model=UserStatsOut)
+async def get_user_stats_endpoint(
+    user: User = Depends(get_dashboard_user),
+    session: AsyncSession = Depends(get_read_db_session),
+):
+    """参加したコンテストごとの回答数・残り・正解数・合計時間・順位"""
+    contests = await get_user_stats(session, user.id)
+    return ModelResponse(UserStatsOut(user_id=user.id, user_name=user.name, contests=contests))
+
+
 @app.get("/results")
-async def get_results_page(request: Request, session: AsyncSession = Depends(get_db_session)):
+async def get_results_page(request: Request, session: AsyncSession = Depends(get_read_db_session)):
     result = await session.execute(
         select(Contest)
         # .where(Contest.status == ContestStatus.Done)
@@ -429,7 +742,7 @@ async def get_results_page(request: Request, session: AsyncSession = Depends(get
 
 
 @app.get("/results/{contest_id}")
-async def get_result_page(request: Request, contest_id: int, session: AsyncSession = Depends(get_db_session)):
+async def get_result_page(request: Request, contest_id: int, session: AsyncSession = Depends(get_read_db_session)):
     result = await session.execute(select(Contest).where(Contest.id == contest_id))
     contest = result.scalars().first()
     if not contest:
@@ -464,28 +777,35 @@ async def get_result_page(request: Request, contest_id: int, session: AsyncSessi
 
 
 @app.get("/results/{contest_id}/details")
-async def get_result_details_page(request: Request, contest_id: int, session: AsyncSession = Depends(get_db_session)):
-    result = await session.execute(
-        select(UserAnswer)
-        .options(joinedload(UserAnswer.user), joinedload(UserAnswer.question))
-        .where(Contest.id == contest_id)
-    )
-    user_answers = result.scalars().all()
-
+async def get_result_details_page(request: Request, contest_id: int, session: AsyncSession = Depends(get_read_db_session)):
     result = await session.execute(select(Contest).where(Contest.id == contest_id))
     contest = result.scalars().first()
     if not contest:
         raise HTTPException(status_code=404, detail="Contest not found")
     contest_name = contest.name
 
+    # 表示する列だけを読む (回答の埋め込みは読み込まない)
+    result = await session.execute(
+        select(
+            User.name,
+            Question.query,
+            UserAnswer.answer,
+            UserAnswer.similarity,
+            UserAnswer.is_correct,
+            UserAnswer.time_taken_ms,
+        )
+        .join(User, User.id == UserAnswer.user_id)
+        .join(Question, Question.id == UserAnswer.question_id)
+        .where(UserAnswer.contest_id == contest_id)
+        .order_by(UserAnswer.id)
+    )
+
     response = []
-    for answer in user_answers:
-        username = answer.user.name
-        query = answer.question.query
+    for answer in result.all():
         response.append(
             {
-                "user_name": username,
-                "query": query,
+                "user_name": answer.name,
+                "query": answer.query,
                 "user_answer": answer.answer,
                 "similarity": answer.similarity,
                 "pass_fail": "Pass" if answer.is_correct else "Fail",
@@ -508,12 +828,32 @@ async def register_contest_page():
 async def register_contest(
     contest_submission: ContestIn = Body(...),
     session: AsyncSession = Depends(get_db_session),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER_NAME),
 ):
-    # Contest, DataSource, Question, AnswerEmbedding, AnswerOption テーブルに格納
+    fingerprint = request_fingerprint(contest_submission)
+    async with IdempotentRequest("register_contest", idempotency_key, fingerprint, session) as request:
+        if request.replay is not None:
+            return request.replay
+        return request.save(await save_contest(contest_submission, session))
+
+
+async def save_contest(contest_submission: ContestIn, session: AsyncSession) -> dict:
+    # Contest, DataSource, Question, AnswerEmbedding, QuestionEmbedding, AnswerOption テーブルに格納
+    # 先に id を採番してパーティションを短いトランザクションで作っておく (登録中に親テーブルをロックしない)
+    result = await session.execute(select(func.nextval(func.pg_get_serial_sequence("contest", "id"))))
+    contest_id = result.scalar_one()
+    async with get_session_manager().connect() as conn:
+        await create_contest_partitions(conn, contest_id)
+
     new_contest = Contest(
+        id=contest_id,
         name=contest_submission.contest_info.name,
         description=contest_submission.contest_info.description,
         number_of_questions=len(contest_submission.query_answers),
+        embedding_dimensions=contest_submission.contest_info.embedding_dimensions or FULL_EMBEDDING_DIMENSIONS,
+        embedding_precision=contest_submission.contest_info.embedding_precision or "float32",
+        embedding_model=DEFAULT_EMBEDDING_MODEL,
+        embedding_prompt_version=DEFAULT_PROMPT_VERSION,
     )
     session.add(new_contest)
     await session.flush()
@@ -538,9 +878,22 @@ async def register_contest(
         session.add(new_qa)
         await session.flush()
 
-        emb = OpenAIClient().get_embedding(qa.query, qa.answer)
-        new_answer = AnswerEmbedding(question_id=new_qa.id, answer=qa.answer, text_embedding_3_small=emb)
+        emb = await asyncio.to_thread(
+            get_embedding_client(new_contest.embedding_model).get_embedding,
+            qa.query,
+            qa.answer,
+            request_dimensions(new_contest),
+            new_contest.embedding_prompt_version,
+        )
+        new_answer = AnswerEmbedding(question_id=new_qa.id, answer=qa.answer)
         session.add(new_answer)
+        new_embedding = QuestionEmbedding(
+            question_id=new_qa.id,
+            model=new_contest.embedding_model,
+            prompt_version=new_contest.embedding_prompt_version,
+            **stored_embedding_columns(new_contest, emb, column="embedding"),
+        )
+        session.add(new_embedding)
         await session.flush()
 
         for option in qa.options:
@@ -549,5 +902,7 @@ async def register_contest(
             await session.flush()
 
     await session.commit()
-    # [疑問]何を返せばいいのか
-    # return {"status": "success", "contest_id": new_contest.id}
+    await build_contest_vector_store(session, contest_id)
+    # 冪等リプレイで同じ結果を返せるよう、作成したコンテストの id を返す
+    # (commit 後の new_contest は expire されているので、採番済みの contest_id を使う)
+    return {"status": "success", "contest_id": contest_id}
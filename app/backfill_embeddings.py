@@ -0,0 +1,164 @@
+"""正解を別のモデル・プロンプトのバージョンで埋め込み直して question_embedding に入れる
+
+まだそのバージョンの埋め込みが無い問題だけをバッチにまとめ、同時に --parallelism 本まで API を呼ぶ。
+バッチごとに短いトランザクションで書くので、途中で止めても次に実行すれば続きから埋める。
+採点はコンテストで有効なバージョンしか読まないので、埋めている間も今のバージョンで採点が続く。
+全問そろったら --activate で切り替える (共有ストアも新しいバージョンで作り直す)。
+切り替えた後の提出回答は新しいバージョンで採点されるので、それまでの回答は `rescore.py --reembed` で採点し直す。
+
+    python backfill_embeddings.py <contest_id> | --all --model text-embedding-3-large --prompt-version v1 [--activate]
+"""
+
+import argparse
+import asyncio
+import random
+
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from database import DatabaseSessionManager, get_database_url
+from embedding_api_client import PROMPT_TEMPLATES, OpenAIClient
+from logger_config import logger
+from model import DEFAULT_EMBEDDING_MODEL, AnswerEmbedding, Contest, Question, QuestionEmbedding
+from validate import request_dimensions, stored_embedding_columns
+from vector_store import build_contest_vector_store
+
+
+async def find_missing_questions(session, contest_id: int, model: str, prompt_version: str) -> list:
+    """指定したバージョンの埋め込みがまだ無い問題 (id, query, 正解)"""
+    result = await session.execute(
+        select(Question.id, Question.query, AnswerEmbedding.answer)
+        .join(AnswerEmbedding, AnswerEmbedding.question_id == Question.id)
+        .outerjoin(
+            QuestionEmbedding,
+            (QuestionEmbedding.question_id == Question.id)
+            & (QuestionEmbedding.model == model)
+            & (QuestionEmbedding.prompt_version == prompt_version),
+        )
+        .where((Question.contest_id == contest_id) & QuestionEmbedding.id.is_(None))
+        .order_by(Question.id)
+    )
+    return result.all()
+
+
+async def _embed_batch(client: OpenAIClient, batch: list, dimensions, prompt_version: str, retries: int) -> list:
+    for attempt in range(retries + 1):
+        try:
+            return await asyncio.to_thread(
+                client.get_embeddings, [(row.query, row.answer) for row in batch], None, dimensions, prompt_version
+            )
+        except Exception as e:
+            if attempt == retries:
+                raise
+            logger.warning(f"backfill batch failed ({e!r}), retrying")
+            await asyncio.sleep(random.uniform(0, 2**attempt))
+
+
+async def backfill_contest(
+    dbsm: DatabaseSessionManager,
+    contest_id: int,
+    model: str,
+    prompt_version: str,
+    batch_size: int = 256,
+    parallelism: int = 4,
+    retries: int = 3,
+) -> tuple[int, int]:
+    """埋めた問題数と、失敗して残った問題数を返す"""
+    async with dbsm.session() as session:
+        contest = await session.get(Contest, contest_id)
+        if contest is None:
+            raise SystemExit(f"Contest {contest_id} not found")
+        missing = await find_missing_questions(session, contest_id, model, prompt_version)
+    if not missing:
+        return 0, 0
+
+    client = OpenAIClient(model)
+    dimensions = request_dimensions(contest)
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def run(batch) -> int:
+        async with semaphore:
+            try:
+                vectors = await _embed_batch(client, batch, dimensions, prompt_version, retries)
+            except Exception as e:
+                # 次の実行で埋め直す
+                logger.error(f"Giving up on {len(batch)} questions of contest {contest_id}: {e!r}")
+                return 0
+            async with dbsm.session() as session:
+                await session.execute(
+                    insert(QuestionEmbedding)
+                    .values(
+                        [
+                            {
+                                "question_id": row.id,
+                                "model": model,
+                                "prompt_version": prompt_version,
+                                **stored_embedding_columns(contest, vector, column="embedding"),
+                            }
+                            for row, vector in zip(batch, vectors)
+                        ]
+                    )
+                    .on_conflict_do_nothing(constraint="uq_question_embedding_version")
+                )
+                await session.commit()
+            return len(batch)
+
+    batches = [missing[start : start + batch_size] for start in range(0, len(missing), batch_size)]
+    done = sum(await asyncio.gather(*(run(batch) for batch in batches)))
+    return done, len(missing) - done
+
+
+async def activate(dbsm: DatabaseSessionManager, contest_id: int, model: str, prompt_version: str) -> bool:
+    async with dbsm.session() as session:
+        if await find_missing_questions(session, contest_id, model, prompt_version):
+            return False
+        await session.execute(
+            update(Contest)
+            .where(Contest.id == contest_id)
+            .values(embedding_model=model, embedding_prompt_version=prompt_version)
+        )
+        await session.commit()
+        await build_contest_vector_store(session, contest_id)
+    return True
+
+
+async def _run(args):
+    dbsm = DatabaseSessionManager(get_database_url())
+    try:
+        if args.all:
+            async with dbsm.session() as session:
+                result = await session.execute(select(Contest.id).order_by(Contest.id))
+                contest_ids = result.scalars().all()
+        else:
+            contest_ids = [args.contest_id]
+        for contest_id in contest_ids:
+            done, failed = await backfill_contest(
+                dbsm, contest_id, args.model, args.prompt_version, args.batch_size, args.parallelism
+            )
+            print(f"contest {contest_id}: embedded {done} questions, {failed} left")
+            if args.activate:
+                if await activate(dbsm, contest_id, args.model, args.prompt_version):
+                    print(f"contest {contest_id}: now scoring with {args.model}@{args.prompt_version}")
+                else:
+                    print(f"contest {contest_id}: not activated, some questions are still missing embeddings")
+    finally:
+        await dbsm.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("contest_id", type=int, nargs="?")
+    parser.add_argument("--all", action="store_true", help="全コンテストを埋める")
+    parser.add_argument("--model", default=DEFAULT_EMBEDDING_MODEL)
+    parser.add_argument("--prompt-version", required=True, choices=sorted(PROMPT_TEMPLATES))
+    parser.add_argument("--batch-size", type=int, default=256, help="埋め込み API 1 リクエストあたりの問題数")
+    parser.add_argument("--parallelism", type=int, default=4, help="同時に送る埋め込みリクエスト数")
+    parser.add_argument("--activate", action="store_true", help="全問そろったコンテストをこのバージョンで採点する")
+    args = parser.parse_args()
+    if args.contest_id is None and not args.all:
+        parser.error("contest_id or --all is required")
+    asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    main()
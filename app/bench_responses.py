@@ -0,0 +1,156 @@
+"""よく呼ばれる API のレスポンスを JSON にするまでの CPU 時間を比べるマイクロベンチマーク (DB は使わない)
+
+    fastapi    response_model で検証し直して JSONResponse (標準の json) で書き出す (以前の経路)
+    orjson     response_model で検証し直して ORJSONResponse で書き出す (モデル以外を返すエンドポイントの経路)
+    model      ModelResponse で検証せずに pydantic-core で書き出す (今の経路)
+
+    python bench_responses.py [--iterations 20000]
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime
+from typing import List, Union
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from payload import (
+    ContestOut,
+    DataSourcePayload,
+    QuestionOut,
+    ScoringTicketOut,
+    UserAnswerOut,
+    UserStatsOut,
+    question_list_adapter,
+)
+from responses import ModelResponse
+
+
+def sample_responses() -> dict:
+    """(response_model, エンドポイントが返すもの, ModelResponse に渡す adapter)"""
+    question = QuestionOut(
+        id=1,
+        query="2023 年度の営業利益は前年から何パーセント増えましたか?",
+        options=["3%", "5%", "8%", "12%"],
+        description=None,
+    )
+    return {
+        "get_contest": (
+            ContestOut,
+            ContestOut(
+                id=1,
+                name="RAG Contest 2024",
+                questions=list(range(1, 51)),
+                description="社内文書を使った RAG の精度を競う",
+                start_at=datetime(2024, 4, 1, 10),
+                end_at=datetime(2024, 4, 1, 18),
+                data_sources=[
+                    DataSourcePayload(
+                        path=f"reports/annual_report_{year}.pdf",
+                        type="PDF",
+                        description=None,
+                        id=year,
+                        url=f"/api/data_sources/{year}/file",
+                        sha256="0" * 64,
+                        size=12_345_678,
+                    )
+                    for year in range(2020, 2024)
+                ],
+            ),
+            None,
+        ),
+        "get_question": (QuestionOut, question, None),
+        "get_questions": (
+            List[QuestionOut],
+            [question.model_copy(update={"id": n}) for n in range(1, 51)],
+            question_list_adapter,
+        ),
+        "submit_answer": (
+            Union[UserAnswerOut, ScoringTicketOut],
+            UserAnswerOut(
+                question_id=1,
+                answer="前年比 8% 増",
+                is_correct=True,
+                similarity=0.9731,
+                time_taken_ms=123_456,
+                not_answered_question_ids=list(range(2, 41)),
+            ),
+            None,
+        ),
+        "get_user_stats": (
+            UserStatsOut,
+            UserStatsOut(
+                user_id=1,
+                user_name="alice",
+                contests=[
+                    {
+                        "contest_id": n,
+                        "contest_name": f"RAG Contest {n}",
+                        "status": "Done",
+                        "number_of_questions": 50,
+                        "answered": 50,
+                        "remaining": 0,
+                        "pending": 0,
+                        "correct": 42,
+                        "total_time_ms": 3_600_000,
+                        "rank": 7,
+                        "participants": 120,
+                    }
+                    for n in range(1, 11)
+                ],
+            ),
+            None,
+        ),
+    }
+
+
+def _fastapi_path(field, content, response_class) -> bytes:
+    # FastAPI が response_model のあるエンドポイントの戻り値に行う処理
+    # (serialize_response は中で await しないので、イベントループを介さずに進める)
+    coroutine = serialize_response(field=field, response_content=content)
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return response_class(stop.value).body
+    raise RuntimeError("serialize_response suspended")
+
+
+def _measure(run, iterations: int) -> float:
+    """1 回あたりの CPU 時間 (マイクロ秒)"""
+    for _ in range(min(iterations // 10, 1000)):
+        run()
+    started = time.process_time()
+    for _ in range(iterations):
+        run()
+    return (time.process_time() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'route':<16} {'fastapi':>10} {'orjson':>10} {'model':>10} {'saved':>10}  (CPU us per response)")
+    for name, (response_model, content, adapter) in sample_responses().items():
+        field = create_response_field(name="Response", type_=response_model, mode="serialization")
+        fastapi_body = _fastapi_path(field, content, JSONResponse)
+        model_body = ModelResponse(content, adapter=adapter).body
+        # 書き出し方の違い (空白など) を除いて同じ内容になること
+        assert json.loads(fastapi_body) == json.loads(model_body), name
+
+        timings = [
+            _measure(lambda: _fastapi_path(field, content, JSONResponse), args.iterations),
+            _measure(lambda: _fastapi_path(field, content, ORJSONResponse), args.iterations),
+            _measure(lambda: ModelResponse(content, adapter=adapter).body, args.iterations),
+        ]
+        print(
+            f"{name:<16} {timings[0]:>10.1f} {timings[1]:>10.1f} {timings[2]:>10.1f}"
+            f" {timings[0] - timings[2]:>10.1f}  ({timings[0] / timings[2]:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
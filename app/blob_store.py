@@ -0,0 +1,188 @@
+"""コンテストのデータソース (PDF・Excel・音声など) のファイルを内容のハッシュで保存して配信する
+
+ファイルは BLOB_STORE_DIR/sha256/ab/cd/<sha256> に置くので、同じ内容は何度アップロードしても、
+どのコンテストから参照しても 1 つしか持たない。sha256 とサイズはアップロード時に DataSource に保存し、
+配信時は強い ETag (sha256) と Repr-Digest に使う。
+BLOB_ACCEL_REDIRECT_PREFIX を設定したときは、認証と条件付きリクエストの判定だけをアプリで行い、
+本体の送信 (sendfile・Range) は X-Accel-Redirect でリバースプロキシ (nginx) に任せる。
+設定しないときはアプリが Range に対応して配信する。
+
+    python blob_store.py gc     # どの DataSource からも参照されていないファイルを消す
+"""
+
+import asyncio
+import base64
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from typing import BinaryIO, Optional
+from urllib.parse import quote
+
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+
+from config import blob_store_settings
+from database import DatabaseSessionManager, get_database_url
+from logger_config import logger
+from model import DataSource
+
+_CHUNK_SIZE = 1024 * 1024
+# アップロード中 (DataSource にまだコミットしていない) のファイルを gc で消さないための猶予
+_GC_GRACE_SECONDS = 3600
+
+
+def blob_relative_path(sha256: str) -> str:
+    return os.path.join("sha256", sha256[:2], sha256[2:4], sha256)
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(blob_store_settings.BLOB_STORE_DIR, blob_relative_path(sha256))
+
+
+def store_blob(fileobj: BinaryIO) -> tuple[str, int]:
+    """ハッシュを計算しながら一時ファイルに書き、同じ内容が無ければ置く。(sha256, サイズ) を返す"""
+    root = blob_store_settings.BLOB_STORE_DIR
+    os.makedirs(root, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=root, prefix=".upload_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while chunk := fileobj.read(_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        sha256 = digest.hexdigest()
+        path = blob_path(sha256)
+        if os.path.exists(path):
+            os.unlink(tmp_path)
+            # gc の猶予を数え直す
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, path)
+        return sha256, size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    """単一の bytes 範囲を (開始, 終了) (終了を含む) で返す。無いか複数範囲なら None、満たせなければ ValueError"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes=") :].strip().partition("-")
+    try:
+        if start == "":
+            # 末尾の n バイト
+            length = int(end)
+            if length <= 0:
+                raise ValueError(header)
+            return max(size - length, 0), size - 1
+        first = int(start)
+        last = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if first >= size or last < first:
+        raise ValueError(header)
+    return first, min(last, size - 1)
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    return any(tag.strip() in ("*", etag) for tag in header.split(","))
+
+
+def _read_range(path: str, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def blob_response(request: Request, data_source: DataSource) -> Response:
+    sha256, size = data_source.sha256, data_source.size
+    etag = f'"{sha256}"'
+    filename = os.path.basename(data_source.path) or sha256
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        # 内容は変わりうるので毎回 ETag で確認させる (変わっていなければ 304)
+        "Cache-Control": "private, no-cache",
+        "Repr-Digest": f"sha-256=:{base64.b64encode(bytes.fromhex(sha256)).decode()}:",
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    content_type = data_source.content_type or "application/octet-stream"
+    if blob_store_settings.BLOB_ACCEL_REDIRECT_PREFIX:
+        # Range と sendfile はプロキシが処理する
+        headers["X-Accel-Redirect"] = blob_store_settings.BLOB_ACCEL_REDIRECT_PREFIX + blob_relative_path(sha256)
+        return Response(headers=headers, media_type=content_type)
+
+    try:
+        byte_range = parse_range(request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    if_range = request.headers.get("if-range")
+    if if_range and if_range.strip() != etag:
+        byte_range = None
+
+    status_code, (start, end) = 200, (0, size - 1)
+    if byte_range is not None:
+        status_code, (start, end) = 206, byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=content_type)
+    return StreamingResponse(
+        _read_range(blob_path(sha256), start, end - start + 1),
+        status_code=status_code,
+        headers=headers,
+        media_type=content_type,
+    )
+
+
+async def collect_garbage(dbsm: DatabaseSessionManager) -> int:
+    async with dbsm.session(read_only=True) as session:
+        result = await session.execute(select(DataSource.sha256).where(DataSource.sha256.is_not(None)).distinct())
+        referenced = set(result.scalars().all())
+
+    removed = 0
+    root = os.path.join(blob_store_settings.BLOB_STORE_DIR, "sha256")
+    now = time.time()
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if filename not in referenced and now - os.path.getmtime(path) > _GC_GRACE_SECONDS:
+                os.unlink(path)
+                removed += 1
+    logger.info(f"Removed {removed} unreferenced blobs")
+    return removed
+
+
+async def _run():
+    dbsm = DatabaseSessionManager(get_database_url())
+    try:
+        print(f"removed {await collect_garbage(dbsm)} blobs")
+    finally:
+        await dbsm.close()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["gc"]:
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(_run())
@@ -0,0 +1,168 @@
+"""埋め込みの次元削減・半精度化で合否が変わらないかを確認するレポート
+
+コンテストの正解と提出回答をフルの次元 (float64 で計算) で埋め込み直して基準の合否を出し、
+次元数 × 保存精度 × 計算精度 の組み合わせごとに合否がいくつ入れ替わるかを比較する。
+次元の削減は切り詰めと正規化で再現する (text-embedding-3 の dimensions 指定と同じ結果になる)。
+
+    python calibrate_embeddings.py <contest_id> --dimensions 1536 512 256 --precision float32 float16 \
+        --scoring-dtype float64 float32 --limit 2000
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+
+from database import DatabaseSessionManager, get_database_url
+from embedding_api_client import FULL_EMBEDDING_DIMENSIONS, OpenAIClient
+from logger_config import logger
+from model import Contest, Question, UserAnswer
+from validate import cosine_similarity, is_passing, reduce_embedding
+
+# pgvector の 1 ベクトルあたりのヘッダ
+_VECTOR_HEADER_BYTES = 8
+
+
+async def load_contest(contest_id: int, limit: int):
+    dbsm = DatabaseSessionManager(get_database_url())
+    try:
+        async with dbsm.session() as session:
+            result = await session.execute(select(Contest).where(Contest.id == contest_id))
+            contest = result.scalars().first()
+            if contest is None:
+                raise SystemExit(f"Contest {contest_id} not found")
+            result = await session.execute(
+                select(Question).options(joinedload(Question.right_answer)).where(Question.contest_id == contest_id)
+            )
+            questions = {question.id: question for question in result.scalars().all()}
+            result = await session.execute(
+                select(UserAnswer)
+                .where((UserAnswer.contest_id == contest_id) & UserAnswer.similarity.is_not(None))
+                .order_by(UserAnswer.id)
+                .limit(limit)
+            )
+            answers = result.scalars().all()
+            return contest, questions, answers
+    finally:
+        await dbsm.close()
+
+
+def _embed_batch(client: OpenAIClient, batch: list[tuple[str, str]], prompt_version: str, retries: int) -> list:
+    # 一時的な失敗で途中まで埋め込んだ分を捨てないよう、バッチごとに待ってから送り直す
+    for attempt in range(retries + 1):
+        try:
+            return client.get_embeddings(batch, prompt_version=prompt_version)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            logger.warning(f"calibration batch failed ({e!r}), retrying")
+            time.sleep(random.uniform(0, 2**attempt))
+
+
+def embed_all(
+    client: OpenAIClient,
+    query_answers: list[tuple[str, str]],
+    batch_size: int,
+    prompt_version: str,
+    retries: int = 3,
+) -> np.ndarray:
+    vectors = []
+    for start in range(0, len(query_answers), batch_size):
+        vectors.extend(_embed_batch(client, query_answers[start : start + batch_size], prompt_version, retries))
+    return np.asarray(vectors, dtype=np.float64).reshape(len(query_answers), -1)
+
+
+def score(right_vectors, user_vectors, dimensions: int, precision: str, scoring_dtype: str) -> np.ndarray:
+    similarities = []
+    for right_vector, user_vector in zip(right_vectors, user_vectors):
+        right_vector = reduce_embedding(right_vector, dimensions, np.dtype(precision))
+        user_vector = reduce_embedding(user_vector, dimensions, np.dtype(precision))
+        similarities.append(cosine_similarity(right_vector, user_vector, np.dtype(scoring_dtype)))
+    return np.asarray(similarities)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("contest_id", type=int)
+    parser.add_argument("--dimensions", type=int, nargs="+", default=[FULL_EMBEDDING_DIMENSIONS, 1024, 512, 256])
+    parser.add_argument("--precision", nargs="+", default=["float32", "float16"], choices=["float32", "float16"])
+    parser.add_argument(
+        "--scoring-dtype", nargs="+", default=["float64", "float32"], choices=["float64", "float32", "float16"]
+    )
+    parser.add_argument("--threshold", type=float, help="自由記述の合格しきい値 (省略時はコンテストの値)")
+    parser.add_argument("--option-threshold", type=float, help="選択式の合格しきい値 (省略時はコンテストの値)")
+    parser.add_argument("--limit", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--retries", type=int, default=3, help="失敗した埋め込みリクエストを送り直す回数")
+    parser.add_argument("--timeout", type=float, default=60.0, help="埋め込みリクエスト 1 回のタイムアウト (秒)")
+    parser.add_argument("--show-flips", type=int, default=10, help="組み合わせごとに表示する入れ替わりの件数")
+    args = parser.parse_args()
+
+    contest, questions, answers = asyncio.run(load_contest(args.contest_id, args.limit))
+    if not answers:
+        raise SystemExit("No scored answers to calibrate against")
+
+    # 実際の採点と同じしきい値で比べる
+    threshold = contest.similarity_threshold if args.threshold is None else args.threshold
+    option_threshold = contest.option_threshold if args.option_threshold is None else args.option_threshold
+
+    # リトライは _embed_batch で行う
+    client = OpenAIClient(contest.embedding_model, timeout=args.timeout, max_retries=0)
+    question_ids = sorted(questions)
+    right_matrix = embed_all(
+        client, [(questions[qid].query, questions[qid].right_answer.answer) for qid in question_ids],
+        args.batch_size,
+        contest.embedding_prompt_version,
+        args.retries,
+    )
+    row_of_question = {qid: row for row, qid in enumerate(question_ids)}
+    user_matrix = embed_all(
+        client, [(questions[answer.question_id].query, answer.answer) for answer in answers],
+        args.batch_size,
+        contest.embedding_prompt_version,
+        args.retries,
+    )
+    right_vectors = right_matrix[[row_of_question[answer.question_id] for answer in answers]]
+    has_options = [questions[answer.question_id].number_of_options > 0 for answer in answers]
+
+    baseline = score(right_vectors, user_matrix, FULL_EMBEDDING_DIMENSIONS, "float64", "float64")
+    baseline_pass = np.array([is_passing(s, o, threshold, option_threshold) for s, o in zip(baseline, has_options)])
+    stored_pass = np.array([bool(answer.is_correct) for answer in answers])
+
+    print(f"contest: {contest.id} {contest.name}")
+    print(f"  current config: {contest.embedding_dimensions} dims / {contest.embedding_precision}")
+    print(f"  answers: {len(answers)}  questions: {len(questions)}")
+    print(f"  thresholds: free text {threshold} / options {option_threshold}")
+    print(f"  full-precision pass rate: {baseline_pass.mean():.4f}")
+    print(f"  agreement of stored decisions with full precision: {(stored_pass == baseline_pass).mean():.4f}")
+    print()
+    print(
+        f"{'dims':>5} {'storage':>8} {'scoring':>8} {'bytes':>6} {'agree':>7} "
+        f"{'pass->fail':>10} {'fail->pass':>10} {'max|d|':>9} {'mean|d|':>9}"
+    )
+    for dimensions, precision, scoring_dtype in itertools.product(
+        args.dimensions, args.precision, args.scoring_dtype
+    ):
+        similarities = score(right_vectors, user_matrix, dimensions, precision, scoring_dtype)
+        passes = np.array([is_passing(s, o, threshold, option_threshold) for s, o in zip(similarities, has_options)])
+        delta = np.abs(similarities - baseline)
+        bytes_per_vector = dimensions * np.dtype(precision).itemsize + _VECTOR_HEADER_BYTES
+        print(
+            f"{dimensions:>5} {precision:>8} {scoring_dtype:>8} {bytes_per_vector:>6} "
+            f"{(passes == baseline_pass).mean():>7.4f} {int((baseline_pass & ~passes).sum()):>10} "
+            f"{int((~baseline_pass & passes).sum()):>10} {delta.max():>9.5f} {delta.mean():>9.5f}"
+        )
+        for i in np.flatnonzero(passes != baseline_pass)[: args.show_flips]:
+            print(
+                f"      flip: answer {answers[i].id} question {answers[i].question_id} "
+                f"full={baseline[i]:.5f} compact={similarities[i]:.5f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -7,4 +7,145 @@ class JWTSettings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
 
 
+class ReplicaSettings(BaseSettings):
+    # リードレプリカ (POSTGRES_REPLICA_HOSTS) に接続できるまで待つ秒数
+    REPLICA_CONNECT_TIMEOUT_SECONDS: float = 2.0
+    # 接続できなかったレプリカを選ばない秒数 (その間は他のレプリカか primary で読む)
+    REPLICA_RETRY_SECONDS: float = 30.0
+
+
+class RateLimitSettings(BaseSettings):
+    RATE_LIMIT_ENABLED: bool = True
+    # 共有メモリの置き場所 (全 gunicorn worker から見える tmpfs)
+    RATE_LIMIT_DIR: str = "/dev/shm"
+    RATE_LIMIT_SLOTS: int = 16384
+    # 回答提出: API キーごと
+    SUBMIT_RATE_PER_SEC: float = 1.0
+    SUBMIT_BURST: int = 10
+    # signup / login: IP ごと
+    AUTH_RATE_PER_SEC: float = 0.2
+    AUTH_BURST: int = 5
+
+
+class IdempotencySettings(BaseSettings):
+    # 処理中の重複リクエストが元のリクエストの完了を待つ最大秒数
+    IDEMPOTENCY_WAIT_SECONDS: float = 60.0
+    # これより古い処理中レコードは worker が落ちたものとみなして引き継ぐ (gunicorn の timeout より長く)
+    IDEMPOTENCY_LEASE_SECONDS: int = 150
+    IDEMPOTENCY_TTL_HOURS: int = 24
+
+
+class ScoringSettings(BaseSettings):
+    # "sync": リクエスト内で採点する / "deferred": 受け付けだけして後で採点する
+    # (sync でも `Prefer: respond-async` ヘッダを付けたリクエストは deferred になる)
+    SCORING_MODE: str = "sync"
+    # 各 gunicorn worker で採点プールを動かすか (False なら `python scoring.py` を別プロセスで動かす)
+    SCORING_POOL_IN_APP: bool = True
+    SCORING_CONCURRENCY: int = 4
+    # 取りこぼした採点待ち (worker の再起動など) を拾い直す間隔
+    SCORING_SWEEP_INTERVAL_SECONDS: float = 5.0
+    # コサイン類似度を計算する精度 ("float64" / "float32" / "float16")
+    # 変更する前に calibrate_embeddings.py で合否が変わらないことを確認すること
+    SCORING_DTYPE: str = "float64"
+
+
+class EmbeddingSettings(BaseSettings):
+    # 1 回の呼び出しのタイムアウトと、リトライを含めた全体の締め切り
+    EMBEDDING_TIMEOUT_SECONDS: float = 5.0
+    EMBEDDING_DEADLINE_SECONDS: float = 15.0
+    EMBEDDING_MAX_RETRIES: int = 2
+    EMBEDDING_BACKOFF_BASE_SECONDS: float = 0.2
+    EMBEDDING_BACKOFF_MAX_SECONDS: float = 2.0
+    # 応答がこの秒数を超えたら同じリクエストをもう 1 本投げる (0 で無効)
+    EMBEDDING_HEDGE_DELAY_SECONDS: float = 0.0
+    # 直近 WINDOW 秒の失敗率が RATIO を超えたら OPEN_SECONDS の間は即座に失敗させる
+    BREAKER_FAILURE_RATIO: float = 0.5
+    BREAKER_MIN_CALLS: int = 10
+    BREAKER_WINDOW_SECONDS: float = 30.0
+    BREAKER_OPEN_SECONDS: float = 15.0
+    # 埋め込みが使えないときは 503 ではなく非同期採点で受け付ける
+    EMBEDDING_FALLBACK_TO_DEFERRED: bool = True
+    # worker あたりで同時に API を呼ぶスレッド数 (ヘッジの分も含む)。0 なら同時に来うる呼び出し数から決める
+    EMBEDDING_MAX_CONCURRENCY: int = 0
+
+
+class VectorStoreSettings(BaseSettings):
+    # 全 worker からマップする正解ベクトルのファイルの置き場所 (tmpfs 推奨)
+    VECTOR_STORE_DIR: str = "/dev/shm/rag_contest_vectors"
+
+
+class DuplicateSettings(BaseSettings):
+    # これ以上似ている別ユーザーの回答を重複候補として記録する
+    DUPLICATE_SIMILARITY: float = 0.98
+    # 1 回答あたりに記録する候補の上限
+    DUPLICATE_TOP_K: int = 20
+    # 類似度行列のブロックあたりの要素数 (float32 で 64MB)
+    DUPLICATE_BLOCK_ELEMENTS: int = 16_000_000
+    # 回答の INSERT からコミットまでにかかりうる時間。これより新しい回答は次の検査でも比べ直す
+    DUPLICATE_COMMIT_MARGIN_SECONDS: float = 30.0
+    # 定期メンテナンスで開催中のコンテストを検査するか
+    DUPLICATE_SCAN_IN_MAINTENANCE: bool = True
+
+
+class AnalyticsSettings(BaseSettings):
+    # 主催者向けの問題ごとの集計を、前回からこの秒数が経つまではキャッシュのまま返す
+    ANALYTICS_REFRESH_SECONDS: float = 10.0
+    # 採点し直し (rescore.py) などを反映するため、この間隔で最初から集計し直す
+    ANALYTICS_FULL_REFRESH_SECONDS: float = 600.0
+    # 回答の INSERT からコミットまでにかかりうる時間 (と API サーバー間の時計のずれ)。
+    # これより新しい回答は、id の小さい回答がまだコミットされていないことがあるので次の集計に回す
+    ANALYTICS_COMMIT_MARGIN_SECONDS: float = 30.0
+    ANALYTICS_BINS: int = 20
+
+
+class BlobStoreSettings(BaseSettings):
+    # データソースのファイルの置き場所 (全 worker から見える永続ボリューム)
+    BLOB_STORE_DIR: str = "/data/blobs"
+    # nginx の internal location (例 "/_blobs/") を設定すると、ファイル本体の送信を X-Accel-Redirect で任せる
+    BLOB_ACCEL_REDIRECT_PREFIX: str = ""
+
+
+class TracingSettings(BaseSettings):
+    # Server-Timing ヘッダーと遅いリクエストのログ
+    TRACE_ENABLED: bool = True
+    TRACE_SLOW_REQUEST_MS: float = 1000.0
+    # x-profile ヘッダーが無くてもプロファイルを採るリクエストの割合
+    TRACE_PROFILE_SAMPLE_RATE: float = 0.0
+    TRACE_PROFILE_INTERVAL_MS: float = 5.0
+
+
+class MaintenanceSettings(BaseSettings):
+    # 各 worker で定期メンテナンスを動かすか (実際に動くのはアドバイザリロックを取った 1 つだけ)
+    MAINTENANCE_IN_APP: bool = True
+    MAINTENANCE_INTERVAL_SECONDS: float = 300.0
+    # 1 回の DELETE で消す行数 (ロックと WAL を小さく保つ)
+    MAINTENANCE_BATCH_SIZE: int = 1000
+    # メール認証の期限。これを過ぎた仮登録は消す
+    TEMPORARY_USER_TTL_HOURS: int = 1
+    # Done になってこの日数を過ぎたコンテストの問題の初回ダウンロード記録を消す
+    FIRST_DOWNLOAD_RETENTION_DAYS: int = 30
+    # 前回の ANALYZE からの変更行数がこれ以上、かつ行数のこの割合以上のテーブルを ANALYZE する
+    MAINTENANCE_ANALYZE_MIN_ROWS: int = 1000
+    MAINTENANCE_ANALYZE_FRACTION: float = 0.05
+
+
+class ProvisioningSettings(BaseSettings):
+    # 一括登録 1 回あたりの最大人数
+    PROVISIONING_MAX_USERS: int = 5000
+    # パスワードのハッシュ化に使うプロセス数 (0 なら CPU 数)
+    PROVISIONING_HASH_WORKERS: int = 0
+
+
 jwt_settings = JWTSettings()
+replica_settings = ReplicaSettings()
+rate_limit_settings = RateLimitSettings()
+idempotency_settings = IdempotencySettings()
+scoring_settings = ScoringSettings()
+embedding_settings = EmbeddingSettings()
+vector_store_settings = VectorStoreSettings()
+duplicate_settings = DuplicateSettings()
+analytics_settings = AnalyticsSettings()
+blob_store_settings = BlobStoreSettings()
+tracing_settings = TracingSettings()
+maintenance_settings = MaintenanceSettings()
+provisioning_settings = ProvisioningSettings()
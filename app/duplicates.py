@@ -0,0 +1,312 @@
+"""別のユーザーのほぼ同じ自由記述の回答 (コピーの疑い) を見つける
+
+UserAnswer に保存した提出回答の埋め込みを問題ごとに読み込み、前回の検査以降の回答だけを
+その問題の全回答とブロック単位の行列積で比べて、しきい値以上の上位 k 件を組として記録する。
+問題ごとの検査済みの位置は duplicate_scan_state に持つので、何度実行しても新しい回答の分しか計算しない。
+id はコミットの順とは前後するので、検査済みの位置は DUPLICATE_COMMIT_MARGIN_SECONDS より前に提出された回答までにし、
+それより新しい回答は次の検査でもう一度比べる (記録済みの組は重ねて記録しない)。
+定期メンテナンス (maintenance.py) が開催中のコンテストを検査する。
+レポートは記録した組を union-find でまとめたクラスタで返す。選択式の問題と、埋め込みを保存していない回答
+(保存を始める前の回答は `rescore.py` で埋まる) は対象外。
+
+    python duplicates.py scan <contest_id> [--threshold 0.98]
+    python duplicates.py scan --live
+    python duplicates.py report <contest_id> [--min-similarity 0.99]
+"""
+
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import duplicate_settings
+from database import DatabaseSessionManager, get_database_url
+from logger_config import logger
+from model import (
+    DEFAULT_EMBEDDING_MODEL,
+    DEFAULT_PROMPT_VERSION,
+    Contest,
+    ContestStatus,
+    DuplicateAnswerPair,
+    DuplicateScanState,
+    Question,
+    UserAnswer,
+    embedding_version,
+)
+
+
+def find_similar_pairs(
+    new_ids: np.ndarray,
+    new_users: np.ndarray,
+    new_matrix: np.ndarray,
+    ids: np.ndarray,
+    users: np.ndarray,
+    matrix: np.ndarray,
+    threshold: float,
+    top_k: int = duplicate_settings.DUPLICATE_TOP_K,
+    block_elements: int = duplicate_settings.DUPLICATE_BLOCK_ELEMENTS,
+) -> dict[tuple[int, int], float]:
+    """新しい回答ごとに、別ユーザーの回答のうち threshold 以上の上位 top_k 件を返す (行は正規化済み)"""
+    pairs = {}
+    if len(new_ids) == 0 or len(ids) == 0:
+        return pairs
+    rows_per_block = max(1, block_elements // len(ids))
+    k = min(top_k, len(ids))
+    for start in range(0, len(new_ids), rows_per_block):
+        end = start + rows_per_block
+        similarities = new_matrix[start:end] @ matrix.T
+        # 同じユーザーの回答 (自分自身を含む) は比べない
+        similarities[new_users[start:end, None] == users[None, :]] = -np.inf
+        if k < len(ids):
+            top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(len(ids)), similarities.shape)
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        for row, col in zip(*np.nonzero(top_similarities >= threshold)):
+            answer_id, other_answer_id = int(new_ids[start + row]), int(ids[top[row, col]])
+            key = (min(answer_id, other_answer_id), max(answer_id, other_answer_id))
+            pairs[key] = float(top_similarities[row, col])
+    return pairs
+
+
+def cluster_pairs(pairs) -> list[set[int]]:
+    """(answer_id, other_answer_id) の組を連結成分にまとめる"""
+    parent = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in pairs:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    clusters = {}
+    for x in parent:
+        clusters.setdefault(find(x), set()).add(x)
+    return list(clusters.values())
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+async def scan_question(
+    session: AsyncSession, contest_id: int, question_id: int, version: str, threshold: float
+) -> int:
+    """前回以降の回答を検査して、新しく見つかった組の数を返す (version は比べる埋め込みのバージョン)"""
+    state = await session.get(DuplicateScanState, question_id)
+    # しきい値を下げたときは、前回記録しなかった組があるので最初から検査し直す
+    watermark = state.last_answer_id if state is not None and state.threshold <= threshold else 0
+
+    result = await session.execute(
+        select(
+            UserAnswer.id,
+            UserAnswer.user_id,
+            UserAnswer.similarity,
+            UserAnswer.submitted_at,
+            UserAnswer.embedding,
+            UserAnswer.embedding_half,
+            UserAnswer.embedding_version,
+        )
+        .where((UserAnswer.contest_id == contest_id) & (UserAnswer.question_id == question_id))
+        .order_by(UserAnswer.id)
+    )
+    rows = result.all()
+    # 有効なバージョンで埋め込んだ回答どうしだけを比べる (NULL は既定のバージョン)
+    default_version = embedding_version(DEFAULT_EMBEDDING_MODEL, DEFAULT_PROMPT_VERSION)
+    embedded = [
+        row
+        for row in rows
+        if (row.embedding is not None or row.embedding_half is not None)
+        and (row.embedding_version or default_version) == version
+    ]
+    # 採点待ちの回答は埋め込みが後から入るので、その手前までしか検査済みにしない
+    pending = [row.id for row in rows if row.similarity is None]
+    new_watermark = max([row.id for row in embedded], default=watermark)
+    if pending:
+        new_watermark = min(new_watermark, min(pending) - 1)
+    # 最近の回答より小さい id の回答がまだコミットされていないことがあるので、次回も検査し直す
+    horizon = datetime.now() - timedelta(seconds=duplicate_settings.DUPLICATE_COMMIT_MARGIN_SECONDS)
+    new_watermark = min(new_watermark, max([row.id for row in rows if row.submitted_at < horizon], default=0))
+
+    found = 0
+    if any(row.id > watermark for row in embedded):
+        ids = np.array([row.id for row in embedded], dtype=np.int64)
+        users = np.array([row.user_id for row in embedded], dtype=np.int64)
+        matrix = _normalize(
+            np.asarray(
+                [
+                    row.embedding_half.to_numpy() if row.embedding_half is not None else row.embedding
+                    for row in embedded
+                ],
+                dtype=np.float32,
+            )
+        )
+        new = ids > watermark
+        pairs = await asyncio.to_thread(
+            find_similar_pairs, ids[new], users[new], matrix[new], ids, users, matrix, threshold
+        )
+        if pairs:
+            result = await session.execute(
+                insert(DuplicateAnswerPair)
+                .values(
+                    [
+                        {
+                            "contest_id": contest_id,
+                            "question_id": question_id,
+                            "answer_id": answer_id,
+                            "other_answer_id": other_answer_id,
+                            "similarity": similarity,
+                        }
+                        for (answer_id, other_answer_id), similarity in pairs.items()
+                    ]
+                )
+                .on_conflict_do_nothing(constraint="uq_duplicate_answer_pair")
+            )
+            found = result.rowcount
+
+    await session.execute(
+        insert(DuplicateScanState)
+        .values(question_id=question_id, contest_id=contest_id, last_answer_id=new_watermark, threshold=threshold)
+        .on_conflict_do_update(
+            index_elements=[DuplicateScanState.question_id],
+            set_={"last_answer_id": new_watermark, "threshold": threshold, "scanned_at": func.now()},
+        )
+    )
+    await session.commit()
+    return found
+
+
+async def scan_contest(session: AsyncSession, contest_id: int, threshold: Optional[float] = None) -> int:
+    threshold = threshold or duplicate_settings.DUPLICATE_SIMILARITY
+    contest = await session.get(Contest, contest_id)
+    # 問題ごとにコミットするので先に取り出しておく
+    version = contest.embedding_version
+    # 前回の検査より後の回答がある問題だけ (しきい値を下げたときは全部)
+    unscanned = (
+        select(UserAnswer.id)
+        .where(
+            (UserAnswer.contest_id == contest_id)
+            & (UserAnswer.question_id == Question.id)
+            & (UserAnswer.id > func.coalesce(DuplicateScanState.last_answer_id, 0))
+        )
+        .exists()
+    )
+    result = await session.execute(
+        select(Question.id)
+        .outerjoin(DuplicateScanState, DuplicateScanState.question_id == Question.id)
+        .where(
+            (Question.contest_id == contest_id)
+            & (Question.number_of_options == 0)
+            & (unscanned | (DuplicateScanState.threshold > threshold))
+        )
+    )
+    found = 0
+    for question_id in result.scalars().all():
+        found += await scan_question(session, contest_id, question_id, version, threshold)
+    logger.info(f"Duplicate scan of contest {contest_id}: {found} new pairs")
+    return found
+
+
+async def scan_live_contests(session: AsyncSession, threshold: Optional[float] = None) -> dict[int, int]:
+    """開催中の全コンテストを検査して、コンテストごとに新しく見つかった組の数を返す"""
+    result = await session.execute(select(Contest.id).where(Contest.status != ContestStatus.Done))
+    return {contest_id: await scan_contest(session, contest_id, threshold) for contest_id in result.scalars().all()}
+
+
+async def get_duplicate_clusters(
+    session: AsyncSession, contest_id: int, min_similarity: Optional[float] = None
+) -> list[dict]:
+    """記録済みの組をクラスタにまとめて、大きい順に返す"""
+    query = select(DuplicateAnswerPair).where(DuplicateAnswerPair.contest_id == contest_id)
+    if min_similarity is not None:
+        query = query.where(DuplicateAnswerPair.similarity >= min_similarity)
+    result = await session.execute(query)
+    pairs = result.scalars().all()
+    if not pairs:
+        return []
+    best = {}
+    for pair in pairs:
+        for answer_id in (pair.answer_id, pair.other_answer_id):
+            best[answer_id] = max(best.get(answer_id, 0.0), pair.similarity)
+
+    result = await session.execute(
+        select(UserAnswer.id, UserAnswer.user_id, UserAnswer.question_id, UserAnswer.answer, UserAnswer.is_correct)
+        .where((UserAnswer.contest_id == contest_id) & UserAnswer.id.in_(list(best)))
+    )
+    answers = {row.id: row for row in result.all()}
+
+    clusters = []
+    for cluster in cluster_pairs([(pair.answer_id, pair.other_answer_id) for pair in pairs]):
+        members = [answers[answer_id] for answer_id in sorted(cluster) if answer_id in answers]
+        if len(members) < 2:
+            continue
+        clusters.append(
+            {
+                "question_id": members[0].question_id,
+                "size": len(members),
+                "users": sorted({member.user_id for member in members}),
+                "max_similarity": max(best[member.id] for member in members),
+                "answers": [
+                    {
+                        "answer_id": member.id,
+                        "user_id": member.user_id,
+                        "answer": member.answer,
+                        "is_correct": member.is_correct,
+                    }
+                    for member in members
+                ],
+            }
+        )
+    clusters.sort(key=lambda cluster: (-cluster["size"], -cluster["max_similarity"]))
+    return clusters
+
+
+async def _run(args):
+    dbsm = DatabaseSessionManager(get_database_url())
+    try:
+        async with dbsm.session() as session:
+            if args.command == "scan":
+                if args.live:
+                    found = await scan_live_contests(session, args.threshold)
+                else:
+                    found = {args.contest: await scan_contest(session, args.contest, args.threshold)}
+                for contest_id, pairs in found.items():
+                    print(f"contest {contest_id}: {pairs} new pairs")
+            else:
+                for cluster in await get_duplicate_clusters(session, args.contest, args.min_similarity):
+                    print(
+                        f"question {cluster['question_id']}: {cluster['size']} answers from "
+                        f"{len(cluster['users'])} users (max similarity {cluster['max_similarity']:.4f})"
+                    )
+                    for answer in cluster["answers"]:
+                        print(f"    answer {answer['answer_id']} user {answer['user_id']}: {answer['answer'][:80]!r}")
+    finally:
+        await dbsm.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["scan", "report"])
+    parser.add_argument("contest", nargs="?", type=int)
+    parser.add_argument("--live", action="store_true", help="開催中の全コンテストを検査する (scan)")
+    parser.add_argument("--threshold", type=float, help="記録するしきい値 (既定は DUPLICATE_SIMILARITY)")
+    parser.add_argument("--min-similarity", type=float, help="レポートに含める最低の類似度")
+    args = parser.parse_args()
+    if args.contest is None and not (args.command == "scan" and args.live):
+        parser.error("contest id is required")
+    asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    main()
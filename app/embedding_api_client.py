@@ -1,16 +1,331 @@
 import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Optional
 
-import openai
+from config import embedding_settings
+from logger_config import logger
+from model import DEFAULT_EMBEDDING_MODEL, DEFAULT_PROMPT_VERSION
+
+
+# text-embedding-3-small の次元数。これより小さい次元は API の dimensions で指定する
+FULL_EMBEDDING_DIMENSIONS = 1536
+
+# 埋め込む文章のテンプレート。変えるときは既存のものを書き換えずに新しいバージョンを足し、
+# backfill_embeddings.py で正解を埋め込み直してからコンテストで有効にする
+PROMPT_TEMPLATES = {
+    "v1": "task: 年齢を表す数字を正しく識別せよ\nquery: {query}\nanswer: {answer}",
+}
+
+
+class EmbeddingUnavailableError(Exception):
+    """締め切りまでに埋め込みを取得できなかった"""
+
+
+class CircuitOpenError(EmbeddingUnavailableError):
+    """サーキットブレーカーが開いているので呼び出さなかった"""
+
+
+class PoolSaturatedError(EmbeddingUnavailableError):
+    """呼び出し用のスレッドが空かないまま締め切りを過ぎた (API には届いていない)"""
+
+
+class DeadlineExceededError(EmbeddingUnavailableError):
+    """全体の締め切りで短くなった呼び出しが間に合わなかった (API の遅さとは言えない)"""
 
 
 class OpenAIClient:
-    def __init__(self, model: str = "text-embedding-3-small"):
+    def __init__(
+        self,
+        model: str = DEFAULT_EMBEDDING_MODEL,
+        timeout: Optional[float] = None,
+        max_retries: Optional[int] = None,
+    ):
+        # openai は import が重いので、最初に埋め込みを作るときに読み込む
+        import openai
+
         api_key = os.getenv("OPENAI_API_KEY")
-        self.client = openai.OpenAI(api_key=api_key)
+        # 指定しなければ SDK の既定のリトライとタイムアウトのまま (OPENAI_BASE_URL でスタブサーバーに向けられる)
+        options = {}
+        if timeout is not None:
+            options["timeout"] = timeout
+        if max_retries is not None:
+            options["max_retries"] = max_retries
+        self.client = openai.OpenAI(api_key=api_key, **options)
         self.EMBEDDING_MODEL = model
 
-    def get_embedding(self, query: str, answer: str) -> list:
-        task = "年齢を表す数字を正しく識別せよ"
-        text = f"task: {task}\nquery: {query}\nanswer: {answer}"
-        res = self.client.embeddings.create(input=[text], model=self.EMBEDDING_MODEL)
-        return res.data[0].embedding
+    def get_embedding(
+        self,
+        query: str,
+        answer: str,
+        timeout: Optional[float] = None,
+        dimensions: Optional[int] = None,
+        prompt_version: str = DEFAULT_PROMPT_VERSION,
+    ) -> list:
+        return self.get_embeddings([(query, answer)], timeout, dimensions, prompt_version)[0]
+
+    def get_embeddings(
+        self,
+        query_answers: list[tuple[str, str]],
+        timeout: Optional[float] = None,
+        dimensions: Optional[int] = None,
+        prompt_version: str = DEFAULT_PROMPT_VERSION,
+    ) -> list[list]:
+        """複数の (query, answer) をまとめて 1 リクエストで埋め込む"""
+        import openai
+
+        template = PROMPT_TEMPLATES[prompt_version]
+        texts = [template.format(query=query, answer=answer) for query, answer in query_answers]
+        res = self.client.embeddings.create(
+            input=texts,
+            model=self.EMBEDDING_MODEL,
+            # None を渡すとタイムアウトが無くなるので、省略時はクライアントの設定を使う
+            timeout=timeout if timeout is not None else openai.NOT_GIVEN,
+            # text-embedding-3 は次元を落とした埋め込みを返せる
+            dimensions=dimensions if dimensions else openai.NOT_GIVEN,
+        )
+        return [data.embedding for data in sorted(res.data, key=lambda data: data.index)]
+
+
+class CircuitBreaker:
+    """直近の失敗率でブレーカーを開閉する (closed -> open -> half_open -> closed/open)"""
+
+    def __init__(self, failure_ratio: float, min_calls: int, window_seconds: float, open_seconds: float):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.counters = Counter()
+        self._outcomes = deque()
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state: str):
+        logger.warning(f"embedding circuit breaker: {self.state} -> {state}")
+        self.counters[f"{self.state}->{state}"] += 1
+        self.state = state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.open_seconds:
+                self._transition("half_open")
+                self._probing = False
+            if self.state == "closed":
+                return True
+            # half_open では 1 本だけ様子見の呼び出しを通す
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            self.counters["rejected"] += 1
+            return False
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        with self._lock:
+            self.counters["success" if ok else "failure"] += 1
+            if self.state == "half_open":
+                self._probing = False
+                if ok:
+                    self._outcomes.clear()
+                    self._transition("closed")
+                else:
+                    self._opened_at = now
+                    self._transition("open")
+                return
+
+            self._outcomes.append((now, ok))
+            while self._outcomes and now - self._outcomes[0][0] > self.window_seconds:
+                self._outcomes.popleft()
+            failures = sum(1 for _, outcome in self._outcomes if not outcome)
+            if (
+                self.state == "closed"
+                and len(self._outcomes) >= self.min_calls
+                and failures / len(self._outcomes) >= self.failure_ratio
+            ):
+                self._opened_at = now
+                self._transition("open")
+
+    def release(self):
+        """結果を記録せずに呼び出しを終える (half_open の様子見の枠を空ける)"""
+        with self._lock:
+            self._probing = False
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"state": self.state, "counters": dict(self.counters)}
+
+
+def _pool_size(settings) -> int:
+    if settings.EMBEDDING_MAX_CONCURRENCY > 0:
+        return settings.EMBEDDING_MAX_CONCURRENCY
+    # 呼び出しはすべて asyncio.to_thread (既定の executor) から来るので、同時に来るのはその最大スレッド数まで。
+    # ヘッジで 1 呼び出しあたり最大 2 本
+    return 2 * min(32, (os.cpu_count() or 1) + 4)
+
+
+class ResilientEmbeddingClient:
+    """埋め込み API 呼び出しに締め切り・ジッター付きリトライ・ヘッジ・サーキットブレーカーを付ける"""
+
+    def __init__(self, client: OpenAIClient, breaker: CircuitBreaker, settings=embedding_settings):
+        self._client = client
+        self._settings = settings
+        self.breaker = breaker
+        self._executor = ThreadPoolExecutor(max_workers=_pool_size(settings), thread_name_prefix="embedding")
+
+    def get_embedding(
+        self,
+        query: str,
+        answer: str,
+        dimensions: Optional[int] = None,
+        prompt_version: str = DEFAULT_PROMPT_VERSION,
+    ) -> list:
+        settings = self._settings
+        deadline = time.monotonic() + settings.EMBEDDING_DEADLINE_SECONDS
+        last_error = None
+        for attempt in range(settings.EMBEDDING_MAX_RETRIES + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.breaker.allow():
+                raise CircuitOpenError("Embedding circuit breaker is open")
+            if attempt > 0:
+                self.breaker.count("retry")
+            try:
+                embedding = self._call(query, answer, deadline, dimensions, prompt_version)
+            except (PoolSaturatedError, DeadlineExceededError):
+                # スレッドの空き待ちや前の試行で締め切りを使い切っただけなので、API の失敗としては数えない
+                self.breaker.release()
+                raise
+            except Exception as e:
+                if not self._is_retryable(e):
+                    # API には届いている (リクエスト自体の誤り) のでブレーカー上は成功扱い
+                    self.breaker.record(True)
+                    raise
+                self.breaker.record(False)
+                last_error = e
+                logger.warning(f"embedding attempt {attempt + 1} failed: {e!r}")
+                # full jitter
+                backoff_cap = settings.EMBEDDING_BACKOFF_BASE_SECONDS * 2**attempt
+                backoff = random.uniform(0, min(settings.EMBEDDING_BACKOFF_MAX_SECONDS, backoff_cap))
+                time.sleep(max(0.0, min(backoff, deadline - time.monotonic())))
+                continue
+            self.breaker.record(True)
+            return embedding
+
+        self.breaker.count("deadline_exceeded")
+        raise EmbeddingUnavailableError(f"Embedding unavailable: {last_error!r}")
+
+    def _call(
+        self,
+        query: str,
+        answer: str,
+        deadline: float,
+        dimensions: Optional[int] = None,
+        prompt_version: str = DEFAULT_PROMPT_VERSION,
+    ) -> list:
+        primary, primary_started = self._submit(query, answer, deadline, dimensions, prompt_version)
+        # プールの空き待ちの時間はタイムアウトに含めない (空かないまま締め切りを過ぎたら API の失敗とは別に扱う)
+        if not primary_started.wait(max(0.0, deadline - time.monotonic())):
+            primary.cancel()
+            self.breaker.count("pool_saturated")
+            raise PoolSaturatedError("No embedding thread became free before the deadline")
+        started = time.monotonic()
+        timeout = min(self._settings.EMBEDDING_TIMEOUT_SECONDS, deadline - started)
+        cut_by_deadline = timeout < self._settings.EMBEDDING_TIMEOUT_SECONDS
+
+        futures = {primary}
+        hedge_delay = self._settings.EMBEDDING_HEDGE_DELAY_SECONDS
+        if hedge_delay > 0 and hedge_delay < timeout:
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                self.breaker.count("hedge")
+                futures.add(self._submit(query, answer, started + timeout, dimensions, prompt_version)[0])
+
+        error = None
+        try:
+            while futures:
+                remaining = max(0.0, timeout - (time.monotonic() - started))
+                done, futures = wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+                if not done:
+                    if cut_by_deadline:
+                        self.breaker.count("deadline_cut")
+                        raise DeadlineExceededError(f"Embedding call cut to {timeout:.1f}s by the deadline")
+                    self.breaker.count("timeout")
+                    raise TimeoutError(f"Embedding call exceeded {timeout:.1f}s")
+                for future in done:
+                    if future.exception() is None:
+                        if future is not primary:
+                            self.breaker.count("hedge_won")
+                        return future.result()
+                    error = future.exception()
+            if cut_by_deadline and self._is_timeout(error):
+                self.breaker.count("deadline_cut")
+                raise DeadlineExceededError(f"Embedding call cut to {timeout:.1f}s by the deadline") from error
+            raise error
+        finally:
+            # 始まっていないヘッジは取り消す (始まったものは HTTP クライアントのタイムアウトで終わる)
+            for future in futures:
+                future.cancel()
+
+    def _submit(
+        self, query: str, answer: str, deadline: float, dimensions: Optional[int], prompt_version: str
+    ) -> tuple[Future, threading.Event]:
+        """スレッドで API を呼ぶ。タイムアウトは待たされた後、実際に呼び出すときに残り時間から決める"""
+        started = threading.Event()
+
+        def run():
+            started.set()
+            timeout = min(self._settings.EMBEDDING_TIMEOUT_SECONDS, deadline - time.monotonic())
+            if timeout <= 0:
+                raise TimeoutError("Embedding call started after its deadline")
+            return self._client.get_embedding(query, answer, timeout, dimensions, prompt_version)
+
+        return self._executor.submit(run), started
+
+    @staticmethod
+    def _is_timeout(error: Exception) -> bool:
+        import openai
+
+        return isinstance(error, (TimeoutError, openai.APITimeoutError))
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        import openai
+
+        if isinstance(error, (TimeoutError, openai.APITimeoutError, openai.APIConnectionError)):
+            return True
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code == 429 or error.status_code >= 500
+        return False
+
+
+_embedding_clients: dict[str, ResilientEmbeddingClient] = {}
+_embedding_client_pid: Optional[int] = None
+
+
+def get_embedding_client(model: str = DEFAULT_EMBEDDING_MODEL) -> ResilientEmbeddingClient:
+    # worker プロセスごと・モデルごとに 1 つ (ブレーカーの状態とコネクションを使い回す)
+    global _embedding_client_pid
+    if _embedding_client_pid != os.getpid():
+        _embedding_clients.clear()
+        _embedding_client_pid = os.getpid()
+    if model not in _embedding_clients:
+        breaker = CircuitBreaker(
+            failure_ratio=embedding_settings.BREAKER_FAILURE_RATIO,
+            min_calls=embedding_settings.BREAKER_MIN_CALLS,
+            window_seconds=embedding_settings.BREAKER_WINDOW_SECONDS,
+            open_seconds=embedding_settings.BREAKER_OPEN_SECONDS,
+        )
+        # リトライとタイムアウトは ResilientEmbeddingClient が行うので、SDK のリトライは止める
+        client = OpenAIClient(model, timeout=embedding_settings.EMBEDDING_TIMEOUT_SECONDS, max_retries=0)
+        _embedding_clients[model] = ResilientEmbeddingClient(client, breaker)
+    return _embedding_clients[model]
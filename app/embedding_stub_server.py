@@ -0,0 +1,92 @@
+"""障害を注入できる埋め込み API のスタブ (ローカル検証用)
+
+    uvicorn embedding_stub_server:app --port 9000
+    OPENAI_BASE_URL=http://localhost:9000/v1 OPENAI_API_KEY=dummy gunicorn
+
+障害の設定は環境変数 (STUB_FAILURE_RATE など) か、実行中に PUT /faults で変更する。
+    curl -X PUT localhost:9000/faults -H "Content-Type: application/json" \
+        -d '{"failure_rate": 0.5, "latency_ms": 200, "hang_rate": 0.1}'
+"""
+
+import asyncio
+import hashlib
+import os
+import random
+from typing import List, Optional, Union
+
+import numpy as np
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+class Faults(BaseModel):
+    # 500 を返す割合
+    failure_rate: float = float(os.getenv("STUB_FAILURE_RATE", "0"))
+    # 429 を返す割合
+    rate_limit_rate: float = float(os.getenv("STUB_RATE_LIMIT_RATE", "0"))
+    # 応答を返さずに止まる割合
+    hang_rate: float = float(os.getenv("STUB_HANG_RATE", "0"))
+    latency_ms: int = int(os.getenv("STUB_LATENCY_MS", "0"))
+    # 遅延のばらつき (0 〜 latency_jitter_ms を加算)
+    latency_jitter_ms: int = int(os.getenv("STUB_LATENCY_JITTER_MS", "0"))
+
+
+class EmbeddingRequest(BaseModel):
+    input: Union[str, List[str]]
+    model: str
+    dimensions: Optional[int] = None
+    encoding_format: Optional[str] = None
+
+
+app = FastAPI(title="Embedding stub")
+faults = Faults()
+stats = {"requests": 0, "failures": 0, "rate_limited": 0, "hangs": 0}
+
+
+def fake_embedding(text: str, dimensions: int) -> list:
+    # 同じ入力には同じベクトルを返す
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+@app.post("/v1/embeddings")
+async def create_embeddings(request: EmbeddingRequest):
+    stats["requests"] += 1
+    latency_ms = faults.latency_ms + random.uniform(0, faults.latency_jitter_ms)
+    if latency_ms:
+        await asyncio.sleep(latency_ms / 1000)
+    if random.random() < faults.hang_rate:
+        stats["hangs"] += 1
+        await asyncio.sleep(3600)
+    if random.random() < faults.rate_limit_rate:
+        stats["rate_limited"] += 1
+        return JSONResponse(status_code=429, content={"error": {"message": "Rate limit (stub)", "type": "rate_limit"}})
+    if random.random() < faults.failure_rate:
+        stats["failures"] += 1
+        return JSONResponse(status_code=500, content={"error": {"message": "Injected failure", "type": "server_error"}})
+
+    inputs = [request.input] if isinstance(request.input, str) else request.input
+    dimensions = request.dimensions or 1536
+    return {
+        "object": "list",
+        "model": request.model,
+        "data": [
+            {"object": "embedding", "index": i, "embedding": fake_embedding(text, dimensions)}
+            for i, text in enumerate(inputs)
+        ],
+        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+    }
+
+
+@app.get("/faults")
+async def get_faults():
+    return {"faults": faults, "stats": stats}
+
+
+@app.put("/faults")
+async def set_faults(new_faults: Faults):
+    global faults
+    faults = new_faults
+    return {"faults": faults}
@@ -1,12 +1,14 @@
 import multiprocessing
 import os
+import time
 
 name = "RagContestAPI"
 wsgi_app = "api:app"
 bind = "0.0.0.0:8000"
 debug = False
 reload = debug
-preload_app = False
+# アプリを master で 1 回だけ import し、worker には fork で共有する
+preload_app = True
 daemon = False
 
 worker_class = "uvicorn.workers.UvicornWorker"
@@ -26,3 +28,24 @@ secure_scheme_headers = {
     "X-FORWARDED-PROTO": "https",
     "X-FORWARDED-SSL": "on",
 }
+
+
+def on_starting(server):
+    # worker を fork する前にスキーマを 1 回だけ作る
+    if os.getenv("SKIP_MIGRATIONS"):
+        server.log.info("Skipping migrations")
+        return
+    import migrate
+
+    started = time.perf_counter()
+    migrate.main()
+    server.log.info(f"Migrations applied in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+def post_fork(server, worker):
+    worker.boot_started = time.perf_counter()
+
+
+def post_worker_init(worker):
+    elapsed_ms = (time.perf_counter() - worker.boot_started) * 1000
+    worker.log.info(f"Worker {worker.pid} booted in {elapsed_ms:.0f} ms")
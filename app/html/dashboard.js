@@ -42,3 +42,60 @@ async function clearBrowserCache() {
         console.log('Service Worker unregistered');
     }
 }
+
+// 参加したコンテストごとの進み具合を表示する
+async function loadStats() {
+    const container = document.getElementById('dashboard');
+    try {
+        const response = await fetch('/api/users/me/stats', { credentials: 'same-origin' });
+        if (!response.ok) {
+            throw new Error('Failed to load stats');
+        }
+        const stats = await response.json();
+        if (stats.contests.length === 0) {
+            container.textContent = 'まだ参加したコンテストはありません';
+            return;
+        }
+
+        const table = document.createElement('table');
+        const header = table.insertRow();
+        for (const title of ['Contest', 'Status', 'Answered', 'Remaining', 'Correct', 'Time', 'Rank']) {
+            const th = document.createElement('th');
+            th.textContent = title;
+            header.appendChild(th);
+        }
+        for (const contest of stats.contests) {
+            const row = table.insertRow();
+            const answered = contest.pending > 0
+                ? `${contest.answered} (${contest.pending} scoring)`
+                : `${contest.answered}`;
+            const rank = contest.rank !== null ? `${contest.rank} / ${contest.participants}` : '-';
+            const cells = [
+                contest.contest_name,
+                contest.status,
+                answered,
+                contest.remaining,
+                contest.correct,
+                formatMillisec(contest.total_time_ms),
+                rank,
+            ];
+            for (const value of cells) {
+                row.insertCell().textContent = value;
+            }
+        }
+        container.replaceChildren(table);
+    } catch (error) {
+        container.textContent = 'Error loading stats: ' + error.message;
+    }
+}
+
+// utils.format_millisec と同じ HH:MM:SS.mmm
+function formatMillisec(ms) {
+    const pad = (value, width) => String(value).padStart(width, '0');
+    const hours = Math.floor(ms / 3600000);
+    const minutes = Math.floor(ms / 60000) % 60;
+    const seconds = Math.floor(ms / 1000) % 60;
+    return `${pad(hours, 2)}:${pad(minutes, 2)}:${pad(seconds, 2)}.${pad(ms % 1000, 3)}`;
+}
+
+loadStats();
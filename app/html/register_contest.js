@@ -55,17 +55,33 @@ document.getElementById('contestForm').addEventListener('submit', function (even
 
     // Send data using Fetch API
     console.log(data);
+    // 二重送信やリトライでコンテストが重複登録されないよう、同じ入力には同じキーを使う
+    if (!idempotencyKey) {
+        idempotencyKey = crypto.randomUUID();
+    }
     fetch('/register_contest', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
+            'Idempotency-Key': idempotencyKey,
         },
         body: JSON.stringify(data),
-    }).then(response => response.json())
+    }).then(response => {
+        if (response.status === 422) {
+            // 入力が変わったので次の送信では新しいキーを使う
+            idempotencyKey = null;
+        }
+        return response.json();
+    })
         .then(data => console.log(data))
         .catch(error => console.error('Error:', error));
 });
 
+let idempotencyKey = null;
+document.getElementById('contestForm').addEventListener('input', () => {
+    idempotencyKey = null;
+});
+
 
 function generateOptions(select) {
     const numberOfOptions = parseInt(select.value, 10);
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import idempotency_settings
+from database import get_session_manager
+from logger_config import logger
+from model import IdempotencyRecord
+
+IDEMPOTENCY_HEADER_NAME = "Idempotency-Key"
+
+
+def request_fingerprint(*parts: Any) -> str:
+    payload = json.dumps(jsonable_encoder(parts), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class IdempotentRequest:
+    """Idempotency-Key 付きリクエストを 1 回だけ実行する
+
+    最初のリクエストがキーを確保して処理し、レスポンスを保存する。
+    完了済みの重複にはそのレスポンスを返し、処理中の重複は完了まで待つ。
+    キーが無い場合は何もしない。session (リクエストのセッション) を渡すと、処理中の重複を待つ間は
+    そのトランザクションを終えて接続をプールに返す (待っている重複でプールを使い切らない)。
+
+        async with IdempotentRequest(scope, key, fingerprint, session) as request:
+            if request.replay is not None:
+                return request.replay
+            ...
+            return request.save(result)
+    """
+
+    def __init__(self, scope: str, key: Optional[str], fingerprint: str, session: Optional[AsyncSession] = None):
+        self.scope = scope
+        self.key = key
+        self.fingerprint = fingerprint
+        self._session = session
+        self.replay: Optional[Response] = None
+        self._record_id: Optional[int] = None
+        self._response: Optional[tuple[int, str]] = None
+
+    async def __aenter__(self) -> "IdempotentRequest":
+        if self.key:
+            await self._claim_or_wait()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._record_id is None:
+            return False
+        async with get_session_manager().session() as session:
+            if exc_type is None and self._response is not None:
+                status_code, body = self._response
+                await session.execute(
+                    update(IdempotencyRecord)
+                    .where(IdempotencyRecord.id == self._record_id)
+                    .values(status_code=status_code, response_body=body, completed_at=datetime.now())
+                )
+            else:
+                # 失敗したリクエストは保存せず、リトライで再実行できるようにする
+                await session.execute(delete(IdempotencyRecord).where(IdempotencyRecord.id == self._record_id))
+            await session.commit()
+        return False
+
+    def save(self, content: Any, status_code: int = 200):
+        if self._record_id is not None:
+            self._response = (status_code, json.dumps(jsonable_encoder(content), ensure_ascii=False))
+        return content
+
+    async def _claim_or_wait(self):
+        deadline = time.monotonic() + idempotency_settings.IDEMPOTENCY_WAIT_SECONDS
+        delay = 0.05
+        while True:
+            record = await self._claim()
+            if record is None:
+                return
+            if record.request_hash != self.fingerprint:
+                raise HTTPException(
+                    status_code=422,
+                    detail="Idempotency-Key has already been used for a different request",
+                )
+            if record.status_code is not None:
+                logger.info(f"idempotent replay: scope={self.scope} key={self.key}")
+                self.replay = Response(
+                    content=record.response_body,
+                    status_code=record.status_code,
+                    media_type="application/json",
+                    headers={"Idempotent-Replayed": "true"},
+                )
+                return
+            if time.monotonic() >= deadline:
+                raise HTTPException(
+                    status_code=409,
+                    detail="A request with the same Idempotency-Key is still in progress",
+                    headers={"Retry-After": "1"},
+                )
+            if self._session is not None and self._session.in_transaction():
+                # 認証などの SELECT のトランザクションを開いたまま (接続を持ったまま) 待たない
+                await self._session.rollback()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    async def _claim(self) -> Optional[IdempotencyRecord]:
+        """キーを確保できれば None を、既に誰かが持っていればそのレコードを返す"""
+        now = datetime.now()
+        async with get_session_manager().session() as session:
+            result = await session.execute(
+                insert(IdempotencyRecord)
+                .values(scope=self.scope, key=self.key, request_hash=self.fingerprint, created_at=now)
+                .on_conflict_do_nothing(constraint="uq_idempotency_scope_key")
+                .returning(IdempotencyRecord.id)
+            )
+            record_id = result.scalar_one_or_none()
+            if record_id is None:
+                record_id = await self._take_over_stale(session, now)
+            await session.commit()
+            if record_id is not None:
+                self._record_id = record_id
+                return None
+
+            result = await session.execute(
+                select(IdempotencyRecord).where(
+                    (IdempotencyRecord.scope == self.scope) & (IdempotencyRecord.key == self.key)
+                )
+            )
+            return result.scalar_one_or_none() or await self._claim()
+
+    async def _take_over_stale(self, session, now: datetime) -> Optional[int]:
+        # 処理中のまま worker が落ちたレコードと、期限切れの完了レコードは引き継ぐ
+        lease_expired = now - timedelta(seconds=idempotency_settings.IDEMPOTENCY_LEASE_SECONDS)
+        ttl_expired = now - timedelta(hours=idempotency_settings.IDEMPOTENCY_TTL_HOURS)
+        result = await session.execute(
+            update(IdempotencyRecord)
+            .where(
+                (IdempotencyRecord.scope == self.scope)
+                & (IdempotencyRecord.key == self.key)
+                & (
+                    (IdempotencyRecord.status_code.is_(None) & (IdempotencyRecord.created_at < lease_expired))
+                    | (IdempotencyRecord.completed_at < ttl_expired)
+                )
+            )
+            .values(
+                request_hash=self.fingerprint,
+                status_code=None,
+                response_body=None,
+                created_at=now,
+                completed_at=None,
+            )
+            .returning(IdempotencyRecord.id)
+        )
+        return result.scalar_one_or_none()
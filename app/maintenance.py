@@ -0,0 +1,244 @@
+"""定期メンテナンス (期限切れの仮登録の削除・終わったコンテストの初回ダウンロード記録の削除・重複回答の検出・統計情報の更新)
+
+各 worker で MaintenanceScheduler を動かし、セッション単位のアドバイザリロックを取れた 1 つだけが
+MAINTENANCE_INTERVAL_SECONDS ごとに実行する。ロックを持つ worker が止まると接続が切れてロックが外れ、
+別の worker が引き継ぐ。削除は MAINTENANCE_BATCH_SIZE 行ずつの短いトランザクションで行う。
+ANALYZE は前回からの変更行数が多いテーブル (一括登録や削除の後) だけにかける。
+autovacuum はパーティション化したテーブルの親を ANALYZE しないので、パーティションを ANALYZE したら親もかける。
+
+    python maintenance.py     # 1 回だけ実行する (MAINTENANCE_IN_APP=false のとき cron などから)
+"""
+
+import asyncio
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, select, text, update
+
+from config import duplicate_settings, idempotency_settings, maintenance_settings
+from database import DatabaseSessionManager, get_database_url, get_session_manager
+from duplicates import scan_live_contests
+from logger_config import logger
+from model import Contest, ContestStatus, IdempotencyRecord, QuestionFirstDownloaded, TemporaryUser
+
+# pg_try_advisory_lock のキー (他の用途のロックと重ならない任意の値)
+MAINTENANCE_LOCK_KEY = 7_346_021_901
+
+_TRY_LOCK = text("SELECT pg_try_advisory_lock(:key)")
+_UNLOCK = text("SELECT pg_advisory_unlock(:key)")
+
+# 前回の ANALYZE から変更の多いテーブル (parent はパーティションの親)
+_STALE_STATISTICS = text(
+    """
+    SELECT s.relname, p.relname AS parent
+    FROM pg_stat_user_tables s
+    JOIN pg_class c ON c.oid = s.relid
+    LEFT JOIN pg_inherits i ON i.inhrelid = s.relid
+    LEFT JOIN pg_class p ON p.oid = i.inhparent AND p.relkind = 'p'
+    WHERE s.schemaname = 'public'
+      AND s.n_mod_since_analyze >= greatest(CAST(:min_rows AS float), c.reltuples * CAST(:fraction AS float))
+    ORDER BY s.relname
+    """
+)
+
+
+async def _delete_in_batches(dbsm: DatabaseSessionManager, key, condition) -> int:
+    """condition に合う行を MAINTENANCE_BATCH_SIZE 行ずつ消す (バッチごとにコミットする)"""
+    batch_size = maintenance_settings.MAINTENANCE_BATCH_SIZE
+    batch = select(key).where(condition).limit(batch_size)
+    deleted = 0
+    while True:
+        async with dbsm.session() as session:
+            result = await session.execute(
+                delete(key.class_)
+                .where(condition & key.in_(batch))
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+        # バッチの間に他のリクエストへ処理を譲る
+        await asyncio.sleep(0)
+
+
+async def purge_expired_temporary_users(dbsm: DatabaseSessionManager) -> int:
+    expired_before = datetime.now() - timedelta(hours=maintenance_settings.TEMPORARY_USER_TTL_HOURS)
+    return await _delete_in_batches(dbsm, TemporaryUser.id, TemporaryUser.registered_at < expired_before)
+
+
+async def prune_first_downloads(dbsm: DatabaseSessionManager) -> int:
+    """終わったコンテストの問題の初回ダウンロード記録を消す
+
+    回答にかかった時間は提出時に user_answer に保存済みなので、Done の後は使わない。
+    コンテストの初回ダウンロード (ダッシュボードの参加履歴に使う) は 1 人 1 行なので残す。
+    Done にする API は無く end_at も入らないことがあるので、保持期間は Done を最初に見た時刻 (done_at) から数える。"""
+    ended_before = datetime.now() - timedelta(days=maintenance_settings.FIRST_DOWNLOAD_RETENTION_DAYS)
+    async with dbsm.session() as session:
+        await session.execute(
+            update(Contest)
+            .where((Contest.status == ContestStatus.Done) & Contest.done_at.is_(None))
+            .values(done_at=datetime.now())
+        )
+        # Done から戻したコンテストは、次に Done になったときから数え直す
+        await session.execute(
+            update(Contest)
+            .where((Contest.status != ContestStatus.Done) & Contest.done_at.is_not(None))
+            .values(done_at=None)
+        )
+        await session.commit()
+        result = await session.execute(
+            select(Contest.id).where(
+                (Contest.status == ContestStatus.Done)
+                & (Contest.done_at < ended_before)
+                & select(QuestionFirstDownloaded.id)
+                .where(QuestionFirstDownloaded.contest_id == Contest.id)
+                .exists()
+            )
+        )
+        contest_ids = result.scalars().all()
+
+    deleted = 0
+    for contest_id in contest_ids:
+        # contest_id で絞ってコンテストのパーティションだけを読む
+        deleted += await _delete_in_batches(
+            dbsm, QuestionFirstDownloaded.id, QuestionFirstDownloaded.contest_id == contest_id
+        )
+    return deleted
+
+
+async def purge_idempotency_records(dbsm: DatabaseSessionManager) -> int:
+    """期限切れの完了レコードと、処理中のまま残ったレコードを消す (どちらも次の同じキーで引き継がれるもの)"""
+    expired_before = datetime.now() - timedelta(hours=idempotency_settings.IDEMPOTENCY_TTL_HOURS)
+    return await _delete_in_batches(
+        dbsm,
+        IdempotencyRecord.id,
+        (IdempotencyRecord.created_at < expired_before)
+        & (IdempotencyRecord.status_code.is_(None) | (IdempotencyRecord.completed_at < expired_before)),
+    )
+
+
+async def scan_duplicates(dbsm: DatabaseSessionManager) -> int:
+    """開催中のコンテストの新しい回答を重複検出にかける (前回の検査以降の回答だけを比べる)"""
+    if not duplicate_settings.DUPLICATE_SCAN_IN_MAINTENANCE:
+        return 0
+    async with dbsm.session() as session:
+        found = await scan_live_contests(session)
+    return sum(found.values())
+
+
+async def analyze_stale_tables(dbsm: DatabaseSessionManager) -> list[str]:
+    async with dbsm.connect() as conn:
+        result = await conn.execute(
+            _STALE_STATISTICS,
+            {
+                "min_rows": maintenance_settings.MAINTENANCE_ANALYZE_MIN_ROWS,
+                "fraction": maintenance_settings.MAINTENANCE_ANALYZE_FRACTION,
+            },
+        )
+        rows = result.all()
+    tables = [row.relname for row in rows]
+    tables += sorted({row.parent for row in rows if row.parent is not None})
+    for table in tables:
+        # ANALYZE はテーブルごとに短いトランザクションで (名前はカタログから読んだもの)
+        async with dbsm.connect() as conn:
+            await conn.execute(text(f'ANALYZE "{table}"'))
+    return tables
+
+
+async def run_maintenance(dbsm: DatabaseSessionManager) -> dict:
+    """各処理は独立に行い、1 つが失敗しても残りは続ける"""
+    report = {}
+    jobs = {
+        "temporary_users": purge_expired_temporary_users,
+        "first_downloads": prune_first_downloads,
+        "idempotency_records": purge_idempotency_records,
+        "duplicate_pairs": scan_duplicates,
+        # 削除の後に統計情報を更新する
+        "analyzed": analyze_stale_tables,
+    }
+    for name, job in jobs.items():
+        try:
+            report[name] = await job(dbsm)
+        except Exception as e:
+            logger.error(f"Maintenance job {name} failed: {e}")
+    logger.info(f"Maintenance finished: {report}")
+    return report
+
+
+async def _unlock(conn):
+    # セッション単位のロックは接続をプールに返しても外れない (接続が切れていればロックも外れている)
+    with suppress(Exception):
+        await conn.execute(_UNLOCK, {"key": MAINTENANCE_LOCK_KEY})
+
+
+class MaintenanceScheduler:
+    """アドバイザリロックを取れた worker だけが定期的にメンテナンスを実行する"""
+
+    def __init__(self, dbsm: Optional[DatabaseSessionManager] = None):
+        self._dbsm = dbsm
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def dbsm(self) -> DatabaseSessionManager:
+        # fork 後の worker で作ったものを使う
+        return self._dbsm or get_session_manager()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        interval = maintenance_settings.MAINTENANCE_INTERVAL_SECONDS
+        while True:
+            try:
+                async with self.dbsm.connect_autocommit() as conn:
+                    result = await conn.execute(_TRY_LOCK, {"key": MAINTENANCE_LOCK_KEY})
+                    if result.scalar():
+                        logger.info("This worker runs the maintenance jobs")
+                        try:
+                            await self._lead(conn, interval)
+                        finally:
+                            await _unlock(conn)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in maintenance scheduler: {e}")
+            await asyncio.sleep(interval)
+
+    async def _lead(self, conn, interval: float):
+        while True:
+            await run_maintenance(self.dbsm)
+            await asyncio.sleep(interval)
+            # ロックを持つ接続が切れていたら例外になり、ロックを取り直す
+            await conn.execute(text("SELECT 1"))
+
+
+maintenance_scheduler = MaintenanceScheduler()
+
+
+async def run_once() -> bool:
+    dbsm = DatabaseSessionManager(get_database_url())
+    try:
+        async with dbsm.connect_autocommit() as conn:
+            result = await conn.execute(_TRY_LOCK, {"key": MAINTENANCE_LOCK_KEY})
+            if not result.scalar():
+                return False
+            try:
+                print(await run_maintenance(dbsm))
+            finally:
+                await _unlock(conn)
+        return True
+    finally:
+        await dbsm.close()
+
+
+if __name__ == "__main__":
+    if not asyncio.run(run_once()):
+        print("maintenance is already running elsewhere")
@@ -0,0 +1,150 @@
+"""スキーマのセットアップ
+
+gunicorn の master が worker を fork する前に 1 回だけ実行する (gunicorn.conf.py の on_starting)。
+開発時に uvicorn を直接起動する場合は `python migrate.py` を先に実行すること。"""
+
+import asyncio
+import time
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from database import DatabaseSessionManager, get_database_url
+from logger_config import logger
+from model import Base, Contest
+from partitions import PARTITIONED_TABLES, create_contest_partitions, create_default_partitions
+from vector_store import build_live_contest_vector_stores
+
+# create_all より前に必要なもの (halfvec は pgvector 0.7 以降)
+EXTENSION_UPDATES = [
+    "ALTER EXTENSION vector UPDATE",
+]
+
+# create_all は既存テーブルを変更しないので、既存の DB 向けの差分はここに冪等な DDL で書く
+SCHEMA_UPDATES = [
+    "CREATE INDEX IF NOT EXISTS ix_question_contest_id ON question (contest_id)",
+    "ALTER TABLE user_answer ALTER COLUMN is_correct DROP NOT NULL",
+    "ALTER TABLE user_answer ALTER COLUMN similarity DROP NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_user_answer_pending ON user_answer (id) WHERE similarity IS NULL",
+    "ALTER TABLE contest ADD COLUMN IF NOT EXISTS embedding_dimensions INTEGER NOT NULL DEFAULT 1536",
+    "ALTER TABLE contest ADD COLUMN IF NOT EXISTS embedding_precision VARCHAR NOT NULL DEFAULT 'float32'",
+    "ALTER TABLE answer_embedding ALTER COLUMN text_embedding_3_small TYPE vector",
+    "ALTER TABLE answer_embedding ADD COLUMN IF NOT EXISTS text_embedding_3_small_half halfvec",
+    "ALTER TABLE contest ADD COLUMN IF NOT EXISTS similarity_threshold FLOAT NOT NULL DEFAULT 0.95",
+    "ALTER TABLE contest ADD COLUMN IF NOT EXISTS option_threshold FLOAT NOT NULL DEFAULT 0.999",
+    "ALTER TABLE user_answer ADD COLUMN IF NOT EXISTS embedding vector",
+    "ALTER TABLE user_answer ADD COLUMN IF NOT EXISTS embedding_half halfvec",
+    "ALTER TABLE user_answer ADD COLUMN IF NOT EXISTS embedding_version VARCHAR",
+    "ALTER TABLE contest ADD COLUMN IF NOT EXISTS embedding_model VARCHAR NOT NULL DEFAULT 'text-embedding-3-small'",
+    "ALTER TABLE contest ADD COLUMN IF NOT EXISTS embedding_prompt_version VARCHAR NOT NULL DEFAULT 'v1'",
+    "CREATE INDEX IF NOT EXISTS ix_contest_result_ranking"
+    " ON contest_result (contest_id, number_of_correct_answers DESC, time_ms)",
+    "ALTER TABLE data_source ADD COLUMN IF NOT EXISTS sha256 VARCHAR(64)",
+    "ALTER TABLE data_source ADD COLUMN IF NOT EXISTS size BIGINT",
+    "ALTER TABLE data_source ADD COLUMN IF NOT EXISTS content_type VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_data_source_sha256 ON data_source (sha256)",
+    "CREATE INDEX IF NOT EXISTS ix_temporary_user_registered_at ON temporary_user (registered_at)",
+    "CREATE INDEX IF NOT EXISTS ix_idempotency_record_created_at ON idempotency_record (created_at)",
+    "ALTER TABLE contest ADD COLUMN IF NOT EXISTS done_at TIMESTAMP WITHOUT TIME ZONE",
+    # answer_embedding に直接持っていた正解の埋め込みを、既定のバージョンとして question_embedding に写す
+    """
+    INSERT INTO question_embedding (question_id, model, prompt_version, embedding, embedding_half, created_at)
+    SELECT question_id, 'text-embedding-3-small', 'v1', text_embedding_3_small, text_embedding_3_small_half, now()
+    FROM answer_embedding
+    WHERE text_embedding_3_small IS NOT NULL OR text_embedding_3_small_half IS NOT NULL
+    ON CONFLICT ON CONSTRAINT uq_question_embedding_version DO NOTHING
+    """,
+]
+
+
+async def _rename_legacy_table(conn: AsyncConnection, table: str) -> bool:
+    """パーティション化前のテーブルを {table}_legacy に退避する (新しいテーブルと名前が衝突する制約とシーケンスも)"""
+    result = await conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"), {"name": table})
+    if result.scalar() != "r":
+        return False
+
+    legacy = f"{table}_legacy"
+    logger.info(f"Converting {table} to a partitioned table")
+    await conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+    result = await conn.execute(
+        text("SELECT conname, contype FROM pg_constraint WHERE conrelid = to_regclass(:name)"), {"name": legacy}
+    )
+    for conname, contype in result.all():
+        if contype == "p":
+            await conn.execute(text(f"ALTER TABLE {legacy} RENAME CONSTRAINT {conname} TO {legacy}_pkey"))
+        elif contype == "u":
+            await conn.execute(text(f"ALTER TABLE {legacy} DROP CONSTRAINT {conname}"))
+    await conn.execute(text(f"ALTER SEQUENCE IF EXISTS {table}_id_seq RENAME TO {legacy}_id_seq"))
+    return True
+
+
+async def _copy_legacy_rows(conn: AsyncConnection, table: str):
+    legacy = f"{table}_legacy"
+    result = await conn.execute(
+        text("SELECT column_name FROM information_schema.columns WHERE table_name = :name ORDER BY ordinal_position"),
+        {"name": legacy},
+    )
+    columns = result.scalars().all()
+    column_list = ", ".join(columns)
+    if "contest_id" in columns:
+        await conn.execute(text(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {legacy}"))
+    else:
+        source_columns = ", ".join(f"l.{column}" for column in columns)
+        await conn.execute(
+            text(
+                f"INSERT INTO {table} ({column_list}, contest_id) "
+                f"SELECT {source_columns}, q.contest_id FROM {legacy} l JOIN question q ON q.id = l.question_id"
+            )
+        )
+    await conn.execute(
+        text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE((SELECT max(id) FROM {table}), 0) + 1, false)"
+        )
+    )
+    await conn.execute(text(f"DROP TABLE {legacy} CASCADE"))
+
+
+async def migrate(dbsm: DatabaseSessionManager):
+    async with dbsm.connect() as conn:
+        for statement in EXTENSION_UPDATES:
+            await conn.execute(text(statement))
+        legacy_tables = [table for table in PARTITIONED_TABLES if await _rename_legacy_table(conn, table)]
+
+        await conn.run_sync(Base.metadata.create_all)
+        for statement in SCHEMA_UPDATES:
+            await conn.execute(text(statement))
+
+        await create_default_partitions(conn)
+        result = await conn.execute(select(Contest.id))
+        for contest_id in result.scalars().all():
+            await create_contest_partitions(conn, contest_id)
+
+        for table in legacy_tables:
+            await _copy_legacy_rows(conn, table)
+
+    # fork 前に開催中のコンテストの正解ベクトルを共有ストアに書き出しておく
+    try:
+        async with dbsm.session() as session:
+            await build_live_contest_vector_stores(session)
+    except Exception as e:
+        # 無くても採点時に DB から読んで作り直すので起動は止めない
+        logger.error(f"Error building vector stores: {e}")
+
+
+async def run_migrations():
+    dbsm = DatabaseSessionManager(get_database_url())
+    try:
+        await migrate(dbsm)
+    finally:
+        await dbsm.close()
+
+
+def main():
+    started = time.perf_counter()
+    asyncio.run(run_migrations())
+    logger.info(f"Migration finished in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
 from datetime import datetime
 from enum import Enum
+from typing import Optional
 
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import HALFVEC, Vector
 from sqlalchemy import (
+    BigInteger,
     Column,
     Integer,
     Float,
@@ -11,6 +13,8 @@ from sqlalchemy import (
     DateTime,
     Enum as EnumType,
     ForeignKey,
+    Index,
+    Text,
     UniqueConstraint,
 )
 from sqlalchemy.orm import declarative_base, relationship
@@ -18,6 +22,15 @@ from sqlalchemy.orm import declarative_base, relationship
 Base = declarative_base()
 
 
+# 埋め込みモデルとプロンプトの既定のバージョン (user_answer.embedding_version が NULL の行もこれで埋め込んだもの)
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
+DEFAULT_PROMPT_VERSION = "v1"
+
+
+def embedding_version(model: str, prompt_version: str) -> str:
+    return f"{model}@{prompt_version}"
+
+
 class ContestStatus(Enum):
     Registered = "Registered"
     Scheduled = "Scheduled"
@@ -60,7 +73,8 @@ class TemporaryUser(Base):
     name = Column(String, unique=True, index=True, nullable=False)
     email = Column(String, unique=True, index=True, nullable=False)
     password = Column(String, nullable=False)
-    registered_at = Column(DateTime, default=datetime.now, nullable=False)
+    # 期限切れの仮登録は maintenance.py が消す
+    registered_at = Column(DateTime, default=datetime.now, nullable=False, index=True)
 
 
 class Contest(Base):
@@ -72,12 +86,27 @@ class Contest(Base):
     status = Column(EnumType(ContestStatus), default=ContestStatus.Registered, nullable=False)
     start_at = Column(DateTime)
     end_at = Column(DateTime)
+    # 定期メンテナンスが Done を最初に見た時刻 (初回ダウンロード記録の保持期間の起点。Done でなくなったら NULL)
+    done_at = Column(DateTime)
+    # 埋め込みの次元数 (text-embedding-3 の dimensions) と保存精度 ("float32" / "float16")
+    embedding_dimensions = Column(Integer, default=1536, nullable=False)
+    embedding_precision = Column(String, default="float32", nullable=False)
+    # 合格とみなす類似度 (自由記述 / 選択式)。変更したら rescore.py で採点し直す
+    similarity_threshold = Column(Float, default=0.95, nullable=False)
+    option_threshold = Column(Float, default=0.999, nullable=False)
+    # 採点に使う埋め込みのモデルとプロンプトのバージョン (question_embedding から選ぶ)
+    embedding_model = Column(String, default=DEFAULT_EMBEDDING_MODEL, nullable=False)
+    embedding_prompt_version = Column(String, default=DEFAULT_PROMPT_VERSION, nullable=False)
 
     data_sources = relationship("DataSource", back_populates="contest")
     questions = relationship("Question", back_populates="contest")
     contests_downloaded = relationship("ContestFirstDownloaded", back_populates="contest")
     contest_results = relationship("ContestResult", back_populates="contest")
 
+    @property
+    def embedding_version(self) -> str:
+        return embedding_version(self.embedding_model, self.embedding_prompt_version)
+
 
 # Define the DataSource class
 class DataSource(Base):
@@ -87,6 +116,10 @@ class DataSource(Base):
     path = Column(String, nullable=False)
     type = Column(String, nullable=False)
     description = Column(String)
+    # アップロードしたファイル (blob_store.py) の内容のハッシュとサイズ。未アップロードなら NULL
+    sha256 = Column(String(64), nullable=True, index=True)
+    size = Column(BigInteger, nullable=True)
+    content_type = Column(String, nullable=True)
 
     contest = relationship("Contest", back_populates="data_sources")
 
@@ -95,7 +128,7 @@ class DataSource(Base):
 class Question(Base):
     __tablename__ = "question"
     id = Column(Integer, primary_key=True)
-    contest_id = Column(Integer, ForeignKey("contest.id", ondelete="CASCADE"), nullable=False)
+    contest_id = Column(Integer, ForeignKey("contest.id", ondelete="CASCADE"), nullable=False, index=True)
     query = Column(String, nullable=False)
     number_of_options = Column(Integer, nullable=False)
     description = Column(String)
@@ -117,10 +150,40 @@ class AnswerEmbedding(Base):
         unique=True,
     )
     answer = Column(String, nullable=False)
-    text_embedding_3_small = Column(Vector(1536), nullable=True)
+    # 埋め込みは question_embedding に移した (以下は移行前の列で、migrate.py が既定のバージョンとして写す)
+    text_embedding_3_small = Column(Vector(), nullable=True)
+    text_embedding_3_small_half = Column(HALFVEC(), nullable=True)
 
     question = relationship("Question", back_populates="right_answer")
 
+    def get_vector(self):
+        if self.text_embedding_3_small_half is not None:
+            return self.text_embedding_3_small_half.to_numpy()
+        return self.text_embedding_3_small
+
+
+class QuestionEmbedding(Base):
+    """正解の埋め込み (モデル・プロンプトのバージョンごと)。採点にはコンテストで有効なものを使う"""
+
+    __tablename__ = "question_embedding"
+    id = Column(Integer, primary_key=True)
+    question_id = Column(Integer, ForeignKey("question.id", ondelete="CASCADE"), nullable=False)
+    model = Column(String, nullable=False)
+    prompt_version = Column(String, nullable=False)
+    # 次元数はコンテストごとに異なるので固定しない。float16 のコンテストは halfvec の列に保存する
+    embedding = Column(Vector(), nullable=True)
+    embedding_half = Column(HALFVEC(), nullable=True)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("question_id", "model", "prompt_version", name="uq_question_embedding_version"),
+    )
+
+    def get_vector(self):
+        if self.embedding_half is not None:
+            return self.embedding_half.to_numpy()
+        return self.embedding
+
 
 class AnswerOption(Base):
     __tablename__ = "answer_option"
@@ -131,44 +194,76 @@ class AnswerOption(Base):
     question = relationship("Question", back_populates="answer_options")
 
 
+# user_answer, question_first_downloaded, contest_first_downloaded はコンテストごとに LIST パーティション化する
+# (パーティションの作成とアーカイブは partitions.py)
 # Define the Answer class
 class UserAnswer(Base):
     __tablename__ = "user_answer"
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    contest_id = Column(Integer, ForeignKey("contest.id", ondelete="CASCADE"), primary_key=True)
     answer = Column(String, nullable=False)
     user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     question_id = Column(Integer, ForeignKey("question.id", ondelete="CASCADE"), nullable=False)
-    is_correct = Column(Boolean, nullable=False)
-    similarity = Column(Float, nullable=False)
+    # 非同期採点 (scoring.py) の採点待ちの間は NULL
+    is_correct = Column(Boolean, nullable=True)
+    similarity = Column(Float, nullable=True)
     submitted_at = Column(DateTime, default=datetime.now, nullable=False)
     time_taken_ms = Column(Integer, nullable=False)
+    # 提出回答の埋め込み (コンテストの次元数・保存精度で保存し、採点し直すときに再利用する)
+    embedding = Column(Vector(), nullable=True)
+    embedding_half = Column(HALFVEC(), nullable=True)
+    embedding_version = Column(String, nullable=True)
 
     user = relationship("User", back_populates="user_answers")
     question = relationship("Question", back_populates="user_answers")
+    __table_args__ = (
+        Index("ix_user_answer_user_question", "user_id", "question_id"),
+        Index("ix_user_answer_question_user", "question_id", "user_id"),
+        Index("ix_user_answer_pending", "id", postgresql_where=similarity.is_(None)),
+        {"postgresql_partition_by": "LIST (contest_id)"},
+    )
+
+    def get_embedding(self, version: Optional[str] = None):
+        """保存した埋め込み。version を指定したときは、そのバージョンで埋め込んだものだけ返す"""
+        stored_version = self.embedding_version or embedding_version(DEFAULT_EMBEDDING_MODEL, DEFAULT_PROMPT_VERSION)
+        if version is not None and stored_version != version:
+            return None
+        if self.embedding_half is not None:
+            return self.embedding_half.to_numpy()
+        return self.embedding
 
 
 class ContestFirstDownloaded(Base):
     __tablename__ = "contest_first_downloaded"
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
-    contest_id = Column(Integer, ForeignKey("contest.id", ondelete="CASCADE"), nullable=False)
+    contest_id = Column(Integer, ForeignKey("contest.id", ondelete="CASCADE"), primary_key=True)
     downloaded_at = Column(DateTime, default=datetime.now, nullable=False)
 
     user = relationship("User", back_populates="contests_downloaded")
     contest = relationship("Contest", back_populates="contests_downloaded")
-    __table_args__ = (UniqueConstraint("user_id", "contest_id", name="uq_user_contest"),)
+    __table_args__ = (
+        UniqueConstraint("user_id", "contest_id", name="uq_user_contest"),
+        {"postgresql_partition_by": "LIST (contest_id)"},
+    )
 
 
 class QuestionFirstDownloaded(Base):
     __tablename__ = "question_first_downloaded"
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    contest_id = Column(Integer, ForeignKey("contest.id", ondelete="CASCADE"), primary_key=True)
     user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     question_id = Column(Integer, ForeignKey("question.id", ondelete="CASCADE"), nullable=False)
     downloaded_at = Column(DateTime, default=datetime.now, nullable=False)
 
     user = relationship("User", back_populates="questions_downloaded")
     question = relationship("Question", back_populates="questions_downloaded")
-    __table_args__ = (UniqueConstraint("user_id", "question_id", name="uq_user_question"),)
+    # パーティションキーを含めないと一意制約を張れない (question_id から contest_id は一意に決まる)
+    __table_args__ = (
+        UniqueConstraint("user_id", "question_id", "contest_id", name="uq_user_question"),
+        Index("ix_question_first_downloaded_question_user", "question_id", "user_id"),
+        {"postgresql_partition_by": "LIST (contest_id)"},
+    )
 
 
 class ContestResult(Base):
@@ -181,4 +276,55 @@ class ContestResult(Base):
 
     user = relationship("User", back_populates="contest_results")
     contest = relationship("Contest", back_populates="contest_results")
-    __table_args__ = (UniqueConstraint("user_id", "contest_id", name="uq_user_contest_result"),)
+    __table_args__ = (
+        UniqueConstraint("user_id", "contest_id", name="uq_user_contest_result"),
+        # コンテスト内の順位 (正解数の多い順、同数なら合計時間の短い順)
+        Index("ix_contest_result_ranking", "contest_id", number_of_correct_answers.desc(), "time_ms"),
+    )
+
+
+class IdempotencyRecord(Base):
+    """Idempotency-Key ごとの最初のレスポンス (status_code が NULL の間は処理中)"""
+
+    __tablename__ = "idempotency_record"
+    id = Column(Integer, primary_key=True)
+    scope = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    request_hash = Column(String, nullable=False)
+    status_code = Column(Integer, nullable=True)
+    response_body = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.now, nullable=False)
+    completed_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("scope", "key", name="uq_idempotency_scope_key"),
+        Index("ix_idempotency_record_created_at", "created_at"),
+    )
+
+
+class DuplicateScanState(Base):
+    """問題ごとの重複検出の進み具合 (last_answer_id までの回答は検査済み)"""
+
+    __tablename__ = "duplicate_scan_state"
+    question_id = Column(Integer, ForeignKey("question.id", ondelete="CASCADE"), primary_key=True)
+    contest_id = Column(Integer, ForeignKey("contest.id", ondelete="CASCADE"), nullable=False, index=True)
+    last_answer_id = Column(Integer, nullable=False, default=0)
+    threshold = Column(Float, nullable=False)
+    scanned_at = Column(DateTime, default=datetime.now, nullable=False)
+
+
+class DuplicateAnswerPair(Base):
+    """別のユーザーのほぼ同じ回答の組 (answer_id < other_answer_id)"""
+
+    __tablename__ = "duplicate_answer_pair"
+    id = Column(Integer, primary_key=True)
+    contest_id = Column(Integer, ForeignKey("contest.id", ondelete="CASCADE"), nullable=False, index=True)
+    question_id = Column(Integer, ForeignKey("question.id", ondelete="CASCADE"), nullable=False)
+    answer_id = Column(Integer, nullable=False)
+    other_answer_id = Column(Integer, nullable=False)
+    similarity = Column(Float, nullable=False)
+    detected_at = Column(DateTime, default=datetime.now, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("question_id", "answer_id", "other_answer_id", name="uq_duplicate_answer_pair"),
+    )
@@ -0,0 +1,118 @@
+"""コンテストごとのパーティション管理
+
+user_answer / question_first_downloaded / contest_first_downloaded は contest_id で LIST パーティション化している。
+コンテスト登録時にパーティションを作り、Done になったコンテストは detach して archive スキーマへ移す。
+アーカイブしたコンテストの回答は親テーブルから見えなくなる (ランキングは contest_result に残る)。
+
+    python partitions.py archive <contest_id>
+    python partitions.py archive-done
+    python partitions.py restore <contest_id>
+"""
+
+import asyncio
+import sys
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from database import DatabaseSessionManager, get_database_url
+from logger_config import logger
+from model import Contest, ContestStatus
+
+PARTITIONED_TABLES = ["user_answer", "question_first_downloaded", "contest_first_downloaded"]
+ARCHIVE_SCHEMA = "archive"
+
+
+def partition_name(table: str, contest_id: int) -> str:
+    return f"{table}_c{int(contest_id)}"
+
+
+async def _relation_exists(conn: AsyncConnection, name: str) -> bool:
+    result = await conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name})
+    return result.scalar()
+
+
+async def create_default_partitions(conn: AsyncConnection):
+    # パーティションが無いコンテストの行の受け皿 (通常は空)
+    for table in PARTITIONED_TABLES:
+        await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+
+
+async def create_contest_partitions(conn: AsyncConnection, contest_id: int):
+    """コンテスト用のパーティションを作る
+
+    CREATE TABLE ... PARTITION OF は親テーブルに ACCESS EXCLUSIVE ロックを取るので、
+    単独のテーブルを作ってから ATTACH する (SHARE UPDATE EXCLUSIVE で済み、回答の書き込みを止めない)。"""
+    for table in PARTITIONED_TABLES:
+        name = partition_name(table, contest_id)
+        if await _relation_exists(conn, name) or await _relation_exists(conn, f"{ARCHIVE_SCHEMA}.{name}"):
+            continue
+        await conn.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+        await conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES IN ({int(contest_id)})"))
+
+
+async def archive_contest(conn: AsyncConnection, contest_id: int):
+    """Done のコンテストのパーティションを detach して archive スキーマへ移す"""
+    result = await conn.execute(select(Contest.status).where(Contest.id == contest_id))
+    status = result.scalar_one_or_none()
+    if status is None:
+        raise ValueError(f"Contest {contest_id} not found")
+    if status != ContestStatus.Done:
+        raise ValueError(f"Contest {contest_id} is {status.value}, only Done contests can be archived")
+
+    await conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+    for table in PARTITIONED_TABLES:
+        name = partition_name(table, contest_id)
+        if not await _relation_exists(conn, name):
+            continue
+        await conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+        await conn.execute(text(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+    logger.info(f"Archived partitions of contest {contest_id}")
+
+
+async def restore_contest(conn: AsyncConnection, contest_id: int):
+    """archive_contest で退避したパーティションを元に戻す"""
+    for table in PARTITIONED_TABLES:
+        name = partition_name(table, contest_id)
+        if not await _relation_exists(conn, f"{ARCHIVE_SCHEMA}.{name}"):
+            continue
+        await conn.execute(text(f"ALTER TABLE {ARCHIVE_SCHEMA}.{name} SET SCHEMA public"))
+        await conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES IN ({int(contest_id)})"))
+    logger.info(f"Restored partitions of contest {contest_id}")
+
+
+async def archive_done_contests(conn: AsyncConnection) -> list[int]:
+    result = await conn.execute(select(Contest.id).where(Contest.status == ContestStatus.Done))
+    archived = []
+    for contest_id in result.scalars().all():
+        if await _relation_exists(conn, partition_name(PARTITIONED_TABLES[0], contest_id)):
+            await archive_contest(conn, contest_id)
+            archived.append(contest_id)
+    return archived
+
+
+async def _run(command: str, contest_id: int | None):
+    dbsm = DatabaseSessionManager(get_database_url())
+    try:
+        async with dbsm.connect() as conn:
+            if command == "archive":
+                await archive_contest(conn, contest_id)
+            elif command == "restore":
+                await restore_contest(conn, contest_id)
+            elif command == "archive-done":
+                archived = await archive_done_contests(conn)
+                print(f"archived contests: {archived}")
+    finally:
+        await dbsm.close()
+
+
+def main(argv: list[str]):
+    if not argv or argv[0] not in ("archive", "restore", "archive-done"):
+        print(__doc__)
+        sys.exit(1)
+    contest_id = int(argv[1]) if argv[0] != "archive-done" else None
+    asyncio.run(_run(argv[0], contest_id))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
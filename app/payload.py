@@ -1,15 +1,19 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Literal, Optional
 
 
 class DataSourcePayload(BaseModel):
     path: str
     type: str
     description: Optional[str]
+    # サービスでホストしているファイルのダウンロード先 (レスポンスのみ)
+    id: Optional[int] = None
+    url: Optional[str] = None
+    sha256: Optional[str] = None
+    size: Optional[int] = None
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class QuestionOut(BaseModel):
@@ -18,15 +22,17 @@ class QuestionOut(BaseModel):
     options: List[str]
     description: Optional[str]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+
+# GET /api/contests/{contest_id}/questions のレスポンス (起動時に 1 回だけスキーマを組み立てる)
+question_list_adapter = TypeAdapter(List[QuestionOut])
 
 
 class UserAnswerSubmission(BaseModel):
     answer: str
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class UserAnswerOut(BaseModel):
@@ -37,8 +43,69 @@ class UserAnswerOut(BaseModel):
     time_taken_ms: int
     not_answered_question_ids: list[int]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+
+class ScoringTicketOut(BaseModel):
+    ticket_id: int
+    question_id: int
+    answer: str
+    time_taken_ms: int
+    status: str
+    result_url: str
+
+
+class ContestProgressOut(BaseModel):
+    contest_id: int
+    contest_name: str
+    status: str
+    number_of_questions: int
+    answered: int
+    remaining: int
+    # 採点待ちの回答数
+    pending: int
+    correct: int
+    total_time_ms: int
+    # 全問の結果が出るまでは None
+    rank: Optional[int]
+    participants: Optional[int]
+
+
+class UserStatsOut(BaseModel):
+    user_id: int
+    user_name: str
+    contests: List[ContestProgressOut]
+
+
+class ProvisionUserIn(BaseModel):
+    name: str = Field(..., min_length=1)
+    email: str = Field(..., min_length=3)
+    # 省略したユーザーには生成したパスワードを返す
+    password: Optional[str] = None
+
+
+class ProvisionUsersIn(BaseModel):
+    users: List[ProvisionUserIn]
+
+
+class ProvisionedUserOut(BaseModel):
+    id: int
+    name: str
+    email: str
+    api_key: str
+    # 生成したパスワード (指定されたものは返さない)
+    password: Optional[str] = None
+
+
+class ProvisionSkippedOut(BaseModel):
+    name: str
+    email: str
+    reason: str
+
+
+class ProvisionUsersOut(BaseModel):
+    created: List[ProvisionedUserOut]
+    skipped: List[ProvisionSkippedOut]
 
 
 class QueryAnswer(BaseModel):
@@ -51,9 +118,11 @@ class QueryAnswer(BaseModel):
 class ContestInfo(BaseModel):
     name: str
     description: Optional[str]
+    # 省略時は 1536 次元 / float32
+    embedding_dimensions: Optional[int] = Field(None, ge=1, le=1536)
+    embedding_precision: Optional[Literal["float32", "float16"]] = None
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class ContestIn(BaseModel):
@@ -71,6 +140,5 @@ class ContestOut(BaseModel):
     end_at: Optional[datetime]
     data_sources: List[DataSourcePayload]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
@@ -0,0 +1,203 @@
+"""管理者による参加者の一括登録 (授業や社内のコンテスト向け)
+
+/signup と /verify を 1 人ずつ通す代わりに、CSV (name,email[,password] の見出し付き) か JSON の名簿をまとめて登録する。
+既存ユーザーとの重複は名簿全体を 1 回の問い合わせで調べ、パスワードはプロセスプールで並列にハッシュ化し、
+User は unnest で 1 つの INSERT にまとめて入れる。同じ名前・メールアドレスの仮登録 (メール認証待ち) は置き換える。
+パスワードを省略したユーザーには生成したパスワードを、全員に API キーを返す。
+"""
+
+import asyncio
+import csv
+import io
+import json
+import multiprocessing
+import os
+import secrets
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+from sqlalchemy import delete, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import provisioning_settings
+from logger_config import logger
+from model import TemporaryUser, User
+from payload import ProvisionedUserOut, ProvisionSkippedOut, ProvisionUserIn, ProvisionUsersIn, ProvisionUsersOut
+from utils import generate_api_key, get_password_hash
+
+_INSERT_USERS = text(
+    """
+    INSERT INTO "user" (name, email, password, api_key, registered_at, is_admin)
+    SELECT name, email, password, api_key, CAST(:registered_at AS timestamp), false
+    FROM unnest(
+        CAST(:names AS varchar[]),
+        CAST(:emails AS varchar[]),
+        CAST(:passwords AS varchar[]),
+        CAST(:api_keys AS varchar[])
+    ) AS t(name, email, password, api_key)
+    ON CONFLICT DO NOTHING
+    RETURNING id, name
+    """
+)
+
+_hash_pool: Optional[ProcessPoolExecutor] = None
+_hash_pool_pid: Optional[int] = None
+
+
+def parse_users(content_type: str, body: bytes) -> list[ProvisionUserIn]:
+    """CSV か JSON ({"users": [...]} かその配列) の名簿を読む"""
+    try:
+        if content_type.startswith("text/csv"):
+            # Excel が付ける BOM は読み飛ばす
+            rows = list(csv.DictReader(io.StringIO(body.decode("utf-8-sig"))))
+            return [ProvisionUserIn(**{key: value or None for key, value in row.items() if key}) for row in rows]
+        data = json.loads(body)
+        return ProvisionUsersIn(**(data if isinstance(data, dict) else {"users": data})).users
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid user list: {e}")
+
+
+def _hash_passwords(passwords: list[str]) -> list[str]:
+    return [get_password_hash(password) for password in passwords]
+
+
+def _hash_workers() -> int:
+    return provisioning_settings.PROVISIONING_HASH_WORKERS or os.cpu_count() or 1
+
+
+def _get_hash_pool() -> ProcessPoolExecutor:
+    # worker プロセスごとに作る (イベントループのある worker からは fork しない)
+    global _hash_pool, _hash_pool_pid
+    if _hash_pool is None or _hash_pool_pid != os.getpid():
+        _hash_pool = ProcessPoolExecutor(
+            max_workers=_hash_workers(),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        _hash_pool_pid = os.getpid()
+    return _hash_pool
+
+
+def shutdown_hash_pool():
+    global _hash_pool
+    if _hash_pool is not None and _hash_pool_pid == os.getpid():
+        _hash_pool.shutdown(cancel_futures=True)
+    _hash_pool = None
+
+
+async def hash_passwords(passwords: list[str]) -> list[str]:
+    """bcrypt は 1 件ごとに重いので、プロセス数に分けて並列に計算する"""
+    pool = _get_hash_pool()
+    size = -(-len(passwords) // _hash_workers())
+    loop = asyncio.get_running_loop()
+    chunks = await asyncio.gather(
+        *(
+            loop.run_in_executor(pool, _hash_passwords, passwords[start : start + size])
+            for start in range(0, len(passwords), size)
+        )
+    )
+    return [hashed for chunk in chunks for hashed in chunk]
+
+
+def _check_batch(users: list[ProvisionUserIn]):
+    if not users:
+        raise HTTPException(status_code=400, detail="No users to provision")
+    if len(users) > provisioning_settings.PROVISIONING_MAX_USERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {provisioning_settings.PROVISIONING_MAX_USERS} users can be provisioned at once",
+        )
+    counts = Counter(user.name for user in users) + Counter(user.email for user in users)
+    duplicates = sorted(value for value, count in counts.items() if count > 1)
+    if duplicates:
+        raise HTTPException(
+            status_code=422,
+            detail={"message": "Duplicate names or emails in the list", "values": duplicates},
+        )
+
+
+async def provision_users(
+    session: AsyncSession, users: list[ProvisionUserIn], skip_existing: bool = False
+) -> ProvisionUsersOut:
+    """名簿を登録する。登録済みの名前・メールアドレスがあれば 409 (skip_existing なら飛ばして報告する)"""
+    users = [user.model_copy(update={"name": user.name.strip(), "email": user.email.strip()}) for user in users]
+    _check_batch(users)
+
+    names = [user.name for user in users]
+    emails = [user.email for user in users]
+    result = await session.execute(
+        select(User.name, User.email).where(User.name.in_(names) | User.email.in_(emails))
+    )
+    existing = result.all()
+    taken_names = {row.name for row in existing}
+    taken_emails = {row.email for row in existing}
+    skipped = [
+        ProvisionSkippedOut(name=user.name, email=user.email, reason="already registered")
+        for user in users
+        if user.name in taken_names or user.email in taken_emails
+    ]
+    if skipped and not skip_existing:
+        raise HTTPException(
+            status_code=409,
+            detail={
+                "message": "Some users are already registered",
+                "conflicts": [user.model_dump() for user in skipped],
+            },
+        )
+    users = [user for user in users if user.name not in taken_names and user.email not in taken_emails]
+    # ハッシュ化の間トランザクションを開いたままにしない
+    await session.rollback()
+    if not users:
+        return ProvisionUsersOut(created=[], skipped=skipped)
+
+    generated = {user.name: secrets.token_urlsafe(12) for user in users if not user.password}
+    passwords = await hash_passwords([user.password or generated[user.name] for user in users])
+    api_keys = [generate_api_key() for _ in users]
+
+    names = [user.name for user in users]
+    emails = [user.email for user in users]
+    await session.execute(delete(TemporaryUser).where(TemporaryUser.name.in_(names) | TemporaryUser.email.in_(emails)))
+    result = await session.execute(
+        _INSERT_USERS,
+        {
+            "registered_at": datetime.now(),
+            "names": names,
+            "emails": emails,
+            "passwords": passwords,
+            "api_keys": api_keys,
+        },
+    )
+    ids = {row.name: row.id for row in result.all()}
+    await session.commit()
+
+    created = []
+    for user, api_key in zip(users, api_keys):
+        if user.name not in ids:
+            # 確認の後に同じ名前・メールアドレスで登録された
+            skipped.append(ProvisionSkippedOut(name=user.name, email=user.email, reason="already registered"))
+            continue
+        created.append(
+            ProvisionedUserOut(
+                id=ids[user.name],
+                name=user.name,
+                email=user.email,
+                api_key=api_key,
+                password=generated.get(user.name),
+            )
+        )
+    logger.info(f"Provisioned {len(created)} users ({len(skipped)} skipped)")
+    return ProvisionUsersOut(created=created, skipped=skipped)
+
+
+def credentials_csv(provisioned: ProvisionUsersOut) -> str:
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["id", "name", "email", "api_key", "password"])
+    for user in provisioned.created:
+        writer.writerow([user.id, user.name, user.email, user.api_key, user.password or ""])
+    return output.getvalue()
@@ -0,0 +1,477 @@
+"""API が発行する問い合わせの実行計画の回帰チェック
+
+本番に近い件数のデータを入れたローカルの Postgres に対して API のエンドポイントを順に呼び、
+その間に発行された問い合わせをすべて記録して `EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)` で実行し直す
+(書き込みを含む問い合わせも実行計画を取ったらロールバックする)。
+大きいテーブル (--large-table-rows 行以上) の Seq Scan と、ベースライン (query_plans_baseline.json) から
+コスト・処理行数・読んだバッファ数が --tolerance 倍を超えて増えた問い合わせがあれば終了コード 1 で終わる。
+同期採点の提出は埋め込み API を呼べない宛先に向けて行い、非同期採点への切り替え (202) も確かめる。
+インデックスや問い合わせを変えるときは、check の結果 (--plans-dir に書き出した実行計画) を根拠として添え、
+意図した変化なら --update-baseline でベースラインを更新してコミットする。
+
+本番の DB には絶対に向けないこと (seed は空の DB にしか入れない)。
+    POSTGRES_DB=ragcontest_plans python migrate.py
+    POSTGRES_DB=ragcontest_plans python query_plans.py seed [--users 2000 --contests 8 --questions 40]
+    POSTGRES_DB=ragcontest_plans python query_plans.py check [--update-baseline] [--plans-dir plans/]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+from dataclasses import dataclass, field
+from typing import Optional
+
+import httpx
+from sqlalchemy import event, func, insert, select, text
+from sqlalchemy.engine import Engine
+
+from database import DatabaseSessionManager, get_database_url
+from model import AnswerOption, Contest, ContestStatus, Question, User
+from partitions import create_contest_partitions
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_plans_baseline.json")
+SEED_PREFIX = "query-plan"
+ADMIN_API_KEY = f"{SEED_PREFIX}-admin"
+# ベースラインと比べる指標と、これ未満の増加は誤差として無視する幅
+METRIC_FLOORS = {"total_cost": 100.0, "rows": 1000, "buffers": 100}
+
+
+@dataclass
+class Case:
+    name: str
+    method: str
+    path: str
+    admin: bool = False
+    headers: dict = field(default_factory=dict)
+    json: Optional[dict] = None
+    # 期待するステータスコード (None なら 400 未満ならよい)
+    expect_status: Optional[int] = None
+    # コンテストの全回答を読むなど、Seq Scan が正しい計画になるテーブル (パーティションは親の名前で書く)
+    allow_seq_scan: tuple = ()
+
+
+def build_cases(ids: dict) -> list[Case]:
+    live, done, question, answer = ids["live_contest"], ids["done_contest"], ids["question"], ids["answer"]
+    return [
+        Case("get_contests_list", "GET", "/api/contests"),
+        Case("get_contest", "GET", f"/api/contests/{live}"),
+        Case("get_question", "GET", f"/api/questions/{question}"),
+        Case("get_questions", "GET", f"/api/contests/{live}/questions"),
+        Case(
+            "submit_answer",
+            "POST",
+            f"/api/questions/{question}",
+            headers={"Prefer": "respond-async"},
+            json={"answer": "query plan check"},
+            expect_status=202,
+        ),
+        # 埋め込み API が落ちているときの同期採点 (受け付けだけして後で採点する)
+        Case(
+            "submit_answer_fallback",
+            "POST",
+            f"/api/questions/{question}",
+            json={"answer": "query plan check"},
+            expect_status=202,
+        ),
+        Case("get_answer_result", "GET", f"/api/answers/{answer}"),
+        Case("get_user_stats", "GET", "/api/users/me/stats"),
+        Case("get_results_page", "GET", "/results"),
+        Case("get_result_page", "GET", f"/results/{done}"),
+        Case("get_result_details_page", "GET", f"/results/{done}/details", allow_seq_scan=("user_answer", "user")),
+        Case(
+            "get_contest_analytics",
+            "GET",
+            f"/api/admin/contests/{live}/analytics?full=true",
+            admin=True,
+            allow_seq_scan=("user_answer",),
+        ),
+        Case("get_duplicates", "GET", f"/api/admin/contests/{live}/duplicates", admin=True),
+    ]
+
+
+async def seed(dbsm: DatabaseSessionManager, users: int, contests: int, questions: int, participation: int):
+    """users 人が各コンテストに participation % の割合で参加し、参加したコンテストの問題をすべてダウンロードする。
+    最後のコンテストだけ開催中で、回答は半分ほど (一部は採点待ち)。それ以外は Done で全問回答済み"""
+    async with dbsm.connect() as conn:
+        if (await conn.execute(select(User.id).limit(1))).first() is not None:
+            raise SystemExit("The database already has users; seed only an empty database")
+
+        await conn.execute(text("SELECT setseed(0.42)"))
+        await conn.execute(
+            text(
+                """
+                INSERT INTO "user" (name, email, password, api_key, registered_at, is_admin)
+                SELECT CAST(:prefix AS text) || '-user-' || i, CAST(:prefix AS text) || '-user-' || i || '@example.com',
+                       '', CAST(:prefix AS text) || '-user-' || i, now(), false
+                FROM generate_series(1, :users) AS i
+                """
+            ),
+            {"prefix": SEED_PREFIX, "users": users},
+        )
+        await conn.execute(
+            insert(User).values(
+                name=ADMIN_API_KEY,
+                email=f"{ADMIN_API_KEY}@example.com",
+                password="",
+                api_key=ADMIN_API_KEY,
+                is_admin=True,
+            )
+        )
+
+        contest_ids = []
+        for i in range(1, contests + 1):
+            result = await conn.execute(
+                insert(Contest)
+                .values(
+                    name=f"{SEED_PREFIX}-{i}",
+                    number_of_questions=questions,
+                    status=ContestStatus.Running if i == contests else ContestStatus.Done,
+                )
+                .returning(Contest.id)
+            )
+            contest_id = result.scalar_one()
+            contest_ids.append(contest_id)
+            await create_contest_partitions(conn, contest_id)
+            # 5 問に 1 問は 4 択
+            result = await conn.execute(
+                insert(Question)
+                .values(
+                    [
+                        {
+                            "contest_id": contest_id,
+                            "query": f"question {n} of contest {i}",
+                            "number_of_options": 4 if n % 5 == 0 else 0,
+                        }
+                        for n in range(1, questions + 1)
+                    ]
+                )
+                .returning(Question.id, Question.number_of_options)
+            )
+            options = [
+                {"question_id": question_id, "option_text": f"option {k}"}
+                for question_id, number_of_options in result.all()
+                for k in range(number_of_options)
+            ]
+            if options:
+                await conn.execute(insert(AnswerOption).values(options))
+
+        params = {"contest_ids": contest_ids, "participation": participation, "live": contest_ids[-1]}
+        # 正解ベクトル (値は乱数。同期採点の提出が埋め込み API を呼ぶところまで進むように)
+        await conn.execute(
+            text(
+                """
+                INSERT INTO question_embedding (question_id, model, prompt_version, embedding, created_at)
+                SELECT q.id, c.embedding_model, c.embedding_prompt_version,
+                       CAST((SELECT array_agg(random()) FROM generate_series(1, c.embedding_dimensions)
+                             WHERE q.id IS NOT NULL) AS vector),
+                       now()
+                FROM question q JOIN contest c ON c.id = q.contest_id
+                WHERE c.id = ANY(:contest_ids)
+                """
+            ),
+            params,
+        )
+        participants = """
+            SELECT c.id AS contest_id, u.id AS user_id
+            FROM contest c JOIN "user" u ON (u.id * 7919 + c.id * 104729) % 100 < :participation
+            WHERE c.id = ANY(:contest_ids) AND NOT u.is_admin
+        """
+        await conn.execute(
+            text(
+                f"""
+                INSERT INTO contest_first_downloaded (user_id, contest_id, downloaded_at)
+                SELECT user_id, contest_id, now() - interval '2 hours' FROM ({participants}) p
+                """
+            ),
+            params,
+        )
+        await conn.execute(
+            text(
+                f"""
+                INSERT INTO question_first_downloaded (contest_id, user_id, question_id, downloaded_at)
+                SELECT p.contest_id, p.user_id, q.id, now() - interval '1 hour' * random()
+                FROM ({participants}) p JOIN question q ON q.contest_id = p.contest_id
+                """
+            ),
+            params,
+        )
+        # 誤答は 50 通りの文字列に寄せる (多い誤答の集計が意味を持つように)
+        await conn.execute(
+            text(
+                """
+                INSERT INTO user_answer
+                    (contest_id, answer, user_id, question_id, is_correct, similarity, submitted_at, time_taken_ms)
+                SELECT d.contest_id, s.answer, d.user_id, d.question_id,
+                       CASE WHEN s.pending THEN NULL ELSE s.similarity >= 0.95 END,
+                       CASE WHEN s.pending THEN NULL ELSE s.similarity END,
+                       d.downloaded_at + interval '1 minute', (random() * 3600000)::int
+                FROM question_first_downloaded d
+                CROSS JOIN LATERAL (
+                    SELECT 'answer ' || (random() * 50)::int AS answer,
+                           0.7 + random() * 0.3 AS similarity,
+                           d.contest_id = :live AND random() < 0.02 AS pending
+                ) s
+                WHERE d.contest_id = ANY(:contest_ids) AND (d.contest_id <> :live OR random() < 0.5)
+                """
+            ),
+            params,
+        )
+        await conn.execute(
+            text(
+                """
+                INSERT INTO contest_result (user_id, contest_id, number_of_correct_answers, time_ms)
+                SELECT user_id, contest_id, count(*) FILTER (WHERE is_correct), sum(time_taken_ms)
+                FROM user_answer
+                WHERE contest_id = ANY(:contest_ids) AND contest_id <> :live
+                GROUP BY user_id, contest_id
+                """
+            ),
+            params,
+        )
+    # ANALYZE はトランザクションの外で
+    async with dbsm.connect() as conn:
+        await conn.execute(text("ANALYZE"))
+
+
+async def find_seed_ids(dbsm: DatabaseSessionManager) -> dict:
+    async with dbsm.session() as session:
+        seeded = Contest.name.like(f"{SEED_PREFIX}-%")
+        result = await session.execute(
+            select(
+                select(func.max(Contest.id)).where(seeded & (Contest.status == ContestStatus.Running))
+                .scalar_subquery().label("live_contest"),
+                select(func.min(Contest.id)).where(seeded & (Contest.status == ContestStatus.Done))
+                .scalar_subquery().label("done_contest"),
+            )
+        )
+        ids = dict(result.mappings().one())
+        if ids["live_contest"] is None or ids["done_contest"] is None:
+            raise SystemExit("Seeded contests not found; run `python query_plans.py seed` on an empty database first")
+        # 開催中のコンテストで、採点済みの回答と未回答の問題の両方があるユーザー
+        result = await session.execute(
+            text(
+                """
+                SELECT u.api_key, a.id AS answer, d.question_id AS question
+                FROM question_first_downloaded d
+                JOIN "user" u ON u.id = d.user_id
+                JOIN user_answer a ON a.contest_id = d.contest_id AND a.user_id = d.user_id AND a.similarity IS NOT NULL
+                WHERE d.contest_id = :live AND NOT EXISTS (
+                    SELECT 1 FROM user_answer x
+                    WHERE x.contest_id = d.contest_id AND x.user_id = d.user_id AND x.question_id = d.question_id
+                )
+                ORDER BY u.id, d.question_id
+                LIMIT 1
+                """
+            ),
+            {"live": ids["live_contest"]},
+        )
+        row = result.mappings().first()
+        if row is None:
+            raise SystemExit("No seeded user with both answered and unanswered questions; seed again")
+    return {**ids, **row}
+
+
+def _walk(node: dict):
+    yield node
+    for child in node.get("Plans", []):
+        yield from _walk(child)
+
+
+def plan_metrics(plan: dict) -> dict:
+    root = plan["Plan"]
+    nodes = list(_walk(root))
+    return {
+        "total_cost": root["Total Cost"],
+        # 各ノードが返した行数の合計 (ループの回数を掛ける)
+        "rows": sum(node.get("Actual Rows", 0) * node.get("Actual Loops", 1) for node in nodes),
+        "buffers": root.get("Shared Hit Blocks", 0) + root.get("Shared Read Blocks", 0),
+        "execution_ms": plan.get("Execution Time"),
+    }
+
+
+async def _relation_sizes(session, names: set[str]) -> dict[str, tuple[str, float]]:
+    """テーブル名 -> (親テーブル名 (パーティションでなければ自分), 推定行数)"""
+    if not names:
+        return {}
+    result = await session.execute(
+        text(
+            """
+            SELECT c.relname, coalesce(p.relname, c.relname) AS parent, c.reltuples
+            FROM pg_class c
+            LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+            LEFT JOIN pg_class p ON p.oid = i.inhparent
+            WHERE c.relname = ANY(:names) AND c.relkind = 'r'
+            """
+        ),
+        {"names": sorted(names)},
+    )
+    return {row.relname: (row.parent, row.reltuples) for row in result.all()}
+
+
+def _statement_hash(statement: str) -> str:
+    return hashlib.sha1(" ".join(statement.split()).encode()).hexdigest()[:12]
+
+
+class QueryRecorder:
+    """エンドポイントの処理中に発行された問い合わせを記録する"""
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(Engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(Engine, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().split(None, 1)[0].upper() in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE"):
+            self.statements.append((statement, parameters))
+
+
+async def explain(dbsm: DatabaseSessionManager, statement: str, parameters) -> dict:
+    async with dbsm.session() as session:
+        conn = await session.connection()
+        try:
+            result = await conn.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters)
+            plan = result.scalar_one()
+        finally:
+            # 書き込みは残さない
+            await session.rollback()
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    return plan[0]
+
+
+def compare(metrics: dict, baseline: Optional[dict], tolerance: float) -> list[str]:
+    if baseline is None:
+        return []
+    problems = []
+    for metric, floor in METRIC_FLOORS.items():
+        before, after = baseline.get(metric), metrics[metric]
+        if before is not None and after > before * tolerance and after - before > floor:
+            problems.append(f"{metric} {before:g} -> {after:g}")
+    return problems
+
+
+async def check(args) -> int:
+    # 埋め込み API は呼べない宛先 (接続拒否) に向ける (本物の API は呼ばない)
+    os.environ["OPENAI_BASE_URL"] = "http://127.0.0.1:9/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "query-plans")
+    # api は読み込むだけでテンプレートや静的ファイルを準備するので check のときだけ読み込む
+    from api import API_HEADER_NAME, app
+
+    dbsm = DatabaseSessionManager(get_database_url())
+    try:
+        ids = await find_seed_ids(dbsm)
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        if args.plans_dir:
+            os.makedirs(args.plans_dir, exist_ok=True)
+
+        recorded = {}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://query-plans") as client:
+            for case in build_cases(ids):
+                headers = {API_HEADER_NAME: ADMIN_API_KEY if case.admin else ids["api_key"], **case.headers}
+                with QueryRecorder() as recorder:
+                    response = await client.request(case.method, case.path, headers=headers, json=case.json)
+                if (
+                    response.status_code != case.expect_status
+                    if case.expect_status is not None
+                    else response.status_code >= 400
+                ):
+                    print(f"{case.name}: {case.method} {case.path} returned {response.status_code}")
+                    print(response.text[:200])
+                    return 1
+                recorded[case.name] = (case, recorder.statements)
+
+        failures = 0
+        results = {}
+        async with dbsm.session() as session:
+            print(f"{'query':<34} {'cost':>10} {'rows':>10} {'buffers':>8} {'ms':>8}  status")
+            for name, (case, statements) in recorded.items():
+                for index, (statement, parameters) in enumerate(statements):
+                    key = f"{name}[{index}]"
+                    try:
+                        plan = await explain(dbsm, statement, parameters)
+                    except Exception as e:
+                        # 重複した初回ダウンロードの INSERT など、2 回目は失敗する書き込み
+                        print(f"{key:<34} skipped: {type(e).__name__}")
+                        continue
+                    metrics = plan_metrics(plan)
+                    results[key] = {"statement_hash": _statement_hash(statement), **metrics}
+                    scans = {
+                        node["Relation Name"]: node.get("Actual Rows", 0)
+                        for node in _walk(plan["Plan"])
+                        if node["Node Type"] == "Seq Scan"
+                    }
+                    sizes = await _relation_sizes(session, set(scans))
+                    problems = [
+                        f"Seq Scan on {relation} ({int(sizes[relation][1])} rows)"
+                        for relation in scans
+                        if relation in sizes
+                        and sizes[relation][1] >= args.large_table_rows
+                        and sizes[relation][0] not in case.allow_seq_scan
+                    ]
+                    before = baseline.get(key)
+                    problems += compare(metrics, before, args.tolerance)
+                    status = "; ".join(problems) or ("new" if before is None else "ok")
+                    if before is not None and before.get("statement_hash") != results[key]["statement_hash"]:
+                        status += " (query changed)"
+                    failures += bool(problems)
+                    print(
+                        f"{key:<34} {metrics['total_cost']:>10.1f} {metrics['rows']:>10} {metrics['buffers']:>8}"
+                        f" {metrics['execution_ms']:>8.2f}  {status}"
+                    )
+                    if args.plans_dir:
+                        with open(os.path.join(args.plans_dir, f"{key}.json"), "w") as f:
+                            json.dump({"statement": statement, "plan": plan}, f, indent=2, default=str)
+    finally:
+        await dbsm.close()
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"wrote {len(results)} queries to {args.baseline}")
+        return 0
+    print(f"{failures} of {len(results)} queries regressed")
+    return 1 if failures else 0
+
+
+async def _run_seed(args):
+    dbsm = DatabaseSessionManager(get_database_url())
+    try:
+        await seed(dbsm, args.users, args.contests, args.questions, args.participation)
+    finally:
+        await dbsm.close()
+    print(f"seeded {args.users} users and {args.contests} contests of {args.questions} questions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["seed", "check"])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--contests", type=int, default=8)
+    parser.add_argument("--questions", type=int, default=40, help="コンテストあたりの問題数")
+    parser.add_argument("--participation", type=int, default=60, help="各コンテストに参加するユーザーの割合 (%%)")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="今回の結果をベースラインとして書き出す")
+    parser.add_argument("--tolerance", type=float, default=2.0, help="ベースラインの何倍までの増加を許すか")
+    parser.add_argument("--large-table-rows", type=int, default=10000, help="Seq Scan を許さないテーブルの行数")
+    parser.add_argument("--plans-dir", help="実行計画 (JSON) を書き出すディレクトリ")
+    args = parser.parse_args()
+    if args.command == "seed":
+        asyncio.run(_run_seed(args))
+    else:
+        sys.exit(asyncio.run(check(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from fastapi import HTTPException
+
+from config import rate_limit_settings
+from logger_config import logger
+
+# 1 スロット = (key hash, 残りトークン, 最終更新時刻)
+_SLOT = struct.Struct("<Qdd")
+# 同じ stripe 内だけを探索し、stripe 単位でファイルロックを取る
+_STRIPE_SLOTS = 8
+
+
+class SharedTokenBucket:
+    """gunicorn の全 worker で共有されるトークンバケット
+
+    状態は tmpfs 上のファイルを mmap した固定長ハッシュテーブルに置く。
+    チェック 1 回あたりのコストはロック 2 回の syscall と struct の読み書きだけで、
+    DB への問い合わせは発生しない。"""
+
+    def __init__(self, name: str, rate: float, capacity: int, slots: int = 16384, directory: Optional[str] = None):
+        self.name = name
+        self.rate = rate
+        self.capacity = float(capacity)
+        self._stripes = max(1, slots // _STRIPE_SLOTS)
+        self._directory = directory
+        self._fd = None
+        self._mm = None
+        self._pid = None
+        # fcntl のロックはプロセス単位なので、スレッド間はこちらで排他する
+        self._thread_lock = threading.Lock()
+
+    def _path(self) -> str:
+        directory = self._directory
+        if not directory or not os.path.isdir(directory):
+            directory = tempfile.gettempdir()
+        return os.path.join(directory, f"rag_contest_ratelimit_{self.name}")
+
+    def _open(self):
+        # fork 後の worker ごとに開き直す
+        if self._mm is not None and self._pid == os.getpid():
+            return
+        size = self._stripes * _STRIPE_SLOTS * _SLOT.size
+        fd = os.open(self._path(), os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        self._fd = fd
+        self._mm = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        # 0 は空きスロットを表すので使わない
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    def acquire(self, key: str, cost: float = 1.0) -> float:
+        """トークンを消費できれば 0 を、できなければ再試行までの秒数を返す"""
+        key_hash = self._hash(key)
+        stripe = key_hash % self._stripes
+        offset = stripe * _STRIPE_SLOTS * _SLOT.size
+        length = _STRIPE_SLOTS * _SLOT.size
+        now = time.monotonic()
+
+        with self._thread_lock:
+            self._open()
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                slot_offset, tokens, updated = self._find_slot(key_hash, offset, now)
+                tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+                if tokens >= cost:
+                    tokens -= cost
+                    wait = 0.0
+                else:
+                    wait = (cost - tokens) / self.rate if self.rate > 0 else math.inf
+                _SLOT.pack_into(self._mm, slot_offset, key_hash, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+        return wait
+
+    def _find_slot(self, key_hash: int, offset: int, now: float):
+        victim = None
+        victim_updated = math.inf
+        for i in range(_STRIPE_SLOTS):
+            slot_offset = offset + i * _SLOT.size
+            slot_hash, tokens, updated = _SLOT.unpack_from(self._mm, slot_offset)
+            if slot_hash == key_hash:
+                return slot_offset, tokens, updated
+            if slot_hash == 0:
+                return slot_offset, self.capacity, now
+            if updated < victim_updated:
+                victim, victim_updated = slot_offset, updated
+        # stripe が埋まっていたら最も古いバケットを追い出す(満タン扱いで作り直す)
+        return victim, self.capacity, now
+
+
+submission_bucket = SharedTokenBucket(
+    "submit",
+    rate=rate_limit_settings.SUBMIT_RATE_PER_SEC,
+    capacity=rate_limit_settings.SUBMIT_BURST,
+    slots=rate_limit_settings.RATE_LIMIT_SLOTS,
+    directory=rate_limit_settings.RATE_LIMIT_DIR,
+)
+auth_bucket = SharedTokenBucket(
+    "auth",
+    rate=rate_limit_settings.AUTH_RATE_PER_SEC,
+    capacity=rate_limit_settings.AUTH_BURST,
+    slots=rate_limit_settings.RATE_LIMIT_SLOTS,
+    directory=rate_limit_settings.RATE_LIMIT_DIR,
+)
+
+
+def enforce_rate_limit(bucket: SharedTokenBucket, key: str):
+    if not rate_limit_settings.RATE_LIMIT_ENABLED:
+        return
+    wait = bucket.acquire(key)
+    if wait > 0:
+        retry_after = max(1, math.ceil(wait))
+        logger.info(f"rate limited: bucket={bucket.name} retry_after={retry_after}")
+        raise HTTPException(
+            status_code=429,
+            detail="Too Many Requests",
+            headers={"Retry-After": str(retry_after)},
+        )
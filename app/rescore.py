@@ -0,0 +1,317 @@
+"""コンテストの回答をまとめて採点し直す (しきい値や埋め込みを変えたとき)
+
+提出回答の埋め込みは UserAnswer に保存したものを使い、無い回答 (保存を始める前の回答) や --reembed を
+付けたときだけ、まとめて埋め込み API を呼ぶ。類似度は回答のチャンクごとに行列演算で計算し、
+similarity / is_correct は 1 チャンク 1 文の UPDATE で書き戻す。最後に ContestResult を集計し直して、
+合否・正解数・順位がどう変わったかを表示する。採点待ち (similarity IS NULL) の回答は対象外。
+
+    python rescore.py <contest_id> [--threshold 0.93] [--option-threshold 0.999] [--reembed] [--dry-run]
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import scoring_settings
+from database import DatabaseSessionManager, get_database_url
+from embedding_api_client import OpenAIClient
+from logger_config import logger
+from model import Contest, ContestResult, Question, UserAnswer
+from validate import request_dimensions, stored_answer_embedding
+from vector_store import load_right_answer_vectors
+
+_UPDATE_ANSWERS = text(
+    """
+    UPDATE user_answer AS u
+    SET similarity = v.similarity, is_correct = v.is_correct
+    FROM unnest(CAST(:ids AS integer[]), CAST(:similarities AS float8[]), CAST(:flags AS boolean[]))
+        AS v(id, similarity, is_correct)
+    WHERE u.contest_id = :contest_id AND u.id = v.id
+    """
+)
+
+# 全問採点済みで結果のあるユーザーだけ集計し直す (update_contest_progress と同じ集計)
+_UPDATE_RESULTS = text(
+    """
+    UPDATE contest_result AS r
+    SET number_of_correct_answers = a.number_of_correct_answers, time_ms = a.time_ms
+    FROM (
+        SELECT user_id, count(*) FILTER (WHERE is_correct) AS number_of_correct_answers, sum(time_taken_ms) AS time_ms
+        FROM user_answer
+        WHERE contest_id = :contest_id
+        GROUP BY user_id
+    ) AS a
+    WHERE r.contest_id = :contest_id AND r.user_id = a.user_id
+    """
+)
+
+
+def _ranks(results: dict[int, tuple[int, int]]) -> dict[int, int]:
+    # 正解数の多い順、同数なら合計時間の短い順 (同じ成績は同順位)
+    ordered = sorted(results.items(), key=lambda item: (-item[1][0], item[1][1]))
+    ranks, previous = {}, None
+    for position, (user_id, score) in enumerate(ordered, start=1):
+        if score != previous:
+            rank, previous = position, score
+        ranks[user_id] = rank
+    return ranks
+
+
+async def _load_results(session: AsyncSession, contest_id: int) -> dict[int, tuple[int, int]]:
+    result = await session.execute(
+        select(ContestResult.user_id, ContestResult.number_of_correct_answers, ContestResult.time_ms).where(
+            ContestResult.contest_id == contest_id
+        )
+    )
+    return {user_id: (correct, time_ms) for user_id, correct, time_ms in result.all()}
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class Rescorer:
+    def __init__(
+        self,
+        session: AsyncSession,
+        contest: Contest,
+        reembed: bool = False,
+        chunk_size: int = 5000,
+        batch_size: int = 512,
+        parallelism: int = 4,
+        retries: int = 3,
+        timeout: float = 60.0,
+    ):
+        self.session = session
+        self.contest = contest
+        self.reembed = reembed
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.parallelism = parallelism
+        self.retries = retries
+        self.timeout = timeout
+        self.dtype = np.dtype(scoring_settings.SCORING_DTYPE)
+        self.flips = []
+        self.embedded = 0
+        self.answers = 0
+        self._client = None
+
+    async def load_questions(self):
+        vectors = await load_right_answer_vectors(self.session, self.contest)
+        result = await self.session.execute(
+            select(Question).where(Question.contest_id == self.contest.id).order_by(Question.id)
+        )
+        rows = [(question, vectors[question.id]) for question in result.scalars().all() if question.id in vectors]
+        if not rows:
+            raise SystemExit(
+                f"Contest {self.contest.id} has no right answer embeddings for {self.contest.embedding_version}"
+            )
+        self.queries = {question.id: question.query for question, _ in rows}
+        self.row_of_question = {question.id: row for row, (question, _) in enumerate(rows)}
+        self.right_matrix = _normalize(np.asarray([vector for _, vector in rows], dtype=self.dtype))
+        self.has_options = np.array([question.number_of_options > 0 for question, _ in rows], dtype=bool)
+
+    def _embed_batch(self, batch: list[tuple[str, str]]) -> list[list]:
+        # 一時的な失敗 (429 や 5xx、応答しない接続) で全体を止めないよう、バッチごとに待ってから送り直す
+        for attempt in range(self.retries + 1):
+            try:
+                return self._client.get_embeddings(
+                    batch,
+                    self.timeout,
+                    request_dimensions(self.contest),
+                    self.contest.embedding_prompt_version,
+                )
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"rescore batch failed ({e!r}), retrying")
+                time.sleep(random.uniform(0, 2**attempt))
+
+    def _embed(self, query_answers: list[tuple[str, str]]) -> np.ndarray:
+        if self._client is None:
+            # リトライは _embed_batch で行う
+            self._client = OpenAIClient(self.contest.embedding_model, timeout=self.timeout, max_retries=0)
+        batches = [
+            query_answers[start : start + self.batch_size] for start in range(0, len(query_answers), self.batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            embedded = executor.map(self._embed_batch, batches)
+            vectors = [vector for batch in embedded for vector in batch]
+        return np.asarray(vectors, dtype=np.float32)
+
+    async def _user_vectors(self, answers: list[UserAnswer]) -> np.ndarray:
+        # 有効なバージョンと違うモデル・プロンプトで埋め込んだものは使えない
+        version = self.contest.embedding_version
+        vectors = [None if self.reembed else answer.get_embedding(version) for answer in answers]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            query_answers = [(self.queries[answers[i].question_id], answers[i].answer) for i in missing]
+            embedded = await asyncio.to_thread(self._embed, query_answers)
+            self.embedded += len(missing)
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+                # 次回以降は保存した埋め込みを使う
+                for column, value in stored_answer_embedding(self.contest, vector).items():
+                    setattr(answers[i], column, value)
+        return np.asarray(vectors, dtype=self.dtype)
+
+    async def rescore_chunk(self, answers: list[UserAnswer]):
+        answers = [answer for answer in answers if answer.question_id in self.row_of_question]
+        if not answers:
+            return
+        rows = np.array([self.row_of_question[answer.question_id] for answer in answers])
+        user_matrix = _normalize(await self._user_vectors(answers))
+        similarities = np.einsum("ij,ij->i", user_matrix, self.right_matrix[rows]).astype(np.float64)
+        passes = np.where(
+            self.has_options[rows],
+            similarities >= self.contest.option_threshold,
+            similarities >= self.contest.similarity_threshold,
+        )
+
+        for answer, similarity, passing in zip(answers, similarities, passes):
+            if bool(answer.is_correct) != bool(passing):
+                self.flips.append(
+                    (answer.id, answer.user_id, answer.question_id, answer.similarity, similarity, bool(passing))
+                )
+        # 埋め込みを付け足した回答は ORM で、採点結果は 1 文でまとめて書く
+        await self.session.flush()
+        await self.session.execute(
+            _UPDATE_ANSWERS,
+            {
+                "ids": [answer.id for answer in answers],
+                "similarities": similarities.tolist(),
+                "flags": passes.tolist(),
+                "contest_id": self.contest.id,
+            },
+        )
+        self.answers += len(answers)
+
+    async def run(self, commit: bool = True) -> dict:
+        await self.load_questions()
+        before = await _load_results(self.session, self.contest.id)
+
+        last_id = 0
+        while True:
+            result = await self.session.execute(
+                select(UserAnswer)
+                .where(
+                    (UserAnswer.contest_id == self.contest.id)
+                    & (UserAnswer.id > last_id)
+                    & UserAnswer.similarity.is_not(None)
+                )
+                .order_by(UserAnswer.id)
+                .limit(self.chunk_size)
+            )
+            answers = result.scalars().all()
+            if not answers:
+                break
+            last_id = answers[-1].id
+            await self.rescore_chunk(answers)
+            if commit:
+                await self.session.commit()
+            # チャンクごとに ORM のオブジェクトを手放す
+            self.session.expunge_all()
+            print(f"  rescored {self.answers} answers (embedded {self.embedded})")
+
+        await self.session.execute(_UPDATE_RESULTS, {"contest_id": self.contest.id})
+        after = await _load_results(self.session, self.contest.id)
+        if commit:
+            await self.session.commit()
+        else:
+            await self.session.rollback()
+        return {"before": before, "after": after}
+
+
+def print_report(contest: Contest, rescorer: Rescorer, results: dict, elapsed: float, show: int):
+    before, after = results["before"], results["after"]
+    rank_before, rank_after = _ranks(before), _ranks(after)
+    fail_to_pass = sum(1 for flip in rescorer.flips if flip[-1])
+    print(f"contest: {contest.id} {contest.name}")
+    print(f"  thresholds: free text {contest.similarity_threshold} / options {contest.option_threshold}")
+    print(f"  answers rescored: {rescorer.answers}  re-embedded: {rescorer.embedded}  elapsed: {elapsed:.1f}s")
+    print(
+        f"  decisions changed: {len(rescorer.flips)} "
+        f"(fail->pass {fail_to_pass}, pass->fail {len(rescorer.flips) - fail_to_pass})"
+    )
+    for answer_id, user_id, question_id, old, new, passing in rescorer.flips[:show]:
+        print(
+            f"    answer {answer_id} user {user_id} question {question_id}: "
+            f"{old:.5f} -> {new:.5f} ({'pass' if passing else 'fail'})"
+        )
+
+    changed = [
+        user_id
+        for user_id in after
+        if before.get(user_id) != after[user_id] or rank_before.get(user_id) != rank_after[user_id]
+    ]
+    print(f"  results changed: {len(changed)} of {len(after)}")
+    changed.sort(key=lambda user_id: rank_after[user_id])
+    for user_id in changed[:show]:
+        (old_correct, _), (new_correct, _) = before[user_id], after[user_id]
+        print(
+            f"    user {user_id}: correct {old_correct} -> {new_correct}, "
+            f"rank {rank_before[user_id]} -> {rank_after[user_id]}"
+        )
+
+
+async def rescore_contest(args) -> None:
+    dbsm = DatabaseSessionManager(get_database_url())
+    try:
+        async with dbsm.session() as session:
+            result = await session.execute(select(Contest).where(Contest.id == args.contest_id))
+            contest = result.scalars().first()
+            if contest is None:
+                raise SystemExit(f"Contest {args.contest_id} not found")
+            if args.threshold is not None:
+                contest.similarity_threshold = args.threshold
+            if args.option_threshold is not None:
+                contest.option_threshold = args.option_threshold
+            # しきい値の変更は最初のチャンクと一緒にコミットされる (--dry-run では巻き戻す)
+            await session.flush()
+            # チャンクごとのコミットで期限切れにならないよう、読み込んだ値のまま切り離して使う
+            session.expunge(contest)
+
+            started = time.monotonic()
+            rescorer = Rescorer(
+                session,
+                contest,
+                reembed=args.reembed,
+                chunk_size=args.chunk_size,
+                batch_size=args.batch_size,
+                parallelism=args.parallelism,
+                retries=args.retries,
+                timeout=args.timeout,
+            )
+            results = await rescorer.run(commit=not args.dry_run)
+            print_report(contest, rescorer, results, time.monotonic() - started, args.show)
+            if args.dry_run:
+                print("  dry run: nothing was written")
+    finally:
+        await dbsm.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("contest_id", type=int)
+    parser.add_argument("--threshold", type=float, help="自由記述の合格しきい値を変更する")
+    parser.add_argument("--option-threshold", type=float, help="選択式の合格しきい値を変更する")
+    parser.add_argument("--reembed", action="store_true", help="保存した埋め込みを使わずに埋め込み直す")
+    parser.add_argument("--dry-run", action="store_true", help="差分を表示するだけで書き込まない")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=512, help="埋め込み API 1 リクエストあたりの回答数")
+    parser.add_argument("--parallelism", type=int, default=4, help="同時に送る埋め込みリクエスト数")
+    parser.add_argument("--retries", type=int, default=3, help="失敗した埋め込みリクエストを送り直す回数")
+    parser.add_argument("--timeout", type=float, default=60.0, help="埋め込みリクエスト 1 回のタイムアウト (秒)")
+    parser.add_argument("--show", type=int, default=20, help="表示する変更の件数")
+    asyncio.run(rescore_contest(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""検証済みのレスポンスモデルを、検証し直さずに JSON にするレスポンス
+
+FastAPI は response_model のあるエンドポイントが返したモデルを、いったん辞書に戻して検証し直してから JSON にする。
+ModelResponse で返すと、モデルを作ったときの 1 回の検証だけで、pydantic-core のシリアライザが直接 JSON のバイト列を作る。
+エンドポイントの response_model は OpenAPI のスキーマのために残しておく (Response を返すと FastAPI は使わない)。
+"""
+
+from typing import Any, Mapping, Optional
+
+from pydantic import TypeAdapter
+from starlette.responses import Response
+
+
+class ModelResponse(Response):
+    media_type = "application/json"
+
+    def __init__(
+        self,
+        content: Any,
+        status_code: int = 200,
+        headers: Optional[Mapping[str, str]] = None,
+        adapter: Optional[TypeAdapter] = None,
+    ):
+        # モデルのリストなどは、起動時に作っておいた TypeAdapter で書き出す
+        self.adapter = adapter
+        super().__init__(content, status_code, headers)
+
+    def render(self, content: Any) -> bytes:
+        if self.adapter is not None:
+            return self.adapter.dump_json(content)
+        return content.__pydantic_serializer__.to_json(content)
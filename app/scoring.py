@@ -0,0 +1,179 @@
+"""回答の採点と、コンテストの完了判定
+
+`SCORING_MODE=deferred` (またはリクエストの `Prefer: respond-async`) では、提出は採点せずに保存して 202 を返し、
+ScoringPool が後から similarity / is_correct を埋める。採点待ちの行は `similarity IS NULL` で判別し、
+`FOR UPDATE SKIP LOCKED` で取り合うので、複数の worker やプロセスでプールを動かしても同じ回答を二重に採点しない。
+
+専用プロセスで動かす場合は `SCORING_POOL_IN_APP=false` にして `python scoring.py` を起動する。
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import scoring_settings
+from database import DatabaseSessionManager, get_session_manager
+from logger_config import logger
+from model import ContestResult, Question, UserAnswer
+from validate import UserAnswerScorer
+
+
+async def update_contest_progress(session: AsyncSession, user_id: int, contest_id: int) -> list[int]:
+    """未回答の問題 id を返す。全問回答済みで採点も終わっていれば ContestResult を作る
+
+    回答の行 (埋め込みを含む) は読み込まず、未回答の問題と合計を SQL で求める"""
+    answered = (
+        select(UserAnswer.id)
+        .where(
+            (UserAnswer.contest_id == contest_id)
+            & (UserAnswer.user_id == user_id)
+            & (UserAnswer.question_id == Question.id)
+        )
+        .exists()
+    )
+    result = await session.execute(
+        select(Question.id).where((Question.contest_id == contest_id) & ~answered).order_by(Question.id)
+    )
+    answers_remain = list(result.scalars().all())
+    if answers_remain:
+        return answers_remain
+
+    result = await session.execute(
+        select(
+            func.count().filter(UserAnswer.similarity.is_(None)).label("pending"),
+            func.count().filter(UserAnswer.is_correct).label("correct"),
+            func.coalesce(func.sum(UserAnswer.time_taken_ms), 0).label("total_time_ms"),
+        ).where((UserAnswer.contest_id == contest_id) & (UserAnswer.user_id == user_id))
+    )
+    totals = result.one()
+    if totals.pending:
+        return answers_remain
+
+    # 既に結果があれば何もしない (uq_user_contest_result)
+    await session.execute(
+        insert(ContestResult)
+        .values(
+            user_id=user_id,
+            contest_id=contest_id,
+            number_of_correct_answers=totals.correct,
+            time_ms=totals.total_time_ms,
+        )
+        .on_conflict_do_nothing(constraint="uq_user_contest_result")
+    )
+    await session.commit()
+    return answers_remain
+
+
+async def score_pending_answer(session: AsyncSession, answer_id: int, contest_id: int) -> bool:
+    """採点待ちの回答を 1 件採点する。他で採点中・採点済みなら False"""
+    result = await session.execute(
+        select(UserAnswer)
+        .where(
+            (UserAnswer.id == answer_id)
+            & (UserAnswer.contest_id == contest_id)
+            & UserAnswer.similarity.is_(None)
+        )
+        .with_for_update(skip_locked=True)
+    )
+    answer = result.scalars().first()
+    if answer is None:
+        await session.rollback()
+        return False
+
+    uas = await UserAnswerScorer.create(answer.user_id, answer.question_id, session, answer.time_taken_ms)
+    # 埋め込み API は同期クライアントなのでイベントループを止めないようスレッドで呼ぶ
+    score = await asyncio.to_thread(uas.get_score, answer.answer)
+    answer.similarity = score
+    answer.is_correct = uas.is_correct(score)
+    for column, value in uas.stored_embedding().items():
+        setattr(answer, column, value)
+    user_id = answer.user_id
+    await session.commit()
+
+    await update_contest_progress(session, user_id, contest_id)
+    return True
+
+
+class ScoringPool:
+    """採点待ちの回答を非同期に採点するタスク群"""
+
+    def __init__(self, dbsm: Optional[DatabaseSessionManager] = None, concurrency: int = 4):
+        self._dbsm = dbsm
+        self._concurrency = concurrency
+        self._queue: asyncio.Queue[tuple[int, int]] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def dbsm(self) -> DatabaseSessionManager:
+        return self._dbsm or get_session_manager()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self._concurrency)]
+        self._tasks.append(asyncio.create_task(self._sweep()))
+        logger.info(f"Scoring pool started with {self._concurrency} tasks")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, answer_id: int, contest_id: int):
+        self._queue.put_nowait((answer_id, contest_id))
+
+    async def _consume(self):
+        while True:
+            answer_id, contest_id = await self._queue.get()
+            try:
+                async with self.dbsm.session() as session:
+                    await score_pending_answer(session, answer_id, contest_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 行は採点待ちのまま残るので、次の sweep で再試行される
+                logger.error(f"Error scoring answer {answer_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _sweep(self):
+        # キューに入らなかった採点待ち (他の worker の再起動など) を拾う
+        interval = scoring_settings.SCORING_SWEEP_INTERVAL_SECONDS
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                submitted_before = datetime.now() - timedelta(seconds=interval)
+                async with self.dbsm.session() as session:
+                    result = await session.execute(
+                        select(UserAnswer.id, UserAnswer.contest_id)
+                        .where(UserAnswer.similarity.is_(None) & (UserAnswer.submitted_at < submitted_before))
+                        .order_by(UserAnswer.id)
+                        .limit(self._concurrency * 16)
+                    )
+                    pending = result.all()
+                if self._queue.empty():
+                    for answer_id, contest_id in pending:
+                        self.submit(answer_id, contest_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error sweeping pending answers: {e}")
+
+
+scoring_pool = ScoringPool(concurrency=scoring_settings.SCORING_CONCURRENCY)
+
+
+async def run_standalone():
+    scoring_pool.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await scoring_pool.stop()
+        await get_session_manager().close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_standalone())
@@ -0,0 +1,246 @@
+"""ダッシュボード向けの集計 (ユーザーの回答履歴は Python に読み込まず SQL で集計する)
+
+主催者向けの問題ごとの集計 (類似度のヒストグラム・正答率・回答時間のパーセンタイル・多い誤答) は
+コンテストごとに worker 内にキャッシュし、前回集計した回答 id より後の採点済みの回答だけを足し込む。
+採点待ちの回答がある間は、その手前までしか集計済みにしない (後から採点されても数え漏れ・二重計上がない)。
+id は INSERT の時点で振られ、コミットの順とは前後するので、ANALYTICS_COMMIT_MARGIN_SECONDS より前に
+提出された回答の id までに限る (それより小さい id の回答はさらに前に INSERT されていて、コミット済みになっている)。
+"""
+
+import asyncio
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import analytics_settings
+from model import Question
+
+# 参加したコンテスト (問題をダウンロードしたか回答した) ごとの進み具合と順位を 1 回の問い合わせで返す。
+# 順位は結果の出たユーザーの中での rank() で、/results と同じく正解数の多い順 (同数なら合計時間の短い順)
+_USER_STATS = text(
+    """
+    WITH answered AS (
+        SELECT
+            contest_id,
+            -- 同じ問題への再提出は 1 問と数える (update_contest_progress の未回答の判定と同じ)
+            count(DISTINCT question_id) AS answered,
+            count(*) FILTER (WHERE is_correct) AS correct,
+            count(*) FILTER (WHERE similarity IS NULL) AS pending,
+            sum(time_taken_ms) AS total_time_ms
+        FROM user_answer
+        WHERE user_id = :user_id
+        GROUP BY contest_id
+    ),
+    participated AS (
+        SELECT contest_id FROM answered
+        UNION
+        SELECT contest_id FROM contest_first_downloaded WHERE user_id = :user_id
+    ),
+    ranked AS (
+        SELECT
+            contest_id,
+            user_id,
+            rank() OVER (
+                PARTITION BY contest_id ORDER BY number_of_correct_answers DESC, time_ms
+            ) AS rank,
+            count(*) OVER (PARTITION BY contest_id) AS participants
+        FROM contest_result
+        WHERE contest_id IN (SELECT contest_id FROM participated)
+    )
+    SELECT
+        c.id AS contest_id,
+        c.name AS contest_name,
+        c.status AS status,
+        c.number_of_questions AS number_of_questions,
+        coalesce(a.answered, 0) AS answered,
+        coalesce(a.correct, 0) AS correct,
+        coalesce(a.pending, 0) AS pending,
+        coalesce(a.total_time_ms, 0) AS total_time_ms,
+        r.rank AS rank,
+        r.participants AS participants
+    FROM participated p
+    JOIN contest c ON c.id = p.contest_id
+    LEFT JOIN answered a ON a.contest_id = p.contest_id
+    LEFT JOIN ranked r ON r.contest_id = p.contest_id AND r.user_id = :user_id
+    ORDER BY c.id
+    """
+)
+
+
+async def get_user_stats(session: AsyncSession, user_id: int) -> list[dict]:
+    result = await session.execute(_USER_STATS, {"user_id": user_id})
+    stats = []
+    for row in result.mappings().all():
+        row = dict(row)
+        row["remaining"] = max(row["number_of_questions"] - row["answered"], 0)
+        stats.append(row)
+    return stats
+
+
+# 集計してよい回答 id の上限 (horizon より前に提出された最大の id。採点待ちがあればその最小の id の手前まで)
+_ANALYTICS_UPPER_BOUND = text(
+    """
+    SELECT least(
+        (SELECT min(id) - 1 FROM user_answer WHERE contest_id = :contest_id AND similarity IS NULL),
+        coalesce(
+            (SELECT max(id) FROM user_answer WHERE contest_id = :contest_id AND submitted_at < :horizon),
+            0
+        )
+    )
+    """
+)
+
+_QUESTION_TOTALS = text(
+    """
+    SELECT question_id, count(*) AS answers, count(*) FILTER (WHERE is_correct) AS correct, sum(similarity) AS total
+    FROM user_answer
+    WHERE contest_id = :contest_id AND id > :after AND id <= :upto
+    GROUP BY question_id
+    """
+)
+
+# バケット 0 は 0 未満、bins + 1 は 1 以上
+_SIMILARITY_HISTOGRAM = text(
+    """
+    SELECT question_id, width_bucket(similarity, 0, 1, :bins) AS bucket, count(*) AS answers
+    FROM user_answer
+    WHERE contest_id = :contest_id AND id > :after AND id <= :upto
+    GROUP BY question_id, bucket
+    """
+)
+
+_WRONG_ANSWERS = text(
+    """
+    SELECT question_id, lower(btrim(answer)) AS answer, count(*) AS answers
+    FROM user_answer
+    WHERE contest_id = :contest_id AND id > :after AND id <= :upto AND NOT is_correct
+    GROUP BY question_id, lower(btrim(answer))
+    """
+)
+
+_TIMES_TAKEN = text(
+    """
+    SELECT question_id, time_taken_ms
+    FROM user_answer
+    WHERE contest_id = :contest_id AND id > :after AND id <= :upto
+    """
+)
+
+
+class ContestAnalytics:
+    """1 コンテスト分の足し込み可能な集計"""
+
+    def __init__(self, contest_id: int, bins: int):
+        self.contest_id = contest_id
+        self.bins = bins
+        self.lock = asyncio.Lock()
+        self.reset()
+
+    def reset(self):
+        self.watermark = 0
+        self.refreshed_at = 0.0
+        self.reset_at = time.monotonic()
+        self.answers = Counter()
+        self.correct = Counter()
+        self.similarity_total = defaultdict(float)
+        self.histograms = defaultdict(lambda: np.zeros(self.bins + 2, dtype=np.int64))
+        self.wrong_answers = defaultdict(Counter)
+        self.times = defaultdict(list)
+
+    async def refresh(self, session: AsyncSession, full: bool = False):
+        now = time.monotonic()
+        if full or now - self.reset_at > analytics_settings.ANALYTICS_FULL_REFRESH_SECONDS:
+            self.reset()
+        elif now - self.refreshed_at < analytics_settings.ANALYTICS_REFRESH_SECONDS:
+            return
+
+        params = {"contest_id": self.contest_id, "after": self.watermark}
+        # submitted_at は API サーバーの時計で入るので、こちらも DB ではなく API サーバーの時計で決める
+        horizon = datetime.now() - timedelta(seconds=analytics_settings.ANALYTICS_COMMIT_MARGIN_SECONDS)
+        params["upto"] = (await session.execute(_ANALYTICS_UPPER_BOUND, {**params, "horizon": horizon})).scalar_one()
+        if params["upto"] > self.watermark:
+            for row in (await session.execute(_QUESTION_TOTALS, params)).all():
+                self.answers[row.question_id] += row.answers
+                self.correct[row.question_id] += row.correct
+                self.similarity_total[row.question_id] += row.total
+            for row in (await session.execute(_SIMILARITY_HISTOGRAM, {**params, "bins": self.bins})).all():
+                self.histograms[row.question_id][row.bucket] += row.answers
+            for row in (await session.execute(_WRONG_ANSWERS, params)).all():
+                self.wrong_answers[row.question_id][row.answer] += row.answers
+            rows = (await session.execute(_TIMES_TAKEN, params)).all()
+            if rows:
+                question_ids = np.array([row.question_id for row in rows])
+                times = np.array([row.time_taken_ms for row in rows], dtype=np.int64)
+                for question_id in np.unique(question_ids):
+                    self.times[int(question_id)].append(times[question_ids == question_id])
+            self.watermark = params["upto"]
+        self.refreshed_at = now
+
+    def question_report(self, question_id: int, top_wrong_answers: int) -> dict:
+        answers = self.answers[question_id]
+        histogram = self.histograms[question_id]
+        # 1 以上 (丸め誤差で 1 をわずかに超えるもの) は最後のビンに入れる
+        counts = histogram[1 : self.bins + 1].copy()
+        counts[-1] += histogram[self.bins + 1]
+        chunks = self.times[question_id]
+        if len(chunks) > 1:
+            # 次回以降は連結済みの配列を使う
+            chunks[:] = [np.concatenate(chunks)]
+        time_taken_ms = {"p50": None, "p90": None, "p99": None}
+        if chunks:
+            time_taken_ms = dict(zip(time_taken_ms, np.percentile(chunks[0], [50, 90, 99]).tolist()))
+        return {
+            "answers": answers,
+            "pass_rate": self.correct[question_id] / answers if answers else None,
+            "mean_similarity": self.similarity_total[question_id] / answers if answers else None,
+            "similarity_histogram": {
+                "below_zero": int(histogram[0]),
+                "edges": np.linspace(0, 1, self.bins + 1).round(6).tolist(),
+                "counts": counts.tolist(),
+            },
+            "time_taken_ms": time_taken_ms,
+            "common_wrong_answers": [
+                {"answer": answer, "count": count}
+                for answer, count in self.wrong_answers[question_id].most_common(top_wrong_answers)
+            ],
+        }
+
+
+_analytics: dict[tuple[int, int], ContestAnalytics] = {}
+
+
+async def get_contest_analytics(
+    session: AsyncSession,
+    contest_id: int,
+    bins: int = analytics_settings.ANALYTICS_BINS,
+    top_wrong_answers: int = 5,
+    full: bool = False,
+) -> dict:
+    analytics = _analytics.get((contest_id, bins))
+    if analytics is None:
+        analytics = _analytics[(contest_id, bins)] = ContestAnalytics(contest_id, bins)
+    # 同じ worker で同時に来たリクエストは 1 回の集計を待つ
+    async with analytics.lock:
+        await analytics.refresh(session, full)
+    result = await session.execute(
+        select(Question.id, Question.query, Question.number_of_options)
+        .where(Question.contest_id == contest_id)
+        .order_by(Question.id)
+    )
+    return {
+        "contest_id": contest_id,
+        "as_of_answer_id": analytics.watermark,
+        "questions": [
+            {
+                "question_id": row.id,
+                "query": row.query,
+                "number_of_options": row.number_of_options,
+                **analytics.question_report(row.id, top_wrong_answers),
+            }
+            for row in result.all()
+        ],
+    }
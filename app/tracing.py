@@ -0,0 +1,173 @@
+"""リクエスト内の処理段階ごとの所要時間の計測と、リクエスト単位のサンプリングプロファイル
+
+`with span("embedding"):` で囲んだ区間と DB の問い合わせ (`instrument_engine`) の時間をリクエストごとに集め、
+`Server-Timing` ヘッダーで返す。TRACE_SLOW_REQUEST_MS を超えたリクエストは内訳をログに出す。
+
+管理者の API キーで `x-profile: 1` を付けたリクエスト (と TRACE_PROFILE_SAMPLE_RATE の割合で選んだリクエスト) は、
+処理中の全スレッドのスタックを TRACE_PROFILE_INTERVAL_MS ごとに採取し、畳み込んだスタック
+(flamegraph.pl / speedscope で読める形式) をログに出す。同じ worker で同時に処理中の別のリクエストも混ざる。
+"""
+
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event, select
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import tracing_settings
+from logger_config import logger
+from model import User
+
+PROFILE_HEADER_NAME = "x-profile"
+
+
+class Trace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        # 段階ごとの (合計 ms, 回数)
+        self.spans = defaultdict(lambda: [0.0, 0])
+
+    def add(self, name: str, duration_ms: float):
+        self.spans[name][0] += duration_ms
+        self.spans[name][1] += 1
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self) -> str:
+        entries = [f'{name};dur={total:.1f};desc="x{count}"' for name, (total, count) in self.spans.items()]
+        entries.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(entries)
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(name: str):
+    """現在のリクエストの段階として計測する (リクエストの外では何もしない)"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, (time.perf_counter() - started) * 1000)
+
+
+def instrument_engine(engine):
+    """問い合わせの時間を "db" の段階として数える"""
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._trace_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add("db", (time.perf_counter() - context._trace_started) * 1000)
+
+
+class SamplingProfiler:
+    """自分以外の全スレッドのスタックを一定間隔で採取する"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None and len(stack) < 64:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples[";".join([names.get(thread_id, str(thread_id)), *reversed(stack)])] += 1
+
+    def collapsed(self, limit: int = 200) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common(limit))
+
+
+async def _is_admin_api_key(api_key: Optional[str]) -> bool:
+    if not api_key:
+        return False
+    # 循環 import を避けるためここで読み込む
+    from database import get_session_manager
+
+    async with get_session_manager().session(read_only=True) as session:
+        result = await session.execute(select(User.is_admin).where(User.api_key == api_key))
+        return bool(result.scalar_one_or_none())
+
+
+class TracingMiddleware:
+    """リクエストごとに Trace を用意し、Server-Timing の付与・遅いリクエストのログ・プロファイルを行う"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not tracing_settings.TRACE_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace()
+        token = _current_trace.set(trace)
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        profiler = None
+        sampled = random.random() < tracing_settings.TRACE_PROFILE_SAMPLE_RATE
+        if sampled or (PROFILE_HEADER_NAME in headers and await _is_admin_api_key(headers.get("x-api-key"))):
+            profiler = SamplingProfiler(tracing_settings.TRACE_PROFILE_INTERVAL_MS / 1000)
+            profiler.start()
+
+        async def send_with_timing(message: Message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = [
+                    *message["headers"],
+                    (b"server-timing", trace.server_timing().encode("latin-1")),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_trace.reset(token)
+            elapsed_ms = trace.elapsed_ms()
+            request_line = f"{scope['method']} {scope['path']}"
+            if elapsed_ms >= tracing_settings.TRACE_SLOW_REQUEST_MS:
+                breakdown = ", ".join(
+                    f"{name}={total:.1f}ms/{count}" for name, (total, count) in trace.spans.items()
+                )
+                logger.warning(f"Slow request {request_line}: {elapsed_ms:.1f}ms ({breakdown})")
+            if profiler is not None:
+                profiler.stop()
+                logger.info(
+                    f"Profile of {request_line} ({elapsed_ms:.1f}ms, {sum(profiler.samples.values())} samples):\n"
+                    f"{profiler.collapsed()}"
+                )
@@ -1,6 +1,7 @@
 from datetime import timedelta, datetime, timezone
 from email.message import EmailMessage
 import os
+import secrets
 import smtplib
 from typing import Optional
 
@@ -27,6 +28,10 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+def generate_api_key() -> str:
+    return secrets.token_urlsafe(16)
+
+
 def format_millisec(milliseconds: int) -> str:
     # Convert milliseconds to seconds and microseconds
     seconds, millis = divmod(milliseconds, 1000)
@@ -1,5 +1,6 @@
 from datetime import datetime
 import json, time
+from typing import Optional
 
 import numpy as np
 from fastapi import FastAPI, Request, HTTPException, Body, Depends, Security
@@ -8,8 +9,10 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
 
 
+from config import scoring_settings
 from database import get_db_session
-from embedding_api_client import OpenAIClient
+from embedding_api_client import FULL_EMBEDDING_DIMENSIONS, get_embedding_client
+from vector_store import get_right_answer_vector, load_right_answer_vectors, schedule_vector_store_build
 from model import (
     Base,
     User,
@@ -24,44 +27,119 @@ from model import (
 )
 
 
+DEFAULT_THRESHOLD = 0.95
+OPTION_THRESHOLD = 0.999
+
+
+def cosine_similarity(a, b, dtype=np.float64) -> float:
+    a = np.asarray(a, dtype=dtype)
+    b = np.asarray(b, dtype=dtype)
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def is_passing(
+    similarity: float,
+    has_options: bool,
+    threshold: float = DEFAULT_THRESHOLD,
+    option_threshold: float = OPTION_THRESHOLD,
+) -> bool:
+    if has_options:
+        return similarity >= option_threshold
+    else:
+        return similarity >= threshold
+
+
+def reduce_embedding(vector, dimensions: int, dtype=np.float32) -> np.ndarray:
+    """先頭 dimensions 次元に切り詰めて正規化する (text-embedding-3 の dimensions 指定と同じ結果になる)"""
+    vector = np.asarray(vector, dtype=np.float64)[:dimensions]
+    return (vector / np.linalg.norm(vector)).astype(dtype)
+
+
+def request_dimensions(contest: Contest) -> Optional[int]:
+    # フルの次元数なら API には指定しない
+    if contest.embedding_dimensions and contest.embedding_dimensions < FULL_EMBEDDING_DIMENSIONS:
+        return contest.embedding_dimensions
+    return None
+
+
+def stored_embedding_columns(contest: Contest, vector, column: str = "text_embedding_3_small") -> dict:
+    """コンテストの保存精度に合わせて埋め込みの列を選ぶ (UserAnswer は column="embedding")"""
+    if contest.embedding_precision == "float16":
+        return {f"{column}_half": np.asarray(vector, dtype=np.float16)}
+    return {column: np.asarray(vector, dtype=np.float32)}
+
+
+def stored_answer_embedding(contest: Contest, vector) -> dict:
+    """UserAnswer に保存する提出回答の埋め込みと、そのバージョン"""
+    return {
+        **stored_embedding_columns(contest, vector, column="embedding"),
+        "embedding_version": contest.embedding_version,
+    }
+
+
 class UserAnswerScorer:
     def __init__(self, question: Question, time_taken_ms: int, right_answer_vector):
         self._query = question.query
         self._has_options = question.number_of_options > 0
-        self._right_answer = question.right_answer
         self._time_taken_ms = time_taken_ms
         self._right_answer_vector = right_answer_vector
-        self.threshold = 0.95
+        self._contest = question.contest
+        self._dimensions = request_dimensions(question.contest)
+        self._model = question.contest.embedding_model
+        self._prompt_version = question.contest.embedding_prompt_version
+        self._dtype = np.dtype(scoring_settings.SCORING_DTYPE)
+        self.threshold = question.contest.similarity_threshold
+        self.option_threshold = question.contest.option_threshold
+        self.embedding = None
 
     @classmethod
-    async def create(cls, user_id: int, question_id: int, session: AsyncSession):
+    async def create(cls, user_id: int, question_id: int, session: AsyncSession, time_taken_ms: Optional[int] = None):
         result = await session.execute(
-            select(Question).options(joinedload(Question.right_answer)).filter(Question.id == question_id)
+            select(Question).options(joinedload(Question.contest)).filter(Question.id == question_id)
         )
         question = result.scalars().first()
+        if time_taken_ms is None:
+            time_taken_ms = await cls.measure_time_taken_ms(user_id, question, session)
+
+        # 正解ベクトルは共有メモリのストアから読む。無ければ DB から読み、裏でストアを作る
+        right_answer_vector = get_right_answer_vector(
+            question.contest_id, question_id, question.contest.embedding_version
+        )
+        if right_answer_vector is None:
+            vectors = await load_right_answer_vectors(session, question.contest, [question_id])
+            right_answer_vector = vectors[question_id]
+            schedule_vector_store_build(question.contest_id)
+
+        return cls(question, time_taken_ms, right_answer_vector)
+
+    @staticmethod
+    async def measure_time_taken_ms(user_id: int, question: Question, session: AsyncSession) -> int:
+        """問題を最初にダウンロードしてから今までの経過時間"""
         result = await session.execute(
             select(QuestionFirstDownloaded)
+            .filter(QuestionFirstDownloaded.contest_id == question.contest_id)
             .filter(QuestionFirstDownloaded.user_id == user_id)
-            .filter(QuestionFirstDownloaded.question_id == question_id)
+            .filter(QuestionFirstDownloaded.question_id == question.id)
         )
         question_first_downloaded = result.scalars().first()
-        time_taken_ms = (int)((datetime.now() - question_first_downloaded.downloaded_at).total_seconds() * 1000)
-
-        return cls(question, time_taken_ms, question.right_answer.text_embedding_3_small)
+        return (int)((datetime.now() - question_first_downloaded.downloaded_at).total_seconds() * 1000)
 
     def get_score(self, user_answer: str) -> float:
-        embedding = OpenAIClient().get_embedding(self._query, user_answer)
-        self.similarity = self.__cosine_similarity(embedding, self._right_answer_vector)
+        embedding = get_embedding_client(self._model).get_embedding(
+            self._query, user_answer, self._dimensions, self._prompt_version
+        )
+        self.embedding = embedding
+        self.similarity = cosine_similarity(embedding, self._right_answer_vector, self._dtype)
         return self.similarity
 
     def is_correct(self, similarity: float) -> bool:
-        if self._has_options:
-            return similarity >= 0.999
-        else:
-            return similarity >= self.threshold
+        return is_passing(similarity, self._has_options, self.threshold, self.option_threshold)
+
+    def stored_embedding(self) -> dict:
+        """UserAnswer に保存する提出回答の埋め込み"""
+        if self.embedding is None:
+            return {}
+        return stored_answer_embedding(self._contest, self.embedding)
 
     def get_time(self):
         return self._time_taken_ms
-
-    def __cosine_similarity(self, a, b):
-        return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
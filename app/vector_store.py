@@ -0,0 +1,193 @@
+"""コンテストの正解ベクトルを gunicorn の全 worker で共有する読み取り専用ストア
+
+コンテストと埋め込みのバージョン (モデル@プロンプト) ごとに 1 ファイルで、question_id の昇順に並べた int64 の索引と、連続した float32 の行列を持つ。
+各 worker は np.memmap で読み取り専用にマップするだけなので、ページキャッシュ上の 1 コピーを共有し、
+worker 数や max_requests による再起動でメモリ使用量もウォームアップも増えない。
+
+ファイルはコンテストの登録時、サーバー起動時 (migrate.py)、backfill_embeddings.py で有効にしたときに作り、
+無ければ最初の採点時に DB から作る。有効なバージョンを切り替えると別のファイルを読むので、古いベクトルで採点することはない。
+
+    python vector_store.py build <contest_id> | --all
+"""
+
+import asyncio
+import glob
+import os
+import re
+import struct
+import sys
+import tempfile
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import vector_store_settings
+from database import DatabaseSessionManager, get_database_url, get_session_manager
+from logger_config import logger
+from model import Contest, ContestStatus, Question, QuestionEmbedding
+
+_MAGIC = b"RAGVEC01"
+# magic, 行数, 次元数
+_HEADER = struct.Struct("<8sQQ")
+_ALIGN = 64
+
+
+def _aligned(offset: int) -> int:
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def vector_store_path(contest_id: int, version: str) -> str:
+    version = re.sub(r"[^A-Za-z0-9._-]", "_", version)
+    return os.path.join(vector_store_settings.VECTOR_STORE_DIR, f"contest_{int(contest_id)}_{version}.vec")
+
+
+def write_vector_store(path: str, question_ids, vectors):
+    """書き込み中のファイルが見えないよう、一時ファイルに書いてから置き換える"""
+    order = np.argsort(np.asarray(question_ids, dtype=np.int64))
+    ids = np.asarray(question_ids, dtype=np.int64)[order]
+    matrix = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)[order])
+    ids_offset = _aligned(_HEADER.size)
+    matrix_offset = _aligned(ids_offset + ids.nbytes)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, len(ids), matrix.shape[1] if len(ids) else 0))
+            f.seek(ids_offset)
+            f.write(ids.tobytes())
+            f.seek(matrix_offset)
+            f.write(matrix.tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ContestVectorStore:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            magic, rows, dims = _HEADER.unpack(f.read(_HEADER.size))
+            stat = os.fstat(f.fileno())
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a vector store")
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+        self.dims = dims
+        ids_offset = _aligned(_HEADER.size)
+        matrix_offset = _aligned(ids_offset + rows * 8)
+        if rows:
+            self.ids = np.memmap(path, dtype=np.int64, mode="r", offset=ids_offset, shape=(rows,))
+            self.matrix = np.memmap(path, dtype=np.float32, mode="r", offset=matrix_offset, shape=(rows, dims))
+        else:
+            self.ids = np.empty(0, dtype=np.int64)
+            self.matrix = np.empty((0, 0), dtype=np.float32)
+
+    def get(self, question_id: int) -> Optional[np.ndarray]:
+        """コピーせずに共有ページ上の行を返す"""
+        row = int(np.searchsorted(self.ids, question_id))
+        if row < len(self.ids) and self.ids[row] == question_id:
+            return self.matrix[row]
+        return None
+
+
+_stores: dict[tuple[int, str], ContestVectorStore] = {}
+_building: set[int] = set()
+
+
+def get_contest_vector_store(contest_id: int, version: str) -> Optional[ContestVectorStore]:
+    path = vector_store_path(contest_id, version)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        _stores.pop((contest_id, version), None)
+        return None
+    store = _stores.get((contest_id, version))
+    # 作り直されていたらマップし直す
+    if store is None or store.identity != (stat.st_ino, stat.st_mtime_ns):
+        store = ContestVectorStore(path)
+        _stores[(contest_id, version)] = store
+    return store
+
+
+def get_right_answer_vector(contest_id: int, question_id: int, version: str) -> Optional[np.ndarray]:
+    store = get_contest_vector_store(contest_id, version)
+    return store.get(question_id) if store is not None else None
+
+
+async def load_right_answer_vectors(
+    session: AsyncSession, contest: Contest, question_ids: Optional[list[int]] = None
+) -> dict[int, np.ndarray]:
+    """コンテストで有効なバージョンの正解ベクトルを DB から読む"""
+    query = (
+        select(QuestionEmbedding)
+        .join(Question, Question.id == QuestionEmbedding.question_id)
+        .where(
+            (Question.contest_id == contest.id)
+            & (QuestionEmbedding.model == contest.embedding_model)
+            & (QuestionEmbedding.prompt_version == contest.embedding_prompt_version)
+        )
+    )
+    if question_ids is not None:
+        query = query.where(QuestionEmbedding.question_id.in_(question_ids))
+    result = await session.execute(query)
+    vectors = {embedding.question_id: embedding.get_vector() for embedding in result.scalars().all()}
+    return {question_id: vector for question_id, vector in vectors.items() if vector is not None}
+
+
+async def build_contest_vector_store(session: AsyncSession, contest_id: int):
+    result = await session.execute(select(Contest).where(Contest.id == contest_id))
+    contest = result.scalars().one()
+    version = contest.embedding_version
+    vectors = await load_right_answer_vectors(session, contest)
+    path = vector_store_path(contest_id, version)
+    await asyncio.to_thread(write_vector_store, path, list(vectors), list(vectors.values()))
+    # 切り替える前のバージョンのファイルを消す (マップ済みの worker はそのまま読める)
+    for old_path in glob.glob(os.path.join(vector_store_settings.VECTOR_STORE_DIR, f"contest_{int(contest_id)}_*.vec")):
+        if old_path != path:
+            os.unlink(old_path)
+    logger.info(f"Built vector store for contest {contest_id} {version} ({len(vectors)} vectors)")
+
+
+def schedule_vector_store_build(contest_id: int):
+    """採点時にストアが無かったときに裏で作る (この worker で作成中なら何もしない)"""
+    if contest_id in _building:
+        return
+    _building.add(contest_id)
+
+    async def build():
+        try:
+            async with get_session_manager().session(read_only=True) as session:
+                await build_contest_vector_store(session, contest_id)
+        except Exception as e:
+            logger.error(f"Error building vector store for contest {contest_id}: {e}")
+        finally:
+            _building.discard(contest_id)
+
+    asyncio.get_running_loop().create_task(build())
+
+
+async def build_live_contest_vector_stores(session: AsyncSession):
+    result = await session.execute(select(Contest.id).where(Contest.status != ContestStatus.Done))
+    for contest_id in result.scalars().all():
+        await build_contest_vector_store(session, contest_id)
+
+
+async def _run(argv: list[str]):
+    dbsm = DatabaseSessionManager(get_database_url())
+    try:
+        async with dbsm.session() as session:
+            if argv[1] == "--all":
+                await build_live_contest_vector_stores(session)
+            else:
+                await build_contest_vector_store(session, int(argv[1]))
+    finally:
+        await dbsm.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "build":
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(_run(sys.argv[1:]))
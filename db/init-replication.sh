@@ -0,0 +1,5 @@
+#!/bin/bash
+set -e
+
+# Allow streaming replication connections (used by compose.replica.yml only)
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -0,0 +1,14 @@
+#!/bin/bash
+set -e
+
+# Clone the primary once, then run as a hot standby
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+  until pg_isready -h "$PRIMARY_HOST" -U "$POSTGRES_USER"; do
+    sleep 1
+  done
+  rm -rf "${PGDATA:?}"/*
+  PGPASSWORD="$POSTGRES_PASSWORD" pg_basebackup -h "$PRIMARY_HOST" -U "$POSTGRES_USER" -D "$PGDATA" -R -X stream
+  chmod 700 "$PGDATA"
+fi
+
+exec postgres